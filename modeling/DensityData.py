@@ -9,7 +9,7 @@ from sklearn import linear_model
 # Connect to the database
 import dbconfig
 import psycopg2
-from sqlalchemy import create_engine
+from sanergy.modeling.connection import get_engine, connect
 
 # Visualizing the data
 import matplotlib
@@ -20,11 +20,8 @@ print('loadData')
 
 class Density:
 	def __init__(self):
-		self.engine = create_engine('postgresql+psycopg2://%s:%s@%s:%s' %(dbconfig.config['user'],
-											dbconfig.config['password'],
-											dbconfig.config['host'],
-											dbconfig.config['port']))
-		self.conn = self.engine.connect()
+		self.engine = get_engine({'backend':'postgres'}, dbconfig.config)
+		self.conn = connect(self.engine)
 		print('connected to postgres')
 
 		self.collects = pd.DataFrame()
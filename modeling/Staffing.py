@@ -1,7 +1,10 @@
 import pyscipopt as scip
 import pandas as pd
+import numpy as np
 import logging
 
+from sanergy.modeling.intervals import IntervalIndex, day_points
+
 class Staffing(object):
     N_DAYS = 7
     COL_ROUTE = 'Area'
@@ -43,9 +46,13 @@ class Staffing(object):
         self.next_days = self.schedule.columns
         self.routes = self.toilet_routes[self.config['cols']['route']].unique()
         self.tr_valid = self.toilet_routes.loc[self.toilet_routes[self.config['cols']['route']] != "None" ] #Drop the none-routes....
-        #Route-toilet dictionary
+        #Route-toilet dictionary: the toilets that were on route r up to today, from the route memberships over time
         #TODO: There will probably be an overlap...
-        rtd = { r:self.tr_valid.loc[(self.tr_valid[self.config['cols']['route']]==r) & (self.tr_valid[self.config['cols']['date']] <= today), self.config['cols']['toiletname']].unique() for r in self.routes}
+        self.memberships = IntervalIndex.by_group(self.tr_valid[self.config['cols']['toiletname']].values,
+                                                  day_points(self.tr_valid[self.config['cols']['date']]),
+                                                  self.tr_valid[self.config['cols']['route']].values)
+        first, last = np.iinfo(np.int64).min, day_points([today])[0]
+        rtd = { r:(self.memberships[r].overlapping(first, last) if r in self.memberships else []) for r in self.routes}
 
         #Only include the routes that have at least one toilet to collect
         #Select toilets which lie on route r
@@ -0,0 +1,80 @@
+"""
+Storage backends for the pipeline database, selected with db: backend in default.yaml.
+1. 'postgres' (default): the postgres server configured in sanergy.input.dbconfig
+2. 'sqlite': an embedded database in a local directory, one file per schema
+
+The sqlite backend attaches input.db, premodeling.db, modeling.db and output.db under their
+schema names, so the same schema-qualified queries (e.g., select * from modeling.dataset) and
+writers work against local files, without a network round trip or a running server.
+"""
+
+import os
+import logging
+
+import pandas as pd
+from sqlalchemy import create_engine, event
+
+from sanergy.modeling.writer import write_frame
+
+BACKENDS = ['postgres', 'sqlite']
+SCHEMAS = ['input', 'premodeling', 'modeling', 'output']
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+
+def postgres_url(dbconfig):
+    return('postgresql+psycopg2://%s:%s@%s:%s' %(dbconfig['user'],
+                                                dbconfig['password'],
+                                                dbconfig['host'],
+                                                dbconfig['port']))
+
+
+def attach_schemas(path):
+    """
+    Return a connect-event listener that attaches one database file per schema.
+    """
+    def attach(dbapi_connection, connection_record):
+        for schema in SCHEMAS:
+            dbapi_connection.execute("ATTACH DATABASE '%s' AS %s" %(os.path.join(path, schema + '.db'), schema))
+    return(attach)
+
+
+def create_db_engine(config_db, dbconfig=None, **kwargs):
+    """
+    Create the SQLAlchemy engine for the configured backend.
+    Args
+       DICT CONFIG_DB	The 'db' section of the yaml configuration
+       			(backend: 'postgres' or 'sqlite'; path: directory of the sqlite files)
+       DICT DBCONFIG	Postgres credentials, defaults to sanergy.input.dbconfig.config
+       KWARGS		Passed on to create_engine (e.g., pool settings)
+    Returns
+       Engine
+    """
+    backend = config_db.get('backend', 'postgres')
+    if backend == 'postgres':
+        if dbconfig is None:
+            import sanergy.input.dbconfig as default_dbconfig
+            dbconfig = default_dbconfig.config
+        return(create_engine(postgres_url(dbconfig), **kwargs))
+    elif backend == 'sqlite':
+        path = config_db['path']
+        if not os.path.exists(path):
+            os.makedirs(path)
+        engine = create_engine('sqlite:///%s' %(os.path.join(path, 'main.db')), **kwargs)
+        event.listen(engine, 'connect', attach_schemas(path))
+        return(engine)
+    else:
+        raise ValueError("Unsupported database backend {0}, use one of {1}".format(backend, BACKENDS))
+
+
+def mirror_table(source, target, schema, name, chunksize=100000):
+    """
+    Copy a table from one backend to another (e.g., premodeling.toiletcollection from postgres
+    into the local sqlite files), reading it in chunks.
+    """
+    chunks = pd.read_sql('select * from %s."%s"' %(schema, name), source, chunksize=chunksize)
+    n_rows = 0
+    for i_chunk, chunk in enumerate(chunks):
+        n_rows += write_frame(chunk, name, schema, target, if_exists='replace' if i_chunk == 0 else 'append', index=False)
+    log.info("Mirrored %s.%s (%i rows)" %(schema, name, n_rows))
+    return(n_rows)
@@ -0,0 +1,202 @@
+"""
+A local, memory-mapped copy of the modeling tables (modeling.dataset and modeling.toilet_route).
+1. A function to fingerprint the feature configuration (config['Xy'])
+2. A function to read the watermark (row count / max date) of the source table
+3. A class that writes the tables as one NumPy file per column and reads date windows back as slices
+
+The cache lives in a directory named after the fingerprint of config['Xy'] (one per feature variant),
+in a subdirectory named after the source watermark, so any change to either invalidates it. Folds are then served from the local files instead of Postgres.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+META_FILE = 'meta.json'
+TABLES = ['dataset', 'toilet_route']
+
+
+def config_fingerprint(config_Xy):
+    """
+    A stable hash of the feature configuration (features, lagged, unique, responses).
+    Args
+       DICT CONFIG_XY	The 'Xy' section of the yaml configuration
+    Returns
+       STR		Hex digest, identical for identical configurations
+    """
+    serialized = json.dumps(config_Xy, sort_keys=True, default=str)
+    return(hashlib.md5(serialized.encode('utf-8')).hexdigest())
+
+
+def source_watermark(db, date_col="Collection_Date"):
+    """
+    Row count and latest date of the source table the features are built from
+    (e.g., premodeling.toiletcollection).
+    Returns
+       DICT		{'n_rows':..., 'max_date':...}
+    """
+    statement = 'select count(*) as n_rows, max("%s") as max_date from %s.%s' %(date_col,
+                                                                              db['database'],
+                                                                              db['table'])
+    watermark = pd.read_sql(statement, con=db['connection'], params=None)
+    return({'n_rows': int(watermark['n_rows'][0]),
+            'max_date': str(watermark['max_date'][0])})
+
+
+def is_cache_entry(path):
+    """
+    Whether PATH is a directory written by a DatasetCache: it holds a table with its META_FILE.
+    """
+    return(os.path.isdir(path) and any([os.path.exists(os.path.join(path, name, META_FILE)) for name in TABLES]))
+
+
+class DatasetCache(object):
+    """
+    On-disk columnar cache of the modeling tables.
+
+    Every column is stored as its own .npy file. Strings/objects are stored as int32 codes with
+    the categories kept in the metadata. The 'dataset' table is kept sorted by date, so the rows
+    of a fold are a contiguous block of each column and are read as slices of memory-mapped arrays.
+    """
+
+    def __init__(self, directory, config_Xy, watermark, date_col="Collection_Date", toilet_col="ToiletID"):
+        self.date_col = date_col
+        self.toilet_col = toilet_col
+        self.root = os.path.join(directory, config_fingerprint(config_Xy))
+        self.key = config_fingerprint({'Xy': config_Xy, 'watermark': watermark})
+        self.path = os.path.join(self.root, self.key)
+        self._columns = {}
+        self._meta = {}
+
+    def exists(self):
+        return(all([os.path.exists(os.path.join(self.path, name, META_FILE)) for name in TABLES]))
+
+    def write(self, name, frame):
+        """
+        Write a table to the cache, replacing any earlier copy under the same key
+        and removing caches built for other keys.
+        """
+        self.prune()
+        table_path = os.path.join(self.path, name)
+        if os.path.exists(table_path):
+            shutil.rmtree(table_path)
+        os.makedirs(table_path)
+
+        sort_by = [col for col in [self.date_col, self.toilet_col] if col in frame.columns]
+        if len(sort_by) > 0:
+            frame = frame.sort_values(by=sort_by)
+
+        meta = {'columns': [], 'n_rows': len(frame)}
+        for i_col, col in enumerate(frame.columns):
+            values = frame[col].values
+            file_name = '%i.npy' %(i_col)
+            column = {'name': col, 'file': file_name, 'categories': None}
+            if str(frame[col].dtype) == 'category':
+                categories = frame[col].cat.categories
+                values = frame[col].cat.codes.values.astype(np.int32)
+                column['categories'] = [cat if isinstance(cat, (str, type(u''))) else str(cat) for cat in categories]
+            elif values.dtype == object:
+                codes, categories = pd.factorize(values)
+                values = codes.astype(np.int32)
+                column['categories'] = [cat if isinstance(cat, (str, type(u''))) else str(cat) for cat in categories]
+            np.save(os.path.join(table_path, file_name), values)
+            meta['columns'].append(column)
+
+        with open(os.path.join(table_path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        self._columns.pop(name, None)
+        log.debug("Cached %s (%i rows) in %s" %(name, len(frame), table_path))
+
+    def prune(self):
+        """
+        Remove the cache directories of this configuration built for other watermarks. Only the
+        directories written by a DatasetCache (a table with its META_FILE) are removed.
+        """
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        for entry in os.listdir(self.root):
+            entry_path = os.path.join(self.root, entry)
+            if (entry != self.key) and is_cache_entry(entry_path):
+                shutil.rmtree(entry_path)
+
+    def _open(self, name):
+        """
+        Memory-map the columns of a table (once per process).
+        """
+        if name not in self._columns:
+            table_path = os.path.join(self.path, name)
+            with open(os.path.join(table_path, META_FILE), 'r') as f:
+                meta = json.load(f)
+            self._meta[name] = meta
+            self._columns[name] = [np.load(os.path.join(table_path, column['file']), mmap_mode='r')
+                                   for column in meta['columns']]
+        return(self._meta[name], self._columns[name])
+
+    def columns(self, name):
+        meta, _ = self._open(name)
+        return([column['name'] for column in meta['columns']])
+
+    def date_bounds(self, name, start=None, end=None):
+        """
+        Row offsets [lo, hi) of the dates within [start, end] (both inclusive).
+        """
+        meta, columns = self._open(name)
+        names = [column['name'] for column in meta['columns']]
+        dates = columns[names.index(self.date_col)]
+        lo = 0 if start is None else int(np.searchsorted(dates, np.datetime64(start, 'ns'), side='left'))
+        hi = len(dates) if end is None else int(np.searchsorted(dates, np.datetime64(end, 'ns'), side='right'))
+        return(lo, hi)
+
+    def read(self, name, start=None, end=None, columns=None):
+        """
+        Read a table (or the rows between the START and END dates) as a data frame.
+        Only the requested rows are read from the mapped files, but the data frame holds a copy of
+        them (the strings decoded to objects); the folds are then cut from it as views (see FoldSlicer).
+        """
+        meta, arrays = self._open(name)
+        if (start is None) and (end is None):
+            lo, hi = 0, meta['n_rows']
+        else:
+            lo, hi = self.date_bounds(name, start, end)
+        data = {}
+        names = []
+        for column, values in zip(meta['columns'], arrays):
+            if (columns is not None) and (column['name'] not in columns):
+                continue
+            values = values[lo:hi]
+            if column['categories'] is not None:
+                values = pd.Categorical.from_codes(values, column['categories']).astype(object)
+            data[column['name']] = values
+            names.append(column['name'])
+        return(pd.DataFrame(data, columns=names))
+
+
+def open_dataset_cache(db, config, log, fill=True):
+    """
+    Return the DatasetCache for the current configuration, or None if caching is switched off
+    (no 'cache_dir' in the 'setup' section). If the cache is stale and FILL is set (the features are
+    not going to be rebuilt in this run), fill it once from the modeling tables in db['tables'].
+    """
+    cache_dir = config['setup'].get('cache_dir')
+    if not cache_dir:
+        return(None)
+    watermark = source_watermark(db, config['cols']['date'])
+    cache = DatasetCache(cache_dir, config['Xy'], watermark,
+                         date_col=config['cols']['date'],
+                         toilet_col=config['cols']['toiletname'])
+    if cache.exists():
+        log.info("Using the local dataset cache %s" %(cache.path))
+    elif fill:
+        log.info("Filling the local dataset cache %s" %(cache.path))
+        for name in TABLES:
+            table = pd.read_sql('select * from modeling.%s' %(db['tables'][name]), db['connection'], coerce_float=True, params=None,
+                                parse_dates=[config['cols']['date']])
+            cache.write(name, table)
+    return(cache)
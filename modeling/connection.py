@@ -0,0 +1,135 @@
+"""
+Connection management shared by the pipeline (run.py) and the premodeling scripts.
+1. One pooled engine per process and database (get_engine), sized from the 'db' section of the yaml
+2. Health checks: every connection is pinged when it leaves the pool and is replaced if it is dead
+3. Per-thread connections (thread_connection), so concurrent stages do not share one socket
+4. Pool wait times (pool_stats), to tell whether the pool is too small for the work
+"""
+
+import os
+import time
+import logging
+import threading
+
+from sqlalchemy import event, exc
+
+from sanergy.modeling.backend import create_db_engine
+
+POOL_DEFAULTS = {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30, 'pool_recycle': 3600}
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+_engines = {}
+_stats = {}
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Checkout listener: test the connection before it is handed out. A DisconnectionError makes
+    the pool discard it and retry with a fresh connection.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        log.warning("Stale database connection, reconnecting")
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def engine_key(config_db):
+    return((os.getpid(), config_db.get('backend', 'postgres'), config_db.get('path')))
+
+
+def get_engine(config_db=None, dbconfig=None):
+    """
+    Return the engine of this process for the configured database, creating it on first use.
+    Args
+       DICT CONFIG_DB	The 'db' section of the yaml configuration. Besides backend/path, the pool
+       			is sized with pool_size, max_overflow, pool_timeout and pool_recycle (seconds)
+       DICT DBCONFIG	Postgres credentials, defaults to sanergy.input.dbconfig.config
+    Returns
+       Engine		Shared by all threads of the process; a forked worker gets its own
+    """
+    if config_db is None:
+        config_db = {}
+    key = engine_key(config_db)
+    with _lock:
+        if key not in _engines:
+            kwargs = {}
+            if config_db.get('backend', 'postgres') == 'postgres':
+                kwargs = dict([(kk, config_db.get(kk, vv)) for kk, vv in POOL_DEFAULTS.items()])
+            engine = create_db_engine(config_db, dbconfig, **kwargs)
+            event.listen(engine, 'checkout', ping_connection)
+            _engines[key] = engine
+            _stats[key] = {'checkouts': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+            log.debug("Created a %s engine (%s)" %(engine.dialect.name, engine.pool.status()))
+    return(_engines[key])
+
+
+def connect(engine):
+    """
+    Check a connection out of the pool, recording how long it took.
+    """
+    started = time.time()
+    connection = engine.connect()
+    waited = time.time() - started
+    stats = _stats.get(engine_key_of(engine))
+    if stats is not None:
+        with _lock:
+            stats['checkouts'] += 1
+            stats['wait_seconds'] += waited
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+    return(connection)
+
+
+def engine_key_of(engine):
+    for key, known in _engines.items():
+        if known is engine:
+            return(key)
+    return((os.getpid(), None, None))
+
+
+def thread_connection(engine):
+    """
+    The connection of the calling thread (one per thread and engine), reopened if it was closed
+    or invalidated. Close it with release_thread_connection when the thread is done.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None or getattr(_local, 'pid', None) != os.getpid():
+        # A forked process must not reuse the sockets of its parent
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+    connection = connections.get(id(engine))
+    if connection is None or connection.closed or connection.invalidated:
+        connection = connections[id(engine)] = connect(engine)
+    return(connection)
+
+
+def release_thread_connection(engine):
+    connections = getattr(_local, 'connections', {})
+    connection = connections.pop(id(engine), None)
+    if connection is not None and not connection.closed:
+        connection.close()
+
+
+def pool_stats(engine):
+    """
+    Checkout count, total and longest wait (seconds) for the pool of ENGINE, and its status line.
+    """
+    stats = dict(_stats.get(engine_key_of(engine), {'checkouts': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}))
+    stats['status'] = engine.pool.status()
+    return(stats)
+
+
+def dispose_engines():
+    """
+    Close the pools of this process (e.g., at the end of a run or in a worker that is exiting).
+    """
+    with _lock:
+        for key in [kk for kk in _engines if kk[0] == os.getpid()]:
+            _engines.pop(key).dispose()
+            _stats.pop(key, None)
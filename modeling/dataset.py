@@ -6,9 +6,7 @@ A script that is imported by run.py to manage dataset extraction and writing res
 """
 
 # Connect to the database
-import sanergy.input.dbconfig as dbconfig
-import psycopg2
-from sqlalchemy import create_engine
+from sanergy.modeling.connection import get_engine, connect
 
 # Analyzing the data
 import pandas as pd
@@ -17,23 +15,36 @@ import numpy as np
 # Helper functions
 import re, pprint
 from datetime import datetime, date, timedelta
+from sanergy.modeling.features import add_daily_features
+from sanergy.modeling.writer import write_frame, create_index
+from sqlalchemy import text
+from sanergy.modeling.ingest import read_compact
+from sanergy.modeling.encoding import CategoricalEncoder
+from sanergy.modeling.intervals import IntervalIndex
 
 # For logging errors
 import logging
 
+# The tables written by grab_collections_data in the modeling schema (db['tables'] may point elsewhere,
+# see modeling/feature_store.py)
+MODELING_TABLES = {'dataset': 'dataset', 'toilet_route': 'toilet_route', 'vocabulary': 'vocabulary'}
+
 
 
 def get_db(config, log):
-	engine = create_engine('postgresql+psycopg2://%s:%s@%s:%s' %(dbconfig.config['user'],
-	dbconfig.config['password'],
-	dbconfig.config['host'],
-	dbconfig.config['port']))
+	"""
+	Connect to the database backend configured in config['db'] (postgres or a local sqlite directory,
+	see modeling/backend.py). The engine is the pooled engine of this process (see modeling/connection.py);
+	db['connection'] is one connection checked out of it, and stages running in other threads
+	should take their own with thread_connection(db['engine']).
+	"""
+	engine = get_engine(config['db'])
 	try:
-		conn = engine.connect()
-		log.info('connected to postgres')
+		conn = connect(engine)
+		log.info('connected to %s' %(engine.dialect.name))
 	except:
-		log.warning('Failure to connect to postgres')
-	db = {'connection': conn, 'table': config['db']['table'], 'database': config['db']['database']}
+		log.warning('Failure to connect to %s' %(engine.dialect.name))
+	db = {'engine': engine, 'connection': conn, 'table': config['db']['table'], 'database': config['db']['database'], 'cache': None, 'tables': MODELING_TABLES}
 	return(db)
 
 def temporal_split(config_cv, day_of_week=None, floating_window=False):
@@ -123,47 +134,6 @@ def write_statement(vardict):
 	pprint.pprint(conditions)
 	return(conditions)
 
-def demand_daily_data(db, rows=[], feature='', function='lag', unique=['ToiletID','Collection_Date'], conditions=None):
-	"""
-	A function to generate by day variables for a feature
-
-	Args:
-	   DICT DB		Connection object (see grab_collections_data)
-	   LIST ROWS		List of rows
-	   STR FEATURE		A feature name to create daily records for
-	   STR FUNCTION		Apply either the LAG or LEAVE function (in the future, maybe some other functions)
-	   LIST UNIQUE		List of unique identifiers
-	   STR CONDITIONS	Apply the conditions string (see grab_collections_data)
-	Returns:
-	   DF DAILY_DATA	Pandas data frame of daily variables
-	"""
-
-	# Reprocess the unique list to account for capitalization
-	unique = ','.join(['"%s"' %(uu) for uu in unique])
-
-	# Construct the sql statement using window functions (e.g., OVER and LAG/LEAVE)
-	statement = 'SELECT %s' %(unique)
-	for rr in rows:
-		statement += ', %s("%s", %i, NULL) OVER(order by %s) as "%s_%s%i" ' %(function,
-										      feature,
-										      rr,
-										      unique,
-										      feature,
-										      function,
-										      rr)
-	# Complete the statement
-	statement += "FROM %s.%s %s ORDER BY %s" %(db['database'],
-				  		   db['table'],
-					  	   conditions,
-						   unique)
-	# Execute the statement
-	daily_data = pd.read_sql(statement,
-				con=db['connection'],
-				coerce_float=True,
-				params=None)
-	# Return the lagged/leave data
-	return(daily_data)
-
 def grab_collections_data(db, config, log ):
     """
     A function to return a postgres query as a Pandas data frame
@@ -182,7 +152,7 @@ def grab_collections_data(db, config, log ):
     DICT[dict] UNIQUE	The unique variables for the dataset
     (e.g., {'Collection_Date':{}}, {'ToiletID':{}}
     DICT LAGGED		The variables to be lagged are keys, the direction, and
-    number of rows forward or back are values.
+    number of days forward or back are values (see modeling/features.py).
     (e.g., {'Feces_kg_day':{'function':'lag',
     'rows':[1,2]}}
     Returns:
@@ -196,6 +166,7 @@ def grab_collections_data(db, config, log ):
     unique = config_Xy['unique']
     lagged = config_Xy['lagged']
     RESPONSE_RENAMER = {'response_f':'response', 'response_u':'response'}
+    tables = db.get('tables', MODELING_TABLES)
 
     # Create the list of all variables requested from the database
     list_of_variables = [response_f['variable']]+[response_u['variable']]+features.keys()+unique.keys()
@@ -212,79 +183,77 @@ def grab_collections_data(db, config, log ):
     else:
         conditions = ""
     # Create the SQL statement requesting the data
-	statement = "select %s from %s.%s %s" %(','.join(list_of_variables),
-						db['database'],
-						db['table'],
-						conditions)
-	# Retrieve the dataset from postgres
-	dataset = pd.read_sql(statement,
-				con=db['connection'],
-				coerce_float=True,
-				params=None)
-	log.debug("Retrieved the dataset.")
-	# Incorporate DAILY features (function reuses 'conditions', 'unique' variables, and 'db'
-	for ll in lagged.keys():
-		daily_data = demand_daily_data(db,
-				rows=lagged[ll]['rows'],
-				feature=ll,
-				function=lagged[ll]['function'],
-				unique=unique.keys(),
-				conditions=conditions)
-		# Merge the DAILY features with DATASET
-		dataset = pd.merge(dataset,
-				   daily_data,
-				   how='inner',
-				   on=unique.keys())
-		dataset['duplicated']=dataset[unique.keys()].duplicated()
-		print(dataset['duplicated'].value_counts())
-		dataset = dataset.loc[dataset['duplicated']==False]
-		dataset = dataset.drop(["duplicated"], axis=1)
-	# Return the response variable
+    statement = "select %s from %s.%s %s" %(','.join(list_of_variables),
+                                            db['database'],
+                                            db['table'],
+                                            conditions)
+    # Retrieve the dataset from postgres, in chunks of compact dtypes (see modeling/ingest.py)
+    dataset = read_compact(statement,
+                           con=db['connection'],
+                           chunksize=config['db'].get('chunksize'),
+                           parse_dates=[config['cols']['date']],
+                           keep=unique.keys())
+    log.debug("Retrieved the dataset (%.1f MB)." %(dataset.memory_usage(index=True).sum() / 1e6))
+    # Incorporate DAILY features (lags/leads/rolling windows by toilet), computed in memory
+    if len(lagged) > 0:
+        dataset = dataset.drop_duplicates(subset=unique.keys())
+        dataset = add_daily_features(dataset,
+                                     lagged,
+                                     toiletname=config['cols']['toiletname'],
+                                     date=config['cols']['date'])
+    # Return the response variable
     #Binary response variable? Ignore this.
-	# if (bool(response['split'])==True):
-	# 	statement = ""
-	# 	for split in response['split']:
-	# 		if (split=='and'):
-	# 			statement = '&'.join(['(dataset["%s"]%s%s)' %(response['variable'],sp[0],sp[1])
-	# 					for sp in response['split'][split]])
-	# 		elif (split=='or'):
-	# 			statement = '|'.join(['(dataset["%s"]%s%s)' %(response['variable'],sp[0],sp[1])
-	# 					for sp in response['split'][split]])
-	# 	dataset['response'] = False
-	# 	dataset.loc[(eval(statement)),"response"] = True
-	# else:
-	dataset['response_f'] = dataset[response_f['variable']]
+    # if (bool(response['split'])==True):
+    # 	statement = ""
+    # 	for split in response['split']:
+    # 		if (split=='and'):
+    # 			statement = '&'.join(['(dataset["%s"]%s%s)' %(response['variable'],sp[0],sp[1])
+    # 					for sp in response['split'][split]])
+    # 		elif (split=='or'):
+    # 			statement = '|'.join(['(dataset["%s"]%s%s)' %(response['variable'],sp[0],sp[1])
+    # 					for sp in response['split'][split]])
+    # 	dataset['response'] = False
+    # 	dataset.loc[(eval(statement)),"response"] = True
+    # else:
+    dataset['response_f'] = dataset[response_f['variable']]
     dataset['response_u'] = dataset[response_u['variable']]
 
     #Link ToiletIds to areas. For now, just link by the route. For now, assume the route is available.
     toilet_route = dataset[[config['cols']['toiletname'], config['cols']['date'], config['cols']['route']]]
-    db['connection'].execute('DROP TABLE IF EXISTS modeling."toilet_route"')
-    toilet_route.to_sql(name='toilet_route',
-    schema="modeling",
-    con=db['connection'],
-    chunksize=20000)
+    write_frame(toilet_route, tables['toilet_route'], 'modeling', db['connection'], if_exists='replace')
+    create_index(db['connection'], 'modeling', tables['toilet_route'], [config['cols']['date'], config['cols']['toiletname']])
     dataset.drop([config['cols']['route']], axis=1, inplace = True)
 
     #Code the categorical/string variables to dummies
-    str_vars = [row for row, tp in dataset.dtypes.iteritems() if tp == 'object']
+    str_vars = [row for row, tp in dataset.dtypes.iteritems() if str(tp) in ['object', 'category']]
     vars_to_dummify = set(list_of_predictors).intersection(str_vars)
-    dataset = pd.get_dummies(dataset, columns = vars_to_dummify, drop_first = True)
+    if config_Xy.get('sparse_categoricals', False):
+        # Keep the strings, the models one-hot encode them as sparse matrices (see modeling/encoding.py)
+        encoder = CategoricalEncoder().fit(dataset, vars_to_dummify)
+        write_frame(encoder.to_frame(), tables['vocabulary'], 'modeling', db['connection'], if_exists='replace', index=False)
+    else:
+        dataset = pd.get_dummies(dataset, columns = vars_to_dummify, drop_first = True)
 
 
     # Divide the dataset into a LABELS and FEATURES dataframe so that they link by UNIQUE variables
-    dataset = dataset.sort_values(by=unique.keys())
-    db['connection'].execute('DROP TABLE IF EXISTS modeling."dataset"')
-    dataset.to_sql(name='dataset',
-    schema="modeling",
-    con=db['connection'],
-    chunksize=20000)
+    dataset.sort_values(by=unique.keys(), inplace=True)
+    write_frame(dataset, tables['dataset'], 'modeling', db['connection'], if_exists='replace')
+    create_index(db['connection'], 'modeling', tables['dataset'], [config['cols']['date'], config['cols']['toiletname']])
 
+    # Keep a local copy for the folds (same columns as the tables written above)
+    if db.get('cache') is not None:
+        db['cache'].write('dataset', dataset.reset_index())
+        db['cache'].write('toilet_route', toilet_route.reset_index())
 
 
-    x_features = dataset.drop(['response_f', 'response_u',response_f['variable'], response_u['variable']], axis=1)
 
+    # Only the features come out without a second full-width copy: they are the dataset itself, with the
+    # responses dropped in place. The labels are copies (three columns), as pandas copies any selection
+    # of columns that are not one contiguous slice of a single block.
     yf_labels = dataset[['response_f']+unique.keys()].rename(columns=RESPONSE_RENAMER)
     yu_labels = dataset[['response_u']+unique.keys()].rename(columns=RESPONSE_RENAMER)
+    x_features = dataset
+    x_features.drop(['response_f', 'response_u',response_f['variable'], response_u['variable']], axis=1, inplace=True)
     # Insert tables into database
     return(yf_labels, yu_labels, x_features, toilet_route)
 
@@ -301,31 +270,169 @@ def grab_from_features_and_labels(db, fold, config):
     df features test
     df labels test
     """
+    dataset, toilet_routes = load_modeling_tables(db, fold['train_start'], fold['test_end'], config=config, contiguous=True)
+    return(FoldSlicer(dataset, toilet_routes, config).split(fold))
+
+def needed_columns(config, available):
+    """
+    The columns of modeling.dataset an experiment uses: the unique keys, the responses and the
+    features, with their dummies (<feature>_<level>) and daily features (<feature>_<function><rows>).
+    """
+    config_Xy = config['Xy']
+    exact = set(config_Xy['unique'].keys() + ['response_f', 'response_u',
+                config_Xy['response_f']['variable'], config_Xy['response_u']['variable']] + config_Xy['features'].keys())
+    prefixes = tuple([ff + '_' for ff in config_Xy['features'].keys() + config_Xy['lagged'].keys()])
+    return([col for col in available if (col in exact) or col.startswith(prefixes)])
+
+def fold_statement(table, columns, toiletname='ToiletID', date='Collection_Date', contiguous=False):
+    """
+    The query of the COLUMNS of TABLE within the dates :start (included) to :end (excluded).
+    With CONTIGUOUS, only the toilets that have data on every day of the window (as many rows as
+    the toilet with the most rows) are kept.
+    """
+    window = '(d."%s" >= :start) and (d."%s" < :end)' %(date, date)
+    projection = ','.join(['d."%s"' %(col) for col in columns])
+    if not contiguous:
+        return('select %s from modeling.%s d where %s' %(projection, table, window))
+    return(('with days as (select d."%s", count(*) as n_days from modeling.%s d where %s group by d."%s") '
+            'select %s from modeling.%s d join days on (d."%s" = days."%s") '
+            'where %s and days.n_days = (select max(n_days) from days)') %(toiletname, table, window, toiletname,
+                                                                          projection, table, toiletname, toiletname,
+                                                                          window))
+
+def load_modeling_tables(db, start=None, end=None, config=None, contiguous=False):
+    """
+    Read modeling.dataset (optionally only the dates between START and END) and modeling.toilet_route
+    (up to END), from the local cache if there is one (see modeling/cache.py), otherwise from the
+    database (the tables named in db['tables']). The date filters run on the server, on the
+    ("Collection_Date", "ToiletID") indexes.
+    Args
+       DICT CONFIG	If given, only the columns of the experiment are read (see needed_columns)
+       BOOL CONTIGUOUS	Drop the toilets that do not have data for the whole window in the query
+    """
+    tables = db.get('tables', MODELING_TABLES)
+    toiletname = config['cols']['toiletname'] if config is not None else 'ToiletID'
+    date = config['cols']['date'] if config is not None else 'Collection_Date'
+    if db.get('cache') is not None:
+        columns = None
+        if config is not None:
+            columns = needed_columns(config, db['cache'].columns('dataset'))
+        dataset = db['cache'].read('dataset', start=start, end=end, columns=columns)
+        toilet_routes = db['cache'].read('toilet_route')
+        return(dataset, toilet_routes)
+
+    columns = pd.read_sql('select * from modeling.%s where 1 = 0' %(tables['dataset']), db['connection']).columns
+    if config is not None:
+        columns = needed_columns(config, columns)
+    # Up to (not including) the day after END, which also works on the text dates of sqlite
+    params = {'start': (start or datetime(1900, 1, 1)).strftime('%Y-%m-%d'),
+              'end': ((end or datetime(2100, 1, 1)) + timedelta(days=1)).strftime('%Y-%m-%d')}
+    statement = fold_statement(tables['dataset'], columns, toiletname, date, contiguous)
+    dataset = pd.read_sql(text(statement), db['connection'], coerce_float=True, params=params, parse_dates=[date])
+    toilet_routes = pd.read_sql(text('select * from modeling.%s where "%s" < :end' %(tables['toilet_route'], date)),
+                                db['connection'], coerce_float=True, params={'end': params['end']}, parse_dates=[date])
+    return(dataset, toilet_routes)
+
+class FoldSlicer(object):
+    """
+    Hold the whole modeling dataset in memory, sorted by date and toilet, and cut the folds out of it.
+
+    The dataset is cleaned (NaN -> 0), sorted and split into features and feces/urine labels once.
+    A date -> row offset index then gives the rows of any date range as one contiguous block,
+    so a fold costs two binary searches instead of a query, a sort and six boolean masks.
+    With sparse_categoricals, ENCODER (a CategoricalEncoder) is handed on to the models.
+    """
     RESPONSE_RENAMER = {'response_f':'response', 'response_u':'response'}
-    dataset = pd.read_sql('select * from modeling.dataset where (("Collection_Date" >= '+"'"+fold['train_start'].strftime('%Y-%m-%d')+"'"+') and ("Collection_Date" <= '+"'"+fold['test_end'].strftime('%Y-%m-%d')+"'"+'))', db['connection'], coerce_float=True, params=None)
-    toilet_routes = pd.read_sql('select * from modeling.toilet_route', db['connection'], coerce_float=True, params=None)
-
-    #TODO: Fix this...
-    dataset = dataset.fillna(0) #A hack to make it run for now...
-    #Drop the toilets that do not have contiguous data.
-    # Note that missing collections are filled with NaN'd rows, so if a toilet is not contiguous, it must mean that it appeared or disappeared during the fold period -> ignore it.
-    toilet_groups = dataset.groupby(config['cols']['toiletname'])
-    toilets = dataset[config['cols']['toiletname']].unique()
-    number_of_days = max(toilet_groups.size())
-    contiguous_toilets = [t for t in toilets if (toilet_groups.size()[t] == number_of_days)]
-    dataset = dataset.loc[dataset[config['cols']['toiletname']].isin(contiguous_toilets)]
-    #Sort for the purposes of later functions...
-    dataset = dataset.sort_values(by=['Collection_Date','ToiletID'])
-
-
-    features_train = dataset.loc[((dataset['Collection_Date']>=fold["train_start"]) & (dataset['Collection_Date']<=fold["train_end"]))].drop(['response_f','response_u',config['Xy']['response_f']['variable'], config['Xy']['response_u']['variable']],axis=1)
-    features_test = dataset.loc[((dataset['Collection_Date']>=fold["test_start"]) & (dataset['Collection_Date']<=fold["test_end"]))].drop(['response_f','response_u',config['Xy']['response_f']['variable'], config['Xy']['response_u']['variable']],axis=1)
-
-    labels_train_u = dataset.loc[((dataset['Collection_Date']>=fold["train_start"]) & (dataset['Collection_Date']<=fold["train_end"])),['response_u','Collection_Date','ToiletID']].rename(columns=RESPONSE_RENAMER)
-    labels_train_f = dataset.loc[((dataset['Collection_Date']>=fold["train_start"]) & (dataset['Collection_Date']<=fold["train_end"])),['response_f','Collection_Date','ToiletID']].rename(columns=RESPONSE_RENAMER)
-    labels_test_f = dataset.loc[((dataset['Collection_Date']>=fold["test_start"]) & (dataset['Collection_Date']<=fold["test_end"])),['response_f','Collection_Date','ToiletID']].rename(columns=RESPONSE_RENAMER)
-    labels_test_u = dataset.loc[((dataset['Collection_Date']>=fold["test_start"]) & (dataset['Collection_Date']<=fold["test_end"])),['response_u','Collection_Date','ToiletID']].rename(columns=RESPONSE_RENAMER)
-    return(features_train, labels_train_f, labels_train_u, features_test, labels_test_f, labels_test_u, toilet_routes)
+
+    def __init__(self, dataset, toilet_routes, config, encoder=None):
+        self.config = config
+        self.encoder = encoder
+        self.toilet_routes = toilet_routes
+        toiletname = config['cols']['toiletname']
+        date = config['cols']['date']
+
+        #TODO: Fix this...
+        dataset = dataset.fillna(0) #A hack to make it run for now...
+        dataset = dataset.sort_values(by=[date, toiletname])
+        dataset.reset_index(drop=True, inplace=True)
+
+        # Date -> first row offset (with a sentinel at the end)
+        self.dates = dataset[date].values
+        self.unique_dates, first_rows = np.unique(self.dates, return_index=True)
+        self.offsets = np.append(first_rows, len(dataset))
+        # Toilets as integer codes, and the runs of consecutive dates each toilet has data on
+        self.toilet_codes, self.toilets = pd.factorize(dataset[toiletname])
+        self.lifetimes = IntervalIndex.from_runs(self.toilet_codes, np.searchsorted(self.unique_dates, self.dates))
+
+        self.features = dataset.drop(['response_f', 'response_u',
+                                      config['Xy']['response_f']['variable'],
+                                      config['Xy']['response_u']['variable']], axis=1)
+        self.labels_f = dataset[['response_f', date, toiletname]].rename(columns=self.RESPONSE_RENAMER)
+        self.labels_u = dataset[['response_u', date, toiletname]].rename(columns=self.RESPONSE_RENAMER)
+
+    @classmethod
+    def from_db(cls, db, config, folds=None):
+        """
+        Load the dataset once (from the local cache if there is one), restricted to the dates the folds cover.
+        """
+        if folds:
+            window = create_enveloping_fold(folds)
+            dataset, toilet_routes = load_modeling_tables(db, window['window_start'], window['window_end'], config=config)
+        else:
+            dataset, toilet_routes = load_modeling_tables(db, config=config)
+        encoder = None
+        if config['Xy'].get('sparse_categoricals', False):
+            encoder = CategoricalEncoder.from_db(db['connection'], db.get('tables', MODELING_TABLES)['vocabulary'])
+        return(cls(dataset, toilet_routes, config, encoder))
+
+    def date_positions(self, start, end):
+        """
+        Positions [first, last) in unique_dates of the dates within [start, end] (both inclusive), in O(log n).
+        """
+        first = np.searchsorted(self.unique_dates, np.datetime64(start, 'ns'), side='left')
+        last = np.searchsorted(self.unique_dates, np.datetime64(end, 'ns'), side='right')
+        return(first, last)
+
+    def rows(self, start, end):
+        """
+        Row offsets [lo, hi) of the dates within [start, end] (both inclusive), in O(log n).
+        """
+        first, last = self.date_positions(start, end)
+        return(self.offsets[first], self.offsets[last])
+
+    def split(self, fold):
+        """
+        Cut a fold (as produced by temporal_split) out of the dataset.
+        Returns the same tuple as grab_from_features_and_labels:
+        features train, labels train (feces, urine), features test, labels test (feces, urine), toilet routes
+        """
+        first, last = self.date_positions(fold['train_start'], fold['test_end'])
+        lo, hi = self.offsets[first], self.offsets[last]
+        # Drop the toilets that do not have contiguous data: keep the ones with a run of dates over the whole fold.
+        # Note that missing collections are filled with NaN'd rows, so if a toilet is not contiguous, it must mean that it appeared or disappeared during the fold period -> ignore it.
+        contiguous = np.ones(len(self.toilets), dtype=bool)
+        if last > first:
+            present = self.lifetimes.overlapping(first, last - 1)
+            covering = self.lifetimes.covering(first, last - 1)
+            if len(covering) == 0:
+                # No toilet has data on every date: keep the ones with the most days
+                days_per_toilet = np.bincount(self.toilet_codes[lo:hi], minlength=len(self.toilets))
+                covering = np.flatnonzero(days_per_toilet == days_per_toilet.max())
+            contiguous[present] = False
+            contiguous[covering] = True
+        train_lo, train_hi = self.rows(fold['train_start'], fold['train_end'])
+        test_lo, test_hi = self.rows(fold['test_start'], fold['test_end'])
+        if contiguous.all():
+            train = slice(train_lo, train_hi)
+            test = slice(test_lo, test_hi)
+        else:
+            keep = np.flatnonzero(contiguous[self.toilet_codes[lo:hi]]) + lo
+            train = keep[np.searchsorted(keep, train_lo):np.searchsorted(keep, train_hi)]
+            test = keep[np.searchsorted(keep, test_lo):np.searchsorted(keep, test_hi)]
+
+        return(self.features.iloc[train], self.labels_f.iloc[train], self.labels_u.iloc[train],
+               self.features.iloc[test], self.labels_f.iloc[test], self.labels_u.iloc[test],
+               self.toilet_routes)
 
 def format_features_labels(features_big,labels_big):
 
@@ -0,0 +1,95 @@
+"""
+Sparse one-hot encoding of the categorical features (Area, Route_Name, OpportunityName, ...).
+
+Instead of one dense dummy column per category in modeling.dataset, the categorical columns are
+kept as strings and encoded per fold as a SciPy CSR matrix, next to the numeric columns.
+The vocabulary (the codes of the categories) is built once on the whole dataset and stored in
+modeling.vocabulary, so the columns of the design matrix are the same in every fold and run.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from sanergy.modeling.ingest import encode_strings
+
+# Models fitted on the sparse matrix directly, the others get a dense array
+SPARSE_MODELS = ['LinearRegression', 'Lasso', 'ElasticNet', 'SVR']
+
+
+class CategoricalEncoder(object):
+    """
+    One-hot encode categorical columns against a persistent vocabulary.
+    The categories of a column are coded in sorted order and the first one is dropped, as
+    pd.get_dummies(..., drop_first=True) does; values missing from the vocabulary encode as all zeros.
+    """
+
+    def __init__(self, vocabulary=None):
+        # {column: [category, ...]}, the position in the list is the code
+        self.vocabulary = vocabulary if vocabulary is not None else {}
+
+    @property
+    def columns(self):
+        return(sorted(self.vocabulary.keys()))
+
+    def fit(self, frame, columns):
+        """
+        Add the categories of COLUMNS in FRAME to the vocabulary, sorted (existing codes are kept).
+        """
+        for col in columns:
+            vocabulary = self.vocabulary.setdefault(col, [])
+            known = set(vocabulary)
+            values = frame[col].dropna().astype(object).unique()
+            vocabulary.extend(sorted([value for value in values if value not in known]))
+        return(self)
+
+    def feature_names(self, numeric):
+        names = list(numeric)
+        for col in self.columns:
+            names.extend(['%s_%s' %(col, value) for value in self.vocabulary[col][1:]])
+        return(pd.Index(names))
+
+    def transform(self, frame, dense=False):
+        """
+        The design matrix of FRAME: its numeric columns followed by the one-hot categories.
+        Args
+           DF FRAME		Features, including the categorical columns of the vocabulary
+           BOOL DENSE	Return a numpy array instead of a CSR matrix
+        Returns
+           CSR MATRIX (or ARRAY), the names of its columns
+        """
+        numeric = [col for col in frame.columns if col not in self.vocabulary]
+        n_rows = len(frame)
+        blocks = [sparse.csr_matrix(frame[numeric].values.astype(np.float64))]
+        for col in self.columns:
+            vocabulary = self.vocabulary[col]
+            if len(vocabulary) < 2:
+                continue
+            codes = encode_strings(frame[col].astype(object).values, list(vocabulary))
+            codes[codes >= len(vocabulary)] = -1  # Unseen categories
+            rows = np.flatnonzero(codes > 0)
+            blocks.append(sparse.csr_matrix((np.ones(len(rows)), (rows, codes[rows] - 1)),
+                                            shape=(n_rows, len(vocabulary) - 1)))
+        matrix = sparse.hstack(blocks, format='csr')
+        if dense:
+            matrix = matrix.toarray()
+        return(matrix, self.feature_names(numeric))
+
+    def to_frame(self):
+        """
+        The vocabulary as a table (variable, code, value), e.g., for modeling.vocabulary.
+        """
+        rows = [(col, code, value) for col in self.columns
+                for code, value in enumerate(self.vocabulary[col])]
+        return(pd.DataFrame(rows, columns=['variable', 'code', 'value']))
+
+    @classmethod
+    def from_frame(cls, table):
+        vocabulary = {}
+        for col, group in table.sort_values(by=['variable', 'code']).groupby('variable'):
+            vocabulary[col] = list(group['value'])
+        return(cls(vocabulary))
+
+    @classmethod
+    def from_db(cls, con, table='vocabulary'):
+        return(cls.from_frame(pd.read_sql('select * from modeling.%s' %(table), con)))
@@ -0,0 +1,128 @@
+"""
+A versioned store of the modeling tables, keyed by the feature configuration.
+
+Every distinct config['Xy'] (features, lagged, unique, responses, ...) is materialized in its own
+tables, modeling.dataset_<key>, modeling.toilet_route_<key> and modeling.vocabulary_<key>, where <key>
+is the content hash of the configuration. The lineage of every materialization is kept in
+modeling.feature_store (configuration, source table watermark, build time, row count), so a run
+reuses the tables of its configuration when the source has not changed since they were built,
+and rebuilds them otherwise. Several feature variants can then coexist and be evaluated in one sweep.
+"""
+
+import copy
+import json
+import logging
+from datetime import datetime
+
+import pandas as pd
+
+from sanergy.modeling.cache import config_fingerprint, source_watermark
+from sanergy.modeling.dataset import grab_collections_data, MODELING_TABLES
+from sanergy.modeling.writer import write_frame
+
+LINEAGE_TABLE = 'feature_store'
+KEY_LENGTH = 12
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+
+def feature_variants(config):
+    """
+    The feature configurations of a run: config['Xy'], followed by one configuration per entry of
+    the optional config['Xy_variants'], each overriding some of the keys of config['Xy']
+    (e.g., [{'features': {...}}, {'lagged': {}}]).
+    """
+    variants = [config['Xy']]
+    for override in config.get('Xy_variants') or []:
+        variant = copy.deepcopy(config['Xy'])
+        variant.update(override)
+        variants.append(variant)
+    return(variants)
+
+
+def feature_tables(key):
+    return(dict([(name, '%s_%s' %(table, key[:KEY_LENGTH])) for name, table in MODELING_TABLES.items()]))
+
+
+class FeatureStore(object):
+    """
+    The materialization of one feature configuration (config['Xy']).
+    """
+
+    def __init__(self, db, config):
+        self.db = db
+        self.config = config
+        self.key = config_fingerprint(config['Xy'])
+        self.tables = feature_tables(self.key)
+
+    def lineage(self):
+        """
+        The lineage row of this configuration (a dict), or None if it was never materialized.
+        """
+        con = self.db['connection']
+        if not con.dialect.has_table(con, LINEAGE_TABLE, schema='modeling'):
+            return(None)
+        lineage = pd.read_sql('select * from modeling.%s' %(LINEAGE_TABLE), con)
+        lineage = lineage[lineage['feature_key'] == self.key]
+        if len(lineage) == 0:
+            return(None)
+        return(lineage.iloc[-1].to_dict())
+
+    def is_current(self, watermark):
+        """
+        Were the tables of this configuration built from the source as it is now?
+        """
+        lineage = self.lineage()
+        return((lineage is not None) and
+               (int(lineage['source_n_rows']) == watermark['n_rows']) and
+               (lineage['source_max_date'] == watermark['max_date']))
+
+    def needs_build(self, force=False):
+        self.watermark = source_watermark(self.db, self.config['cols']['date'])
+        return(force or not self.is_current(self.watermark))
+
+    def use(self):
+        """
+        Point the readers and writers (db['tables']) to the tables of this configuration.
+        """
+        self.db['tables'] = self.tables
+        return(self.tables)
+
+    def build(self):
+        """
+        Materialize the configuration and record its lineage.
+        """
+        self.use()
+        if not hasattr(self, 'watermark'):
+            self.watermark = source_watermark(self.db, self.config['cols']['date'])
+        log.info("Building the features %s" %(self.key))
+        x_features = grab_collections_data(self.db, self.config, log)[2]
+        self.record(len(x_features), self.watermark)
+        return(self.tables)
+
+    def record(self, n_rows, watermark):
+        con = self.db['connection']
+        row = pd.DataFrame([{'feature_key': self.key,
+                             'xy': json.dumps(self.config['Xy'], sort_keys=True, default=str),
+                             'dataset_table': self.tables['dataset'],
+                             'source_table': '%s.%s' %(self.db['database'], self.db['table']),
+                             'source_n_rows': watermark['n_rows'],
+                             'source_max_date': watermark['max_date'],
+                             'built_at': datetime.now().isoformat(),
+                             'n_rows': n_rows}])
+        if con.dialect.has_table(con, LINEAGE_TABLE, schema='modeling'):
+            con.execute("delete from modeling.%s where feature_key = '%s'" %(LINEAGE_TABLE, self.key))
+        write_frame(row, LINEAGE_TABLE, 'modeling', con, if_exists='append', index=False)
+
+    def materialize(self, force=False):
+        """
+        Reuse the tables of this configuration if they are current, build them otherwise.
+        Returns
+           BOOL		True if the tables were (re)built
+        """
+        if self.needs_build(force):
+            self.build()
+            return(True)
+        log.info("Reusing the features %s (built %s)" %(self.key, self.lineage()['built_at']))
+        self.use()
+        return(False)
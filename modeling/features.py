@@ -0,0 +1,89 @@
+"""
+Temporal (by day) features computed in memory on the loaded dataset.
+1. LAG/LEAD of a variable by a number of days
+2. ROLLING_MEAN/ROLLING_SUM of a variable over the preceding days
+
+All features are partitioned by toilet and use the calendar: the lag of 2 days is the value
+recorded two days earlier for the same toilet, or NaN if that day is missing.
+"""
+
+import numpy as np
+import pandas as pd
+
+FUNCTIONS = ['lag', 'lead', 'rolling_mean', 'rolling_sum']
+
+
+def day_keys(dataset, toiletname, date, pad=0):
+    """
+    One sortable integer per row: toilet code * span + day number, where each toilet gets its own
+    block of SPAN days (with PAD spare days at both ends so that shifted keys stay in the block).
+    """
+    codes = pd.factorize(dataset[toiletname])[0].astype(np.int64)
+    days = dataset[date].values.astype('datetime64[D]').astype(np.int64)
+    days = days - days.min() + pad
+    span = days.max() + pad + 1
+    return(codes * span + days)
+
+
+def add_daily_features(dataset, lagged, toiletname='ToiletID', date='Collection_Date'):
+    """
+    A function to generate by day variables for the features in LAGGED, in one pass over the data.
+
+    Args:
+       DF DATASET		Data frame with one row per toilet and day
+       DICT LAGGED		The variables to be lagged are keys, the function and the
+       			number of days are values, e.g.,
+       			{'Feces_kg_day':{'function':'lag', 'rows':[1,2]}}
+       			The function is one of 'lag', 'lead', 'rolling_mean', 'rolling_sum'
+       			(or a list of them). Rolling windows cover the ROWS days before the
+       			current day (the current day is not included).
+       STR TOILETNAME	The toilet identifier (the partition)
+       STR DATE		The date identifier
+    Returns:
+       DF DATASET		The dataset with a "<variable>_<function><rows>" column per feature
+       			(e.g., Feces_kg_day_lag1), NaN where the days are missing
+    """
+    if len(lagged) == 0 or len(dataset) == 0:
+        return(dataset)
+
+    pad = max([max(lagged[ll]['rows']) for ll in lagged])
+    keys = day_keys(dataset, toiletname, date, pad)
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    n = len(sorted_keys)
+
+    for ll in lagged:
+        functions = lagged[ll]['function']
+        if not isinstance(functions, list):
+            functions = [functions]
+        values = pd.to_numeric(dataset[ll], errors='coerce').values.astype(np.float64)[order]
+        observed = ~np.isnan(values)
+        # Cumulative sums for the rolling windows (with a leading zero)
+        cum_values = np.concatenate([[0.0], np.cumsum(np.where(observed, values, 0.0))])
+        cum_counts = np.concatenate([[0], np.cumsum(observed)])
+
+        for function in functions:
+            if function not in FUNCTIONS:
+                raise ValueError("Unsupported daily function {0}".format(function))
+            for rr in lagged[ll]['rows']:
+                if function in ['lag', 'lead']:
+                    target = sorted_keys - rr if function == 'lag' else sorted_keys + rr
+                    idx = np.searchsorted(sorted_keys, target, side='left')
+                    idx_valid = np.minimum(idx, n - 1)
+                    found = (idx < n) & (sorted_keys[idx_valid] == target)
+                    feature = np.where(found, values[idx_valid], np.nan)
+                else:
+                    # Window of the RR days before the current day
+                    lo = np.searchsorted(sorted_keys, sorted_keys - rr, side='left')
+                    hi = np.searchsorted(sorted_keys, sorted_keys - 1, side='right')
+                    total = cum_values[hi] - cum_values[lo]
+                    count = cum_counts[hi] - cum_counts[lo]
+                    if function == 'rolling_sum':
+                        feature = np.where(count > 0, total, np.nan)
+                    else:
+                        feature = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+                # Back to the original row order
+                unsorted = np.empty(n)
+                unsorted[order] = feature
+                dataset['%s_%s%i' %(ll, function, rr)] = unsorted
+    return(dataset)
@@ -0,0 +1,111 @@
+"""
+Streaming ingestion of query results with compact dtypes.
+
+The query is read in bounded chunks and every chunk is shrunk as it arrives:
+1. floats (fill percentages, weights, weather statistics) to float32
+2. integers (flags, month, counts) to the smallest integer type that holds them
+3. strings (Area, Route_Name, FranchiseType, ...) to integer codes into a vocabulary shared by
+   all chunks, turned into one categorical column at the end
+
+So the peak memory is one raw chunk plus the compact result, rather than the whole raw table.
+"""
+
+import numpy as np
+import pandas as pd
+
+INT_TYPES = [np.int8, np.int16, np.int32, np.int64]
+
+
+def smallest_int(values):
+    """
+    The smallest signed integer type that holds VALUES.
+    """
+    if len(values) == 0:
+        return(np.int8)
+    lo, hi = values.min(), values.max()
+    for int_type in INT_TYPES:
+        info = np.iinfo(int_type)
+        if lo >= info.min and hi <= info.max:
+            return(int_type)
+    return(np.int64)
+
+
+def encode_strings(values, vocabulary):
+    """
+    Integer codes of VALUES in VOCABULARY (a list, extended in place with the new values),
+    -1 for missing values.
+    """
+    local_codes, uniques = pd.factorize(values)
+    index = dict([(vv, ii) for ii, vv in enumerate(vocabulary)])
+    lookup = np.empty(len(uniques) + 1, dtype=np.int32)
+    lookup[-1] = -1
+    for i_unique, value in enumerate(uniques):
+        if value not in index:
+            index[value] = len(vocabulary)
+            vocabulary.append(value)
+        lookup[i_unique] = index[value]
+    return(lookup[local_codes])
+
+
+def compact_chunk(chunk, vocabularies, keep=[]):
+    """
+    Shrink the dtypes of CHUNK in place. String columns are replaced by their int32 codes
+    (VOCABULARIES holds one list of values per string column). Columns in KEEP are left as they are.
+    """
+    for col in chunk.columns:
+        if col in keep:
+            continue
+        dtype = chunk[col].dtype
+        if dtype == object:
+            vocabulary = vocabularies.setdefault(col, [])
+            chunk[col] = encode_strings(chunk[col].values, vocabulary)
+        elif col in vocabularies:
+            # A column that was all missing in an earlier chunk is a string column after all
+            chunk[col] = encode_strings(chunk[col].astype(object).values, vocabularies[col])
+        elif dtype.kind == 'f':
+            chunk[col] = chunk[col].astype(np.float32)
+        elif dtype.kind in 'iu':
+            chunk[col] = chunk[col].astype(smallest_int(chunk[col].values))
+    return(chunk)
+
+
+def read_compact(statement, con, chunksize=None, parse_dates=None, keep=[]):
+    """
+    Read the result of STATEMENT as a data frame with compact dtypes.
+    Args
+       STR STATEMENT	The SQL query
+       CON		A SQLAlchemy engine or connection
+       INT CHUNKSIZE	Rows per chunk (None reads the result at once and compacts it afterwards)
+       LIST PARSE_DATES	Date columns, as in pd.read_sql
+       LIST KEEP		Columns whose dtypes are not changed
+    Returns
+       DF		String columns as categoricals (the categories sorted, whatever the order of the
+       		rows), floats as float32, integers as the smallest type
+    """
+    chunks = pd.read_sql(statement, con=con, coerce_float=True, params=None,
+                         parse_dates=parse_dates, chunksize=chunksize)
+    if chunksize is None:
+        chunks = [chunks]
+    vocabularies = {}
+    compact = []
+    for chunk in chunks:
+        compact.append(compact_chunk(chunk, vocabularies, keep))
+        del chunk
+    if len(compact) == 1:
+        dataset = compact[0]
+    else:
+        dataset = pd.concat(compact, ignore_index=True, copy=False)
+    del compact
+    for col, vocabulary in vocabularies.items():
+        codes = dataset[col].values
+        if codes.dtype.kind == 'f':
+            # Missing in a whole chunk and upcast by concat
+            codes = np.where(np.isnan(codes), -1, codes)
+        codes = codes.astype(np.int32)
+        # The codes are in the order the values were seen: rank them by value, as an object column sorts them
+        order = sorted(range(len(vocabulary)), key=vocabulary.__getitem__)
+        rank = np.empty(len(vocabulary) + 1, dtype=np.int32)
+        rank[order] = np.arange(len(vocabulary))
+        rank[-1] = -1
+        dataset[col] = pd.Categorical.from_codes(rank[codes], [vocabulary[ii] for ii in order])
+    return(dataset)
@@ -0,0 +1,115 @@
+"""
+An in-memory index of intervals, e.g., the days each toilet is active or is on a route, for the
+"which toilets on day d (or within [a, b])" queries of the folds, the density features and the staffing.
+1. The intervals are closed, [start, end], over integer points (e.g., days, see day_points). The runs
+   of consecutive points of a table (one row per toilet and day) are one interval each (from_runs)
+2. A centered interval tree: every node keeps the intervals that contain its center, sorted by start
+   and by end, so its matches are one slice found by a binary search. A query visits O(log n) nodes,
+   and returns the k intervals found in O(log n + k) slices
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def day_points(dates):
+    """
+    Days since the epoch (int64) of a date column or list of dates, the points of day intervals.
+    """
+    return(pd.to_datetime(dates).values.astype('datetime64[D]').astype(np.int64))
+
+
+class IntervalIndex(object):
+    """
+    The closed intervals [STARTS, ENDS] of KEYS (a key may have several intervals).
+    """
+
+    def __init__(self, keys, starts, ends):
+        self.keys = np.asarray(keys)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        # The nodes of the tree: (center, ids by start, sorted starts, ids by end, sorted -ends, left, right)
+        self.nodes = []
+        self.root = self.build(np.arange(len(self.starts)))
+
+    @classmethod
+    def from_runs(cls, keys, points):
+        """
+        One interval per run of consecutive POINTS of each key, e.g., the days a toilet has data.
+        Missing keys are dropped.
+        """
+        codes, uniques = pd.factorize(np.asarray(keys))
+        points = np.asarray(points, dtype=np.int64)[codes >= 0]
+        codes = codes[codes >= 0]
+        order = np.lexsort((points, codes))
+        codes, points = codes[order], points[order]
+        first = np.ones(len(points), dtype=bool)
+        first[1:] = (codes[1:] != codes[:-1]) | (points[1:] > points[:-1] + 1)
+        first = np.flatnonzero(first)
+        last = np.append(first[1:], len(points)) - 1
+        return(cls(np.asarray(uniques)[codes[first]], points[first], points[last]))
+
+    @classmethod
+    def by_group(cls, keys, points, groups):
+        """
+        The runs of each group, e.g., the route memberships of the toilets over time, as {group: IntervalIndex}.
+        """
+        keys, points, groups = np.asarray(keys), np.asarray(points), np.asarray(groups)
+        codes, uniques = pd.factorize(groups)
+        return(dict([(group, cls.from_runs(keys[codes == ii], points[codes == ii])) for ii, group in enumerate(uniques)]))
+
+    def build(self, ids):
+        if len(ids) == 0:
+            return(-1)
+        starts, ends = self.starts[ids], self.ends[ids]
+        # The median of the end points: at most half of the intervals lie on either side
+        center = np.median(np.concatenate([starts, ends]))
+        here = ids[(starts <= center) & (ends >= center)]
+        by_start = here[np.argsort(self.starts[here], kind='mergesort')]
+        by_end = here[np.argsort(-self.ends[here], kind='mergesort')]
+        node = len(self.nodes)
+        self.nodes.append([center, by_start, self.starts[by_start], by_end, -self.ends[by_end], -1, -1])
+        self.nodes[node][5] = self.build(ids[ends < center])
+        self.nodes[node][6] = self.build(ids[starts > center])
+        return(node)
+
+    def positions(self, start, end=None):
+        """
+        Positions of the intervals that overlap [START, END] (the point START if END is None).
+        """
+        end = start if end is None else end
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node < 0:
+                continue
+            center, by_start, starts, by_end, negative_ends, left, right = self.nodes[node]
+            if start <= center <= end:
+                found.append(by_start)
+            elif end < center:
+                # They all end after END: the ones that start before it
+                found.append(by_start[:np.searchsorted(starts, end, side='right')])
+            else:
+                found.append(by_end[:np.searchsorted(negative_ends, -start, side='right')])
+            if start < center:
+                stack.append(left)
+            if end > center:
+                stack.append(right)
+        return(np.sort(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64))
+
+    def overlapping(self, start, end=None):
+        """
+        The keys with an interval that overlaps [START, END] (or contains the point START), sorted.
+        """
+        return(np.unique(self.keys[self.positions(start, end)]))
+
+    def covering(self, start, end):
+        """
+        The keys with an interval that contains the whole [START, END], sorted.
+        """
+        positions = self.positions(start)
+        return(np.unique(self.keys[positions[self.ends[positions] >= end]]))
+
+    def __len__(self):
+        return(len(self.starts))
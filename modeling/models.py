@@ -15,8 +15,10 @@ from sklearn.feature_selection import SelectKBest
 import statsmodels
 from datetime import  timedelta
 
-from sanergy.modeling.dataset import grab_from_features_and_labels, format_features_labels
+from sanergy.modeling.dataset import grab_from_features_and_labels, format_features_labels, FoldSlicer
 from sanergy.modeling.Staffing import Staffing
+from sanergy.modeling.writer import write_frame, FrameBuffer
+from sanergy.modeling.encoding import SPARSE_MODELS
 
 log = logging.getLogger(__name__)
 
@@ -32,9 +34,10 @@ class FullModel(object):
     """
 
     def __init__(self, config, modeltype_waste, modeltype_schedule="simple", parameters_waste=None, parameters_schedule=None,
-    toilet_routes=None):
+    toilet_routes=None, encoder=None):
         """
         Args:
+          encoder (CategoricalEncoder): One-hot encodes the categorical features (sparse_categoricals), or None
         """
         self.parameters_waste=parameters_waste
         self.parameters_schedule=parameters_schedule
@@ -42,6 +45,7 @@ class FullModel(object):
         self.modeltype_schedule=modeltype_schedule
         self.toilet_routes = toilet_routes
         self.config = config
+        self.encoder = encoder
 
 
     def run(self, train_x, train_yf, train_yu, test_x, waste_past = None, remaining_threshold=50.0):
@@ -59,8 +63,8 @@ class FullModel(object):
             waste_matrix_feces = waste_matrix_urine = roster = waste_vector_urine = waste_vector_feces = importances = None
             
         else:
-            self.feces_model = WasteModel(self.modeltype_waste, self.parameters_waste, self.config, train_x, train_yf, waste_type = 'feces') #Includes gen_model?
-            self.urine_model = WasteModel(self.modeltype_waste, self.parameters_waste, self.config, train_x, train_yu, waste_type = 'urine') #Includes gen_model?
+            self.feces_model = WasteModel(self.modeltype_waste, self.parameters_waste, self.config, train_x, train_yf, waste_type = 'feces', encoder=self.encoder) #Includes gen_model?
+            self.urine_model = WasteModel(self.modeltype_waste, self.parameters_waste, self.config, train_x, train_yu, waste_type = 'urine', encoder=self.encoder) #Includes gen_model?
             waste_matrix_feces, waste_vector_feces, yf = self.feces_model.predict(test_x)
             waste_matrix_urine, waste_vector_urine, yu = self.urine_model.predict(test_x)
             self.schedule_model = ScheduleModel(self.config, self.modeltype_schedule, self.parameters_schedule, train_yf, train_yu, train_x, train_yf, train_yu) #For simpler models, can ignore train_x and train_y?
@@ -113,11 +117,12 @@ class WasteModel(object):
       test_x: testing features
       model (str): model type
       parameters: hyperparameters for model
+      encoder: CategoricalEncoder for the categorical features, or None if they are already dummies
     Returns:
       result_y: predictions on test set
       modelobj: trained model object
     """
-    def __init__(self, modeltype, parameters, config, train_x = None, train_y = None, waste_type='feces'):
+    def __init__(self, modeltype, parameters, config, train_x = None, train_y = None, waste_type='feces', encoder=None):
         """
 
         Args:
@@ -126,6 +131,7 @@ class WasteModel(object):
         self.parameters = parameters
         self.modeltype = modeltype
         self.config = config
+        self.encoder = encoder
 	self.timestamp = datetime.datetime.now().isoformat()
         if (train_x is not None) and (train_y is not None):
             self.gen_model(train_x, train_y)
@@ -153,7 +159,7 @@ class WasteModel(object):
         for d in future_days:
             #update the results table
             ftr_pred = (features.loc[features[self.config['cols']['date']]==d]).drop([self.config['cols']['toiletname'], self.config['cols']['date']], axis=1)
-            result_onedayahead = list(self.trained_model.predict( ftr_pred))
+            result_onedayahead = list(self.trained_model.predict( self.design_matrix(ftr_pred)[0] ))
             result_y = result_y + result_onedayahead
             #update the features table
             d_next = d + datetime.timedelta(days=1)
@@ -213,13 +219,24 @@ class WasteModel(object):
         #For features, assume they have already been subsetted, use everything except toilet_id, day...
         features = train_x.drop([self.config['cols']['toiletname'], self.config['cols']['date']], axis=1)
 
+        features, self.feature_names = self.design_matrix(features)
+
         #fit the model..
 	self.time_started = datetime.datetime.now().isoformat()
-        self.feature_names = features.columns
         self.trained_model.fit(features, labels)
 	self.time_ended = datetime.datetime.now().isoformat()
         return self.trained_model
 
+    def design_matrix(self, features):
+        """
+        The matrix the model is fitted on / predicts from, and the names of its columns.
+        With an encoder, the categorical features are one-hot encoded into a sparse matrix,
+        which is passed as such to the models that accept it (SPARSE_MODELS) and densified for the others.
+        """
+        if self.encoder is None:
+            return(features, features.columns)
+        return(self.encoder.transform(features, dense=self.modeltype not in SPARSE_MODELS))
+
     def define_model(self):
         #if self.modeltype == "AR" :
         #    return statsmodels.tsa.ar_model.AR(max_order=self.parameters['max_order'])
@@ -405,26 +422,46 @@ class ScheduleModel(object):
         return collection_schedule, collection_vector
 
 
-def run_models_on_folds(folds, loss_function, db, experiment):
+def run_models_on_folds(folds, loss_function, db, experiment, slicer=None, buffer=None, done=frozenset(), fold_ids=None):
+    """
+    The output rows of a fold are tagged with model_id (experiment.fingerprint(), the same for all the folds)
+    and fold_id (the position of the fold in FOLDS).
+    Args:
+      slicer (FoldSlicer): The dataset loaded once for all the folds (and experiments). Loaded here if not given.
+      buffer (FrameBuffer): Collects the output rows (model, evaluations, predictions, experiments) for the caller
+        to write (e.g., the writer of a parallel sweep). If not given, they are written to db after every fold.
+      done (set): The (model_id, fold_id) pairs whose results are already written; they are skipped.
+      fold_ids (list): The positions of the folds to run (all if not given).
+    """
+    flush = buffer is None
+    if flush:
+        buffer = FrameBuffer()
     results = pd.DataFrame({'model id':[], 'model':[], 'fold':[], 'metric':[], 'parameter':[], 'value':[]})#Index by experiment hash
     log = logging.getLogger("Sanergy Collection Optimizer")
     log.debug("Running model {0}".format(experiment.model))
-    for i_fold, fold in enumerate(folds):
+    if slicer is None:
+        slicer = FoldSlicer.from_db(db, experiment.config, folds)
+    model_id = experiment.fingerprint()
+    for i_fold in (range(len(folds)) if fold_ids is None else fold_ids):
+        fold = folds[i_fold]
         #log.debug("Fold {0}: {1}".format(i_fold, fold))
-        features_train, labels_train_f, labels_train_u, features_test, labels_test_f, labels_test_u,  toilet_routes = grab_from_features_and_labels(db, fold, experiment.config)
+        if (model_id, i_fold) in done:
+            log.debug("Fold {0} of model {1} is already done".format(i_fold, experiment.model))
+            continue
+        features_train, labels_train_f, labels_train_u, features_test, labels_test_f, labels_test_u,  toilet_routes = slicer.split(fold)
 
 
         # 5. Run the models
         #pdb.set_trace()
-        model = FullModel(experiment.config, experiment.model, parameters_waste = experiment.parameters, parameters_schedule=experiment.config['parameters']['StaticModel']['parameters'], toilet_routes = toilet_routes)
+        model = FullModel(experiment.config, experiment.model, parameters_waste = experiment.parameters, parameters_schedule=experiment.config['parameters']['StaticModel']['parameters'], toilet_routes = toilet_routes, encoder = slicer.encoder)
         cm, wmf, wmu, roster, cv, wvf, wvu, fi = model.run(features_train, labels_train_f, labels_train_u, features_test) #Not interested in the collection schedule, will recompute with different parameters.
         #L2 evaluation of the waste prediction
         roster.to_csv("%s\workforce_schedule.csv" %(experiment.config['pickle_store']))
 
         loss_f = loss_function.evaluate_waste(labels_test_f, wvf)
         loss_u = loss_function.evaluate_waste(labels_test_u, wvu)
-        generate_result_row(db, experiment, model.feces_model, i_fold, 'MSE_feces', loss_f)
-        generate_result_row(db, experiment, model.urine_model, i_fold, 'MSE_urine', loss_u)
+        generate_result_row(buffer, experiment, model.feces_model, i_fold, 'MSE_feces', loss_f, model_id = model_id)
+        generate_result_row(buffer, experiment, model.urine_model, i_fold, 'MSE_urine', loss_u, model_id = model_id)
         remainder_range = list(reversed(experiment.config['setup']['collection_remainder_threshold']))
         if len(remainder_range) == 0:
             remainder_range = range(0, 100, 1)
@@ -445,20 +482,20 @@ def run_models_on_folds(folds, loss_function, db, experiment):
            print(p_overflow)
            print(p_overflow_conservative)
            #print("--------")
-           generate_result_row(db, experiment, model.feces_model, i_fold, 'p_collect', p_collect, parameter = float(safety_remainder))
-           generate_result_row(db, experiment, model.feces_model, i_fold, 'p_overflow', p_overflow, parameter = float(safety_remainder))
-           generate_result_row(db, experiment, model.feces_model, i_fold, 'p_overflow_conservative', p_overflow_conservative, parameter = float(safety_remainder))
-           generate_result_row(db, experiment, model.feces_model, i_fold, 'p_overflow_feces', p_overflow_f, parameter = float(safety_remainder))
-           generate_result_row(db, experiment, model.urine_model, i_fold, 'p_overflow_urine', p_overflow_u, parameter = float(safety_remainder))
-           generate_result_row(db, experiment, model.urine_model, i_fold, 'p_overflow_urine_conservative', p_overflow_u_conservative, parameter = float(safety_remainder))
-           generate_result_row(db, experiment, model.feces_model, i_fold, 'p_overflow_feces_conservative', p_overflow_f_conservative, parameter = float(safety_remainder))
+           generate_result_row(buffer, experiment, model.feces_model, i_fold, 'p_collect', p_collect, parameter = float(safety_remainder), model_id = model_id)
+           generate_result_row(buffer, experiment, model.feces_model, i_fold, 'p_overflow', p_overflow, parameter = float(safety_remainder), model_id = model_id)
+           generate_result_row(buffer, experiment, model.feces_model, i_fold, 'p_overflow_conservative', p_overflow_conservative, parameter = float(safety_remainder), model_id = model_id)
+           generate_result_row(buffer, experiment, model.feces_model, i_fold, 'p_overflow_feces', p_overflow_f, parameter = float(safety_remainder), model_id = model_id)
+           generate_result_row(buffer, experiment, model.urine_model, i_fold, 'p_overflow_urine', p_overflow_u, parameter = float(safety_remainder), model_id = model_id)
+           generate_result_row(buffer, experiment, model.urine_model, i_fold, 'p_overflow_urine_conservative', p_overflow_u_conservative, parameter = float(safety_remainder), model_id = model_id)
+           generate_result_row(buffer, experiment, model.feces_model, i_fold, 'p_overflow_feces_conservative', p_overflow_f_conservative, parameter = float(safety_remainder), model_id = model_id)
 
            exp_results = pd.DataFrame(model.schedule_model.collection_vector)
-	   exp_results["model_id"] = hash(experiment)
+	   exp_results["model_id"] = model_id
            exp_results["waste_type"]="Combined"
 	   exp_results["fold_id"]=i_fold
 	   exp_results["comment"]="Lauren will reach inbox 0!"  
-           exp_results.to_sql(con=db['connection'], name="predictions", schema="output", if_exists="append", index=False)
+           buffer.append(exp_results, "predictions", "output", index=False)
 
            #results_fold = results_fold.append([res_collect,res_overflow,res_overflow_conservative, res_overflow_f, res_overflow_f_conservative, res_overflow_u, res_overflow_u_conservative], ignore_index=True)
 
@@ -468,18 +505,23 @@ def run_models_on_folds(folds, loss_function, db, experiment):
         """
         #print(results_fold)
         #write_evaluation_into_db(results_fold, db)
-        write_experiment_into_db(experiment, model, db)
+        write_experiment_into_db(experiment, model, buffer, model_id = model_id, fold_id = i_fold)
+        if flush:
+            # One transaction per fold: a crash only loses the fold it happens in
+            buffer.flush(db['connection'])
         #results = results.append(results_fold,ignore_index=True)
 
 	#write_evaluation_into_db(results, append = False)
     return(results)
 
-def generate_result_row(db, experiment, model, fold, metric, value, parameter=np.nan):
+def generate_result_row(buffer, experiment, model, fold, metric, value, parameter=np.nan, model_id=None):
     """
-    Just a wrapper
+    Just a wrapper: adds the rows of a result to output.model and output.evaluations (to BUFFER, a FrameBuffer)
+    MODEL_ID is the fingerprint of the experiment (experiment.fingerprint())
     """
+    model_id = experiment.fingerprint() if model_id is None else model_id
     timestamp = datetime.datetime.now().isoformat()
-    exp_results = [{"model_id": hash(experiment),
+    exp_results = [{"model_id": model_id,
 			"algorithm": experiment.model,
 			"hyperparameters": experiment.to_json(),
 			"features": "|".join(model.feature_names.tolist()),
@@ -488,15 +530,15 @@ def generate_result_row(db, experiment, model, fold, metric, value, parameter=np
 			"batch_id": None,
 			"fold_id": fold,
 			"comment": "Joe was right."}]  
-    pd.DataFrame(exp_results).to_sql(con=db['connection'], name="model", schema="output", if_exists="append", index=False)
+    buffer.append(pd.DataFrame(exp_results), "model", "output", index=False)
     
-    exp_results = [{"model_id": hash(experiment),
+    exp_results = [{"model_id": model_id,
 			"metric": metric,
 			"parameter": parameter,
 			"fold_id": fold,
 			"parameter_value": "Joe was right.",
 			"value":value}]  
-    pd.DataFrame(exp_results).to_sql(con=db['connection'], name="evaluations", schema="output", if_exists="append", index=False)
+    buffer.append(pd.DataFrame(exp_results), "evaluations", "output", index=False)
 
     #result_row = pd.DataFrame({'model id':[hash(experiment)], 'model':[experiment.model], 'fold':[fold], 'metric':[metric], 'parameter':[parameter], 'value':[value]})#, index = [hash( (experiment.model, fold, metric,parameter) )] )
     #result_row = pd.DataFrame({'id':[hash(experiment)],'model':[experiment.model], 'model_parameters':[experiment.to_json()], 'fold':[fold], 'metric':[metric], 'parameter':[parameter], 'value':[value]})#, index = [hash( (experiment.model, fold, metric,parameter) )] )
@@ -505,15 +547,15 @@ def generate_result_row(db, experiment, model, fold, metric, value, parameter=np
 def write_evaluation_into_db(results, db , append = True, chunksize=1000):
     #if ~append :
     #    db['connection'].execute('DROP TABLE IF EXISTS output."evaluations"')
-    results.to_sql(name='evaluations',
-    schema="output",
-    con=db['connection'],
-    chunksize=chunksize,
-    if_exists='append')
+    write_frame(results, 'evaluations', 'output', db['connection'], if_exists='append', chunksize=chunksize)
 
     return None
 
-def write_experiment_into_db(experiment, model, db , append = True, chunksize=1000):
+def write_experiment_into_db(experiment, model, buffer, append = True, model_id=None, fold_id=None):
+    """
+    Pickle the models, and add the row of the experiment on fold FOLD_ID to output.experiments (to BUFFER, a FrameBuffer)
+    """
+    model_id = experiment.fingerprint() if model_id is None else model_id
     timestamp =  model.feces_model.time_started
 
     #save model to pickle object
@@ -531,14 +573,10 @@ def write_experiment_into_db(experiment, model, db , append = True, chunksize=10
     #pickle.dump(model.staffing_model, save_model_file)
     #save_model_file.close()
 
-    exp_row = pd.DataFrame({'timestamp':[timestamp], 'id':[hash(experiment)] ,'model':[experiment.model], 'model_parameters':[experiment.to_json()], 'model_config':[json.dumps(experiment.config)],
+    exp_row = pd.DataFrame({'timestamp':[timestamp], 'id':[model_id], 'fold_id':[fold_id], 'model':[experiment.model], 'model_parameters':[experiment.to_json()], 'model_config':[json.dumps(experiment.config)],
     'feature_importances':[json.dumps(model.get_feature_importances()[0].tolist())],'feature_names':[json.dumps(model.get_feature_importances()[1].tolist())] })
 
-    exp_row.to_sql(name='experiments',
-    schema="output",
-    con=db['connection'],
-    chunksize=chunksize,
-    if_exists='append')
+    buffer.append(exp_row, 'experiments', 'output')
 
     return None
 
@@ -574,25 +612,12 @@ def run_best_model_on_all_data(experiment, db, folds):
 
 
     # Write the results to postgres
-    db['connection'].execute('DROP TABLE IF EXISTS output."predicted_filled"')
-    pd.DataFrame(yhat).to_sql(name='predicted_filled',
-    schema="output",
-    con=db['connection'],
-    chunksize=1000)
-
-    db['connection'].execute('DROP TABLE IF EXISTS output."collection_schedule"')
-    pd.DataFrame(output_schedule).to_sql(name='collection_schedule',
-    schema="output",
-    con=db['connection'],
-    chunksize=1000)
+    write_frame(pd.DataFrame(yhat), 'predicted_filled', 'output', db['connection'], if_exists='replace')
+    write_frame(pd.DataFrame(output_schedule), 'collection_schedule', 'output', db['connection'], if_exists='replace')
 
     #If we created the output roster, save it into the db too
     if output_roster:
-        db['connection'].execute('DROP TABLE IF EXISTS output."workforce_schedule"')
-        pd.DataFrame(output_roster).to_sql(name='workforce_schedule',
-        schema="output",
-        con=db['connection'],
-        chunksize=1000)
+        write_frame(pd.DataFrame(output_roster), 'workforce_schedule', 'output', db['connection'], if_exists='replace')
 
 
     return(best_model)
@@ -0,0 +1,134 @@
+"""
+Run the experiments of a sweep on a pool of worker processes (setup: workers in the yaml).
+1. The folds, the dataset (FoldSlicer) and the experiments are set up once in the parent and inherited
+   by the forked workers: a task is only the position of an experiment
+2. Every worker opens its own engine and connection (get_engine is per process) and logs to its own
+   file, <log file>.<pid>
+3. A task is one fold of one experiment. The workers return its output rows (a FrameBuffer) instead
+   of writing them: the parent is the single writer, and writes every fold in its own transaction
+4. A fold that fails is logged with its traceback and reported at the end, the sweep goes on
+5. Resume: the (experiment, fold) pairs whose results are already in output.experiments (by model_id,
+   the stable experiment.fingerprint(), and fold_id) are skipped, so an interrupted sweep picks up where it stopped
+"""
+
+import os
+import logging
+import itertools
+import traceback
+from multiprocessing import Pool
+
+from sqlalchemy import inspect
+
+from sanergy.modeling.LossFunction import LossFunction
+from sanergy.modeling.models import run_models_on_folds
+from sanergy.modeling.connection import get_engine, connect
+from sanergy.modeling.writer import FrameBuffer
+
+DONE_TABLE = 'experiments' # Written for every fold in the transaction of the rows of the other output tables
+
+LOG_FORMAT = "%(asctime)s %(processName)s %(message)s"
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+# The sweep the workers inherit (set in the parent before the pool is forked)
+_sweep = {}
+
+
+def persisted_folds(con, schema='output', table=DONE_TABLE):
+    """
+    The (model_id, fold_id) pairs whose results are written (none if the table predates fold_id).
+    """
+    if not con.dialect.has_table(con, table, schema=schema):
+        return(set())
+    if 'fold_id' not in [column['name'] for column in inspect(con).get_columns(table, schema=schema)]:
+        return(set())
+    return(set([(int(row[0]), int(row[1])) for row in con.execute('select distinct id, fold_id from %s.%s' %(schema, table))
+                if row[0] is not None and row[1] is not None]))
+
+
+def init_worker(config_db, log_file):
+    """
+    Set up a worker process: its own log file and database connection.
+    """
+    root = logging.getLogger()
+    for logger in [root, log]:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+    handler = logging.FileHandler('%s.%i' %(log_file, os.getpid()))
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root.addHandler(handler)
+    # The engine of the parent is not shared: get_engine creates one for this process
+    db = dict(_sweep['db'])
+    db['engine'] = get_engine(config_db)
+    db['connection'] = connect(db['engine'])
+    _sweep['db'] = db
+    log.info("Worker %i started" %(os.getpid()))
+
+
+def run_experiment(task):
+    """
+    Run the experiment of the sweep on one fold.
+    Args
+       TUPLE TASK	(position of the experiment, position of the fold)
+    Returns
+       TUPLE, FRAMEBUFFER, STR	TASK, its output rows (None if it failed) and the traceback (None if it did not)
+    """
+    i_exp, i_fold = task
+    experiment = _sweep['experiments'][i_exp]
+    log.debug("Running experiment #{0} on fold {1}".format(i_exp, i_fold))
+    buffer = FrameBuffer()
+    try:
+        run_models_on_folds(_sweep['folds'], LossFunction(experiment.config), _sweep['db'], experiment, _sweep['slicer'], buffer,
+                            fold_ids=[i_fold])
+    except Exception:
+        log.exception("Experiment #{0} ({1}) failed on fold {2}".format(i_exp, experiment.model, i_fold))
+        return(task, None, traceback.format_exc())
+    return(task, buffer, None)
+
+
+def run_experiments(experiments, folds, db, slicer, config_db, workers=1, log_file='default.log', resume=True):
+    """
+    Run EXPERIMENTS on WORKERS processes (in this process if 1) and write their output rows to db.
+    With RESUME, the folds of the experiments that are already written are skipped.
+    Every fold of every experiment is one task, written in one transaction when it is done.
+    Args
+       LIST EXPERIMENTS	As generated by generate_experiments
+       DICT DB		As returned by get_db; its connection is used by the writer only
+       FOLDSLICER SLICER	The dataset of the folds, loaded once
+       DICT CONFIG_DB	The 'db' section of the yaml, for the connections of the workers
+    Returns
+       LIST		((experiment position, fold position), traceback) of the failed folds
+    """
+    done = persisted_folds(db['connection']) if resume else set()
+    tasks = [(i_exp, i_fold) for i_exp, experiment in enumerate(experiments) for i_fold in range(len(folds))]
+    pending = [(i_exp, i_fold) for i_exp, i_fold in tasks if (experiments[i_exp].fingerprint(), i_fold) not in done]
+    if len(pending) < len(tasks):
+        log.info("Resuming: {0} of {1} folds are already done".format(len(tasks) - len(pending), len(tasks)))
+    _sweep.update({'experiments': experiments, 'folds': folds, 'db': db, 'slicer': slicer})
+    pool = None
+    if workers > 1 and len(pending) > 1:
+        pool = Pool(processes=min(workers, len(pending)), initializer=init_worker, initargs=(config_db, log_file))
+        results = pool.imap_unordered(run_experiment, pending)
+    else:
+        results = itertools.imap(run_experiment, pending)
+    failures = []
+    try:
+        for n_done, (task, buffer, error) in enumerate(results):
+            if error is not None:
+                failures.append((task, error))
+                log.error("Experiment #{0} failed on fold {1}:\n{2}".format(task[0], task[1], error))
+                continue
+            written = buffer.flush(db['connection'])
+            log.info("Experiment #{0} fold {1} done, {2} rows written ({3}/{4})".format(task[0], task[1], written, n_done + 1, len(pending)))
+    except Exception:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _sweep.clear()
+    if failures:
+        log.warning("{0} of {1} folds failed: {2}".format(len(failures), len(pending), sorted([task for task, _ in failures])))
+    return(failures)
@@ -0,0 +1,162 @@
+"""
+A bulk writer for the pipeline tables (modeling.*, output.*, premodeling.*).
+
+Data frames are streamed to postgres with COPY ... FROM STDIN (CSV), one bounded chunk at a time,
+instead of the row-by-row INSERTs issued by DataFrame.to_sql. Replacing a table writes a new copy
+next to it and swaps it in within one transaction, so readers never see a missing or half-written table;
+its index is created after the swap, under the name of the live table.
+Rows for several tables can be buffered (FrameBuffer) and written in one go.
+"""
+
+import logging
+
+import pandas as pd
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from sqlalchemy import MetaData, Table, Column, Index
+from sqlalchemy.engine import Engine
+
+SWAP_SUFFIX = '__swap'
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+
+def quote(identifier):
+    return('"%s"' %(identifier))
+
+
+def copy_chunks(frame, cursor, table, index=True, chunksize=50000):
+    """
+    Stream FRAME into TABLE (schema-qualified, quoted) through COPY, CHUNKSIZE rows at a time.
+    """
+    for start in range(0, len(frame), chunksize):
+        chunk = frame.iloc[start:start + chunksize]
+        if index:
+            chunk = chunk.reset_index()
+        columns = ','.join([quote(col) for col in chunk.columns])
+        buf = StringIO()
+        chunk.to_csv(buf, header=False, index=False, na_rep='', encoding='utf-8')
+        buf.seek(0)
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' %(table, columns), buf)
+
+
+def write_frame(frame, name, schema, con, if_exists='append', index=True, chunksize=50000, swap=True):
+    """
+    Write a data frame to a table.
+    Args
+       DF FRAME		The data to write
+       STR NAME		Table name
+       STR SCHEMA		Schema name (e.g., 'modeling', 'output')
+       CON			A SQLAlchemy engine or connection
+       STR IF_EXISTS	'append' (create the table if needed) or 'replace'
+       BOOL INDEX		Write the index as a column (as DataFrame.to_sql does)
+       INT CHUNKSIZE	Rows per COPY chunk, bounds the memory used for the CSV buffer
+       BOOL SWAP		With 'replace', build the new table under a temporary name and swap it in
+       			atomically; otherwise drop the old table first
+    Returns
+       INT		Number of rows written
+    """
+    if con.dialect.name != 'postgresql':
+        # No COPY outside postgres, fall back to pandas. The index is written as a plain column:
+        # sqlite cannot create the (schema-qualified) index that to_sql would add on it.
+        if index:
+            frame = frame.reset_index()
+        frame.to_sql(name=name, schema=schema, con=con, if_exists=if_exists, index=False, chunksize=chunksize)
+        return(len(frame))
+
+    connection = con.connect() if isinstance(con, Engine) else con
+    try:
+        with connection.begin():
+            if if_exists == 'replace' and swap:
+                target = name + SWAP_SUFFIX
+                connection.execute('DROP TABLE IF EXISTS %s.%s' %(schema, quote(target)))
+            else:
+                target = name
+                if if_exists == 'replace':
+                    connection.execute('DROP TABLE IF EXISTS %s.%s' %(schema, quote(target)))
+            # Create the (empty) table with the pandas type mapping, then fill it through COPY
+            if target != name and index:
+                # The index pandas would add is named after the table: index the swapped-in table instead
+                empty = frame.head(0).reset_index()
+                index_columns = list(empty.columns[:frame.index.nlevels])
+                empty.to_sql(name=target, schema=schema, con=connection, if_exists='append', index=False)
+            else:
+                frame.head(0).to_sql(name=target, schema=schema, con=connection, if_exists='append', index=index)
+            cursor = connection.connection.cursor()
+            copy_chunks(frame, cursor, '%s.%s' %(schema, quote(target)), index=index, chunksize=chunksize)
+            if target != name:
+                connection.execute('DROP TABLE IF EXISTS %s.%s' %(schema, quote(name)))
+                connection.execute('ALTER TABLE %s.%s RENAME TO %s' %(schema, quote(target), quote(name)))
+                if index:
+                    index_table(connection, schema, name, index_columns)
+    finally:
+        if connection is not con:
+            connection.close()
+    log.debug("Wrote %i rows to %s.%s" %(len(frame), schema, name))
+    return(len(frame))
+
+
+def index_table(con, schema, table, columns):
+    """
+    Index each of COLUMNS of TABLE under the name to_sql gives it, ix_<schema>_<table>_<column>.
+    """
+    metadata = MetaData(schema=schema)
+    columns = [Column(col) for col in columns]
+    Table(table, metadata, *columns)
+    for col in columns:
+        Index('ix_%s_%s_%s' %(schema, table, col.name) if schema else 'ix_%s_%s' %(table, col.name), col).create(con)
+
+
+def create_index(con, schema, table, columns):
+    """
+    Index TABLE on COLUMNS (e.g., the date and toilet of modeling.dataset, for the fold queries)
+    and refresh the planner statistics. Call it after the table is (re)written.
+    """
+    name = 'ix_%s_%s' %(table, '_'.join([col.lower() for col in columns]))
+    cols = ','.join([quote(col) for col in columns])
+    if con.dialect.name == 'sqlite':
+        # sqlite qualifies the index (not the table) with the attached schema
+        con.execute('CREATE INDEX IF NOT EXISTS %s.%s ON %s (%s)' %(schema, quote(name), quote(table), cols))
+    else:
+        con.execute('CREATE INDEX %s ON %s.%s (%s)' %(quote(name), schema, quote(table), cols))
+        con.execute('ANALYZE %s.%s' %(schema, quote(table)))
+    log.debug("Indexed %s.%s on %s" %(schema, table, cols))
+
+
+class FrameBuffer(object):
+    """
+    Rows to append to several tables, written with one write_frame per table on flush, e.g., the
+    results of an experiment, handed from a worker process to the single writer (see parallel.py).
+    """
+
+    def __init__(self):
+        self.frames = {}
+
+    def append(self, frame, name, schema, index=True):
+        self.frames.setdefault((schema, name, index), []).append(frame)
+
+    def __len__(self):
+        return(sum([len(frame) for frames in self.frames.values() for frame in frames]))
+
+    def flush(self, con, chunksize=50000):
+        """
+        Append the buffered rows to their tables in one transaction, and empty the buffer.
+        Returns
+           INT		Number of rows written
+        """
+        written = 0
+        connection = con.connect() if isinstance(con, Engine) else con
+        try:
+            with connection.begin():
+                for (schema, name, index), frames in sorted(self.frames.items()):
+                    frame = pd.concat(frames, ignore_index=not index)
+                    written += write_frame(frame, name, schema, connection, if_exists='append', index=index, chunksize=chunksize)
+        finally:
+            if connection is not con:
+                connection.close()
+        self.frames = {}
+        return(written)
@@ -2,6 +2,12 @@ import yaml
 import itertools
 import json
 
+from sanergy.modeling.cache import config_fingerprint
+
+# The sections of the configuration that change the results of an experiment (with its model and parameters);
+# cv defines the folds, so a fold_id means the same fold for the same fingerprint
+FINGERPRINT_SECTIONS = ['Xy', 'cols', 'staffing', 'cv']
+
 class Experiment(object):
     """
     A class to encapsulate one experiment. An experiment should correspond as closely as possible to an actual use scenario by the project partner.
@@ -23,12 +29,31 @@ class Experiment(object):
         """
         Adding the hashing and equals functions, so that we can use the Experiment objects as dictionary keys.
         """
-        return hash((self.model, hash(frozenset(self.parameters.items())) ) )
+        return self.fingerprint()
+
+    def fingerprint(self):
+        """
+        A stable id of the experiment: a hash of the model, the parameters and the sections of the config
+        that change the results. Identical across runs (unlike hash()), so the results of a sweep can be
+        found again (see modeling/parallel.py). It is the model_id of all the folds of the experiment.
+        Returns an int of 60 bits (a valid hash()); output.experiments keeps it as an integer id, the
+        reporting tables as text in model_id VARCHAR(50) (see input/model_reporting_tables.sql).
+        """
+        content = {'model': self.model,
+                   'parameters': self.parameters,
+                   'config': dict([(section, self.config.get(section)) for section in FINGERPRINT_SECTIONS]),
+                   'schedule': self.config.get('parameters', {}).get('StaticModel'),
+                   'collection_remainder_threshold': self.config.get('setup', {}).get('collection_remainder_threshold')}
+        return int(config_fingerprint(content)[:15], 16)
 
     def __eq__(self, other):
-        models_are_the_same = (self.model == other.model)
-        items_are_the_same =  (len(set(self.parameters.items()) ^ set(other.parameters.items())) == 0) #Take the symmetric difference of the sets of two items and check that the symmetric difference is empty.
-        return (   models_are_the_same & items_are_the_same )
+        """
+        The same model, parameters and relevant config (see fingerprint), consistent with __hash__.
+        """
+        return self.fingerprint() == other.fingerprint()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def to_json(self):
         return json.dumps(self.parameters.items())
@@ -0,0 +1,99 @@
+"""
+Load premodeling.toiletdensity (one row per toilet, day and density feature) as a wide table, one
+column <functional>_<area>_<period>_<variable> per feature, as pd.pivot_table would.
+1. The features and the (toilet, day) rows are read first (select distinct), so the wide float32
+   array is allocated once
+2. The long table is streamed in chunks; every chunk is mapped to (row, column) positions with integer
+   codes of the four name columns and of the toilets, and accumulated into the array
+So the peak memory is one chunk plus the wide output, instead of the long table and its pivot copies.
+"""
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from sanergy.modeling.ingest import encode_strings
+from sanergy.premodeling.timeseries import day_numbers
+
+FEATURE_PARTS = ['functional', 'area', 'period', 'variable']
+
+
+def feature_name(functional, area, period, variable):
+    return('_'.join([functional, area, period.replace(' ', ''), variable]))
+
+
+def encode_known(values, vocabulary):
+    """
+    Codes of VALUES in VOCABULARY (left as it is), -1 for the missing and unknown values.
+    """
+    codes = encode_strings(values, list(vocabulary))
+    codes[codes >= len(vocabulary)] = -1
+    return(codes)
+
+
+def load_density(con, since=None, chunksize=200000, table='premodeling.toiletdensity',
+                 toiletname='ToiletID', date='Collection_Date', value='value'):
+    """
+    The density features per toilet and day.
+    Args
+       CON		A SQLAlchemy engine or connection
+       DATE SINCE	Only the days from this date on (all if None)
+       INT CHUNKSIZE	Rows of the long table per chunk
+    Returns
+       DF		TOILETNAME, DATE and one float32 column per feature (NaN if missing; the mean of
+       		duplicated rows), sorted by toilet and day
+    """
+    where = ' where "%s" >= :since' %(date) if since is not None else ''
+    params = {'since': since} if since is not None else {}
+    parts = ', '.join(FEATURE_PARTS)
+
+    # The columns: one per distinct feature name
+    levels = pd.read_sql(text('select distinct %s from %s%s' %(parts, table, where)), con, params=params)
+    vocabularies = [sorted(levels[part].dropna().unique()) for part in FEATURE_PARTS]
+    shape = [max(len(vocabulary), 1) for vocabulary in vocabularies]
+    levels = levels.dropna()
+    names = [feature_name(*row) for row in levels[FEATURE_PARTS].values]
+    columns = sorted(set(names))
+    position = dict([(name, ii) for ii, name in enumerate(columns)])
+    lookup = np.empty(int(np.prod(shape)), dtype=np.int32)
+    lookup.fill(-1)
+    level_codes = [encode_known(levels[part].values, vocabulary) for part, vocabulary in zip(FEATURE_PARTS, vocabularies)]
+    lookup[np.ravel_multi_index(level_codes, shape)] = [position[name] for name in names]
+
+    # The rows: one per distinct (toilet, day), sorted
+    keys = pd.read_sql(text('select distinct "%s", "%s" from %s%s' %(toiletname, date, table, where)), con,
+                       params=params, parse_dates=[date])
+    keys = keys.dropna()
+    toilets = sorted(keys[toiletname].unique())
+    toilet_codes = encode_known(keys[toiletname].values, toilets).astype(np.int64)
+    days = day_numbers(keys[date])
+    offset = days.min() if len(days) else 0
+    span = (days.max() - offset + 1) if len(days) else 1
+    row_keys = np.sort(toilet_codes * span + (days - offset))
+    del keys, toilet_codes, days
+
+    wide = np.zeros((len(row_keys), len(columns)), dtype=np.float32)
+    counts = np.zeros((len(row_keys), len(columns)), dtype=np.int32) # Any number of duplicated rows
+    statement = text('select "%s", "%s", %s, %s from %s%s' %(toiletname, date, parts, value, table, where))
+    for chunk in pd.read_sql(statement, con, params=params, parse_dates=[date], chunksize=chunksize):
+        codes = [encode_known(chunk[part].values, vocabulary) for part, vocabulary in zip(FEATURE_PARTS, vocabularies)]
+        chunk_toilets = encode_known(chunk[toiletname].values, toilets).astype(np.int64)
+        values = chunk[value].values.astype(np.float32)
+        valid = (chunk_toilets >= 0) & ~np.isnan(values) & pd.notnull(chunk[date]).values
+        for part_codes in codes:
+            valid &= part_codes >= 0
+        column = lookup[np.ravel_multi_index([part_codes[valid] for part_codes in codes], shape)]
+        key = chunk_toilets[valid] * span + (day_numbers(chunk[date].values[valid]) - offset)
+        row = np.minimum(np.searchsorted(row_keys, key), max(len(row_keys) - 1, 0))
+        found = (row_keys[row] == key) & (column >= 0) if len(row_keys) else np.zeros(len(key), dtype=bool)
+        np.add.at(wide, (row[found], column[found]), values[valid][found])
+        np.add.at(counts, (row[found], column[found]), 1)
+        del chunk
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.divide(wide, counts, out=wide) # 0/0: NaN where the feature is missing
+    del counts
+    density = pd.DataFrame(wide, columns=columns)
+    density.insert(0, date, (row_keys % span + offset).astype('datetime64[D]').astype('datetime64[ns]'))
+    density.insert(0, toiletname, np.asarray(toilets, dtype=object)[row_keys // span] if len(toilets) else [])
+    return(density)
@@ -0,0 +1,238 @@
+"""
+Ingest the KML files and shapefiles of input/Drakefile (the areas, the public facilities, the watsan
+layers and the boundaries) in one step, instead of one ogr2ogr or shp2pgsql | psql call per file.
+1. The features of every layer are streamed with OGR, as GeoJSON, in batches of BATCH_SIZE
+2. The coordinates of a batch are reprojected to EPSG:21037 (meters) in one vectorized call
+   (see neighbors.project_points)
+3. Every batch is bulk written (write_frame) to its table, the properties as columns and the geometry
+   as GeoJSON (a PostGIS geometry on postgres), and optionally to a <schema>.<table>.geojson file
+4. The source files are processed concurrently, each on its own thread and pooled connection
+"""
+
+import os
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas as pd
+
+from sanergy.modeling.connection import thread_connection, release_thread_connection
+from sanergy.modeling.writer import write_frame
+from sanergy.premodeling.neighbors import COORD_SYSTEM, COORD_WGS, project_points
+
+BATCH_SIZE = 5000 # features
+LOAD_THREADS = 4
+GEOMETRY = 'geometry'
+# (path under data/input/shapefiles, schema, table): the tables of a KML file are named after its
+# layers, as ogr2ogr did; the shapefiles all have one layer, named after the file
+SOURCES = [('SanergyFresh_Life_mapping_areas.kml', 'shapefiles', None),
+           ('kibera_public.kml', 'shapefiles_kibera', None),
+           ('mathare_public.kml', 'shapefiles_mathare', None),
+           ('mukuru_public.kml', 'shapefiles_mukuru', None),
+           ('Map_Kibera/Mathare-watsan-shapefile/watsan.shp', 'shapefiles', 'watsan_mathare'),
+           ('Map_Kibera/MKR-watsan-shapefile/watsan.shp', 'shapefiles', 'watsan_mukuru'),
+           ('Map_Kibera/Shapefiles/kibera_boundary-shapefile/Boundary.shp', 'shapefiles', 'boundary_kibera'),
+           ('Map_Kibera/Shapefiles/Mathare_boundary-shapefile/Boundary.shp', 'shapefiles', 'boundary_mathare'),
+           ('Map_Kibera/Shapefiles/Mukuru_boundary-shapefile/Boundary.shp', 'shapefiles', 'boundary_mukuru')]
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+
+def layer_epsg(layer):
+    """
+    The EPSG code of the coordinates of an OGR LAYER (WGS84 if it has none, e.g., KML).
+    """
+    reference = layer.GetSpatialRef()
+    if reference is None:
+        return(COORD_WGS)
+    reference.AutoIdentifyEPSG()
+    code = reference.GetAuthorityCode(None)
+    return(int(code) if code else COORD_WGS)
+
+
+def read_layers(path):
+    """
+    Stream the layers of a KML file or shapefile.
+    Returns
+       GENERATOR	(layer name, EPSG code, names of its fields, generator of its features as GeoJSON
+       		dicts); every layer has to be read before the next one
+    """
+    from osgeo import ogr
+    source = ogr.Open(path)
+    if source is None:
+        raise IOError("Cannot open %s" %(path))
+    for layer in source:
+        definition = layer.GetLayerDefn()
+        fields = [definition.GetFieldDefn(ii).GetName() for ii in range(definition.GetFieldCount())]
+        yield(layer.GetName(), layer_epsg(layer), fields, (json.loads(feature.ExportToJson()) for feature in layer))
+
+
+def batches(items, size=BATCH_SIZE):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield(batch)
+            batch = []
+    if batch:
+        yield(batch)
+
+
+def geometry_positions(geometry):
+    """
+    The positions ([x, y] or [x, y, z] lists) of a GeoJSON GEOMETRY, to be updated in place.
+    """
+    if geometry is None:
+        return([])
+    if geometry['type'] == 'GeometryCollection':
+        return([position for part in geometry['geometries'] for position in geometry_positions(part)])
+    positions = []
+    stack = [geometry['coordinates']]
+    while stack:
+        coordinates = stack.pop()
+        if len(coordinates) and isinstance(coordinates[0], (int, long, float)):
+            positions.append(coordinates)
+        else:
+            stack.extend(coordinates)
+    return(positions)
+
+
+def reproject_features(features, transform):
+    """
+    Reproject the geometries of FEATURES (GeoJSON dicts) in place, with one call of TRANSFORM
+    (x ARRAY, y ARRAY -> x ARRAY, y ARRAY) for all their coordinates.
+    """
+    positions = [position for feature in features for position in geometry_positions(feature.get(GEOMETRY))]
+    if len(positions) == 0:
+        return(features)
+    x, y = transform(np.array([position[0] for position in positions], dtype=np.float64),
+                     np.array([position[1] for position in positions], dtype=np.float64))
+    for position, xx, yy in zip(positions, x, y):
+        position[0] = float(xx)
+        position[1] = float(yy)
+    return(features)
+
+
+def feature_frame(features, fields=None):
+    """
+    FEATURES as a table: one column per property (lower case, as ogr2ogr names them) and GEOMETRY (GeoJSON).
+    With FIELDS (the fields of the layer), every batch has the same columns, whatever properties it holds.
+    """
+    frame = pd.DataFrame([feature.get('properties') or {} for feature in features])
+    frame.columns = [str(col).lower() for col in frame.columns]
+    if fields is not None:
+        frame = frame.reindex(columns=[str(field).lower() for field in fields])
+    frame[GEOMETRY] = [json.dumps(feature.get(GEOMETRY)) if feature.get(GEOMETRY) else None for feature in features]
+    return(frame)
+
+
+class GeoJSONWriter(object):
+    """
+    Stream features into a GeoJSON FeatureCollection file.
+    """
+
+    def __init__(self, path, epsg=COORD_SYSTEM):
+        self.stream = open(path, 'w')
+        self.stream.write('{"type": "FeatureCollection", "crs": {"type": "name", "properties": '
+                          '{"name": "urn:ogc:def:crs:EPSG::%i"}}, "features": [\n' %(epsg))
+        self.count = 0
+
+    def write(self, features):
+        for feature in features:
+            self.stream.write((',\n' if self.count else '') + json.dumps(feature))
+            self.count += 1
+
+    def close(self):
+        self.stream.write('\n]}\n')
+        self.stream.close()
+
+
+def spatial_column(con, schema, table, epsg=COORD_SYSTEM):
+    """
+    On postgres, turn the GeoJSON column of SCHEMA.TABLE into a PostGIS geometry.
+    """
+    if con.dialect.name != 'postgresql':
+        return
+    con.execute('alter table %s."%s" alter column "%s" type geometry(Geometry, %i) using ST_SetSRID(ST_GeomFromGeoJSON("%s"), %i)'
+                %(schema, table, GEOMETRY, epsg, GEOMETRY, epsg))
+
+
+def load_source(path, con, schema, table=None, epsg=COORD_SYSTEM, geojson=None, batch_size=BATCH_SIZE):
+    """
+    Load the layers of a KML file or shapefile into SCHEMA, replacing their tables.
+    Args
+       STR TABLE	The table of the (single) layer; the layers are named after themselves if None
+       STR GEOJSON	Also write every layer to <GEOJSON>/<schema>.<table>.geojson
+    Returns
+       DICT		Number of features per table
+    """
+    loaded = {}
+    for name, source, fields, features in read_layers(path):
+        name = (table or name).lower()
+        transform = lambda x, y: project_points(x, y, epsg, source)
+        writer = GeoJSONWriter(os.path.join(geojson, '%s.%s.geojson' %(schema, name)), epsg) if geojson else None
+        if_exists = 'replace'
+        loaded[name] = 0
+        for batch in batches(features, batch_size):
+            if source != epsg:
+                reproject_features(batch, transform)
+            if con is not None:
+                write_frame(feature_frame(batch, fields), name, schema, con, if_exists=if_exists, index=False)
+            if writer is not None:
+                writer.write(batch)
+            loaded[name] += len(batch)
+            if_exists = 'append'
+        if writer is not None:
+            writer.close()
+        if con is not None and loaded[name]:
+            spatial_column(con, schema, name, epsg)
+        log.info("%s: %i features in %s.%s" %(path, loaded[name], schema, name))
+    return(loaded)
+
+
+def ingest_geometries(directory, engine=None, sources=SOURCES, threads=LOAD_THREADS, geojson=None):
+    """
+    Load SOURCES (the files under DIRECTORY), several at a time.
+    Args
+       ENGINE		A SQLAlchemy engine (every file is loaded on its own connection), or None to
+       			only write the GeoJSON files
+    Returns
+       DICT		Number of features per schema.table
+    """
+    if engine is not None and engine.dialect.name == 'postgresql':
+        for schema in sorted(set([schema for _, schema, _ in sources])):
+            engine.execute('create schema if not exists %s' %(schema))
+
+    def load(source):
+        path, schema, table = source
+        con = thread_connection(engine) if engine is not None else None
+        try:
+            loaded = load_source(os.path.join(directory, path), con, schema, table, geojson=geojson)
+        finally:
+            if engine is not None:
+                release_thread_connection(engine)
+        return(dict([('%s.%s' %(schema, name), count) for name, count in loaded.items()]))
+
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(load, sources)
+    finally:
+        pool.close()
+        pool.join()
+    return(dict([item for loaded in results for item in loaded.items()]))
+
+
+if __name__ == '__main__':
+    import argparse
+    from sanergy.modeling.connection import get_engine
+    parser = argparse.ArgumentParser(description="Load the KML files and shapefiles into the database")
+    parser.add_argument('directory', help="data/input/shapefiles")
+    parser.add_argument('--geojson', help="Also write the layers as GeoJSON files to this directory")
+    parser.add_argument('--no-database', action='store_true', help="Only write the GeoJSON files")
+    parser.add_argument('--threads', type=int, default=LOAD_THREADS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    engine = None if args.no_database else get_engine()
+    for table, count in sorted(ingest_geometries(args.directory, engine, threads=args.threads, geojson=args.geojson).items()):
+        log.info("%s: %i features" %(table, count))
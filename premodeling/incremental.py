@@ -0,0 +1,118 @@
+"""
+Incremental refresh of premodeling.toiletcollection (ProcessCollectionsData.py --incremental).
+1. The high-water mark of the processed Collection_Date is kept in premodeling.watermark
+2. Every toilet is recomputed from its last complete collection (both containers weighed and a
+   collection that closes an interpolation run) at least CASE_WINDOW days before the mark. From there
+   on, the interpolation runs, the days-since counters and the case window only depend on re-read rows.
+   The toilets without one in the last MAX_LOOKBACK_DAYS are recomputed from their first stored day
+3. The recomputed rows replace the stored ones, from the first recomputed day of each toilet on
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from sanergy.modeling.writer import write_frame
+
+WATERMARK_TABLE = 'watermark'
+CASE_WINDOW = 7
+# Toilets without a complete collection in this many days before the mark are recomputed from their first day
+MAX_LOOKBACK_DAYS = 90
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+
+def read_watermark(con, name, schema='premodeling'):
+    """
+    The high-water mark (a Timestamp) of the table NAME, or None if it was never processed.
+    """
+    if not con.dialect.has_table(con, WATERMARK_TABLE, schema=schema):
+        return(None)
+    mark = con.execute(text('select high_water_mark from %s.%s where table_name = :name' %(schema, WATERMARK_TABLE)),
+                       name=name).scalar()
+    return(None if mark is None else pd.Timestamp(mark))
+
+
+def record_watermark(con, name, high_water_mark, schema='premodeling'):
+    row = pd.DataFrame([{'table_name': name,
+                         'high_water_mark': pd.Timestamp(high_water_mark).to_pydatetime(),
+                         'processed_at': datetime.now()}])
+    if con.dialect.has_table(con, WATERMARK_TABLE, schema=schema):
+        con.execute(text('delete from %s.%s where table_name = :name' %(schema, WATERMARK_TABLE)), name=name)
+    write_frame(row, WATERMARK_TABLE, schema, con, if_exists='append', index=False)
+
+
+def recompute_starts(con, watermark, interpolate_codes, zero_codes, table='toiletcollection', schema='premodeling',
+                     window=CASE_WINDOW, max_lookback=MAX_LOOKBACK_DAYS,
+                     toiletname='ToiletID', date='Collection_Date', code='Missed_Collection_Code'):
+    """
+    The day each toilet has to be recomputed from: its last complete collection no later than
+    WINDOW days before WATERMARK (the state of the toilet is reset on that day).
+    Only the stored rows of the last MAX_LOOKBACK days are searched: the toilets stored there without
+    a complete collection are recomputed from their first stored day, as a full run would compute them.
+    Args
+       DATE WATERMARK	The high-water mark of TABLE
+       SET INTERPOLATE_CODES, ZERO_CODES	The missed collection codes of interpolate_missed_collections
+    Returns
+       SERIES		Start day per stored toilet (the start of the lookback for the toilets not stored in it)
+       DATE		The earliest day to read, and the start of the toilets that were never stored
+    """
+    cutoff = watermark - timedelta(days=window)
+    earliest = watermark - timedelta(days=max_lookback)
+    stored = pd.read_sql(text('select "%s", "%s", "Feces_Collected", "Urine_Collected", "%s" from %s.%s '
+                              'where "%s" >= :earliest and "%s" <= :cutoff' %(toiletname, date, code, schema, table, date, date)),
+                         con, params={'earliest': earliest.to_pydatetime(), 'cutoff': cutoff.to_pydatetime()},
+                         parse_dates=[date])
+    complete = ((stored['Feces_Collected'] == 1) & (stored['Urine_Collected'] == 1) &
+                ~stored[code].isin(interpolate_codes) & ~stored[code].isin(zero_codes))
+    reset = stored.loc[complete].groupby(toiletname)[date].max()
+    firsts = pd.read_sql('select "%s", min("%s") as "%s" from %s.%s group by "%s"' %(toiletname, date, date, schema, table, toiletname),
+                         con, parse_dates=[date]).set_index(toiletname)[date]
+    # No state to restart from in the lookback: the whole history of the toilet is recomputed
+    unreset = firsts[firsts.index.isin(stored[toiletname]) & ~firsts.index.isin(reset.index)]
+    starts = pd.Series(pd.Timestamp(earliest), index=firsts.index)
+    starts[unreset.index] = unreset
+    starts[reset.index] = reset
+    since = min(pd.Timestamp(earliest), unreset.min()) if len(unreset) > 0 else pd.Timestamp(earliest)
+    log.info("Recomputing %i toilets from their last complete collection, %i from their first day (since %s), the others from %s"
+             %(len(reset), len(unreset), since.date(), earliest.date()))
+    return(starts, since)
+
+
+def rows_to_recompute(frame, starts, default, toiletname='ToiletID', date='Collection_Date'):
+    """
+    The rows of FRAME on or after the start day of their toilet (DEFAULT for the toilets not in STARTS).
+    """
+    start = pd.to_datetime(frame[toiletname].map(starts)).fillna(pd.Timestamp(default))
+    return(frame.loc[(frame[date] >= start).values])
+
+
+def replace_rows(frame, con, table='toiletcollection', schema='premodeling', toiletname='ToiletID', date='Collection_Date', index=True):
+    """
+    Upsert FRAME into SCHEMA.TABLE: the stored rows of each toilet from its first day in FRAME on
+    are replaced by the rows of FRAME, in one transaction.
+    Args
+       CON		A SQLAlchemy connection
+       BOOL INDEX		Write the index as a column, as the table was written (see write_frame); it is
+       			renumbered to follow the largest stored one, so the column stays unique
+    Returns
+       INT		Number of rows written
+    """
+    starts = frame.groupby(toiletname)[date].min().reset_index()
+    starts_table = '%s_starts' %(table)
+    with con.begin():
+        write_frame(starts, starts_table, schema, con, if_exists='replace', index=False)
+        deleted = con.execute('delete from %s.%s where exists (select 1 from %s.%s s where s."%s" = %s."%s" and %s."%s" >= s."%s")'
+                              %(schema, table, schema, starts_table, toiletname, table, toiletname, table, date, date)).rowcount
+        if index:
+            label = frame.index.name or 'index'
+            last = con.execute('select max("%s") from %s.%s' %(label, schema, table)).scalar()
+            frame = frame.copy()
+            frame.index = pd.Index(np.arange(len(frame), dtype=np.int64) + (int(last) + 1 if last is not None else 0), name=frame.index.name)
+        written = write_frame(frame, table, schema, con, if_exists='append', index=index)
+        con.execute('drop table %s.%s' %(schema, starts_table))
+    log.info("Replaced %i rows of %s.%s with %i rows" %(deleted, schema, table, written))
+    return(written)
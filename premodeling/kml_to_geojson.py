@@ -1,13 +1,9 @@
-from osgeo import ogr
+from sanergy.premodeling.geometries import load_source
 
-def kml2geojson(kml_file):
+def kml2geojson(kml_file, directory='.'):
     '''
-    From Gist. 
-    Transform kml (from Google Maps) to the geojson format.
+    From Gist.
+    Transform kml (from Google Maps) to the geojson format: one shapefiles.<layer>.geojson file per
+    layer in DIRECTORY, reprojected to EPSG:21037 (see geometries.py).
     '''
-    drv = ogr.GetDriverByName('KML')
-    kml_ds = drv.Open(kml_file)
-    for kml_lyr in kml_ds:
-        for feat in kml_lyr:
-            print feat.ExportToJson()
-
+    return(load_source(kml_file, None, 'shapefiles', geojson=directory))
@@ -3,7 +3,7 @@ The purpose of this code is to move the tables provided by Sanergy from the PUBL
 """
 
 ## Import basic libraries for communicating with the postgres database
-from sqlalchemy import create_engine
+from sanergy.modeling.connection import get_engine, connect
 import dbconfig 
 import psycopg2
 
@@ -22,11 +22,8 @@ KNOWN_TABLES = [u'Collection_Data__c',
 		u'tblToilet',
 		u'_IPA_tbl_user']
 
-engine = create_engine('postgresql+psycopg2://%s:%s@%s:%s' %(dbconfig.config['user'],
-							dbconfig.config['password'],
-							dbconfig.config['host'],
-							dbconfig.config['port']))
-connection = engine.connect()
+engine = get_engine({'backend':'postgres'}, dbconfig.config)
+connection = connect(engine)
 result = connection.execute("select table_schema, table_name from information_schema.tables;")
 result = [res for res in result.fetchall() if ((res[0]==MOVE_FROM)&(res[1] in KNOWN_TABLES))]
 
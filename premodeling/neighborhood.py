@@ -0,0 +1,216 @@
+"""
+The rolling neighborhood features of premodeling.toiletdensity (e.g., average_50m_7days_Feces_kg_day),
+for every toilet and day of the history at once instead of a loop over the days.
+1. The waste of every toilet and day is a dense (toilet x day) matrix, with the number of
+   collections (waste not missing) and of non-empty collections (not missing and not 0)
+2. Their sums over the window [day - period, day) of every day are differences of their cumulative
+   sums along the days
+3. The sums over the neighbors within a radius are a product with the sparse neighbor matrix
+   (neighbors.py): average = waste / collections of the neighbors, collections = non-empty collections
+   of the neighbors, and distance = average distance to the neighbors collected in the window
+4. Only the days a toilet is active are kept (StartCollection < day <= LastCollection, as in
+   premodeling.toilethistory, a cumulative sum of the lifetime starts and ends), and only if a
+   neighbor was collected in the window
+The matrices are float32 (the counts and sums of a window are small) and the masks boolean.
+The rows have the layout of the table, which load_density (density.py) pivots to one column per feature.
+"""
+
+import logging
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sqlalchemy import text
+
+from sanergy.modeling.writer import write_frame
+from sanergy.premodeling.density import encode_known
+from sanergy.premodeling.neighbors import pairs_matrix
+from sanergy.premodeling.timeseries import day_numbers
+
+PERIODS = [1, 7] # days
+AREAS = [5, 50] # meters
+VARIABLES = ['Feces_kg_day', 'Urine_kg_day']
+DENSITY_TABLE = 'toiletdensity'
+DENSITY_COLUMNS = ['ToiletID', 'Collection_Date', 'functional', 'area', 'period', 'variable', 'observations', 'value']
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+
+def day_matrices(frame, toilets, first_day, n_days, variable, toiletname='ToiletID', date='Collection_Date'):
+    """
+    VARIABLE of FRAME per toilet and day.
+    Args
+       LIST TOILETS	The rows (the rows of FRAME of other toilets are dropped)
+       INT FIRST_DAY	The first column, in days since the epoch (see day_numbers)
+       INT N_DAYS	Number of columns
+    Returns
+       ARRAY, ARRAY, ARRAY	(toilet x day) waste (0 if missing), collections, non-empty collections
+    """
+    rows = encode_known(frame[toiletname].values, list(toilets))
+    cols = day_numbers(frame[date]) - first_day
+    values = frame[variable].values.astype(np.float64)
+    kept = (rows >= 0) & (cols >= 0) & (cols < n_days)
+    collected = kept & ~np.isnan(values)
+    shape = (len(toilets), n_days)
+    waste = np.zeros(shape, dtype=np.float32)
+    collections = np.zeros(shape, dtype=np.float32)
+    nonempty = np.zeros(shape, dtype=np.float32)
+    np.add.at(waste, (rows[collected], cols[collected]), values[collected])
+    np.add.at(collections, (rows[collected], cols[collected]), 1)
+    np.add.at(nonempty, (rows[collected], cols[collected]), values[collected] != 0)
+    return(waste, collections, nonempty)
+
+
+def window_sums(matrix, period):
+    """
+    The sums of MATRIX over the columns [day - PERIOD, day) of every column (day), of the dtype of
+    MATRIX (the cumulative sums over the whole history are float64, not to lose the small windows).
+    """
+    cumulative = np.zeros((matrix.shape[0], matrix.shape[1] + 1))
+    np.cumsum(matrix, axis=1, out=cumulative[:, 1:])
+    days = np.arange(matrix.shape[1])
+    return((cumulative[:, days] - cumulative[:, np.maximum(days - period, 0)]).astype(matrix.dtype))
+
+
+def activity_matrix(history, toilets, first_day, n_days, toiletname='ToiletID',
+                    start='StartCollection', last='LastCollection'):
+    """
+    The days each toilet is active, StartCollection < day <= LastCollection, as a boolean
+    (toilet x day) matrix (see day_matrices for the arguments): +1 on the first day of every
+    lifetime and -1 after its last, summed along the days.
+    """
+    history = history.loc[pd.notnull(history[start]) & pd.notnull(history[last])]
+    rows = encode_known(history[toiletname].values, list(toilets))
+    known = rows >= 0
+    rows = rows[known]
+    firsts = np.clip(day_numbers(history[start])[known] + 1 - first_day, 0, n_days)
+    ends = np.clip(day_numbers(history[last])[known] + 1 - first_day, 0, n_days)
+    rows, firsts, ends = rows[firsts < ends], firsts[firsts < ends], ends[firsts < ends]
+    changes = np.zeros((len(toilets), n_days + 1), dtype=np.int32)
+    np.add.at(changes, (rows, firsts), 1)
+    np.add.at(changes, (rows, ends), -1)
+    return(np.cumsum(changes[:, :n_days], axis=1) > 0)
+
+
+def within(matrix, radius, distances=False):
+    """
+    The pairs of the distance MATRIX within RADIUS, as 1s (or their distances if DISTANCES).
+    """
+    matrix = matrix.tocsr()
+    close = matrix.data <= radius
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    data = matrix.data[close].astype(np.float32) if distances else np.ones(close.sum(), dtype=np.float32)
+    return(sparse.csr_matrix((data, (rows[close], matrix.indices[close])), shape=matrix.shape))
+
+
+def long_rows(keep, observations, values, toilets, first_day, functional, area, period, variable):
+    """
+    The cells of KEEP as rows of premodeling.toiletdensity.
+    """
+    rows, cols = np.nonzero(keep)
+    dates = (first_day + cols).astype('datetime64[D]').astype('datetime64[ns]')
+    table = pd.DataFrame({'ToiletID': np.asarray(toilets, dtype=object)[rows],
+                          'Collection_Date': dates,
+                          'observations': observations[rows, cols].astype(np.float64),
+                          'value': values[rows, cols].astype(np.float64)})
+    table['functional'] = functional
+    table['area'] = '%im' %(area)
+    table['period'] = '%i days' %(period)
+    table['variable'] = variable
+    return(table[DENSITY_COLUMNS])
+
+
+def neighborhood_features(collections, history, matrix, toilets, start=None, end=None,
+                          areas=AREAS, periods=PERIODS, variables=VARIABLES,
+                          toiletname='ToiletID', date='Collection_Date'):
+    """
+    The rows of premodeling.toiletdensity, one data frame per area and period.
+    Args
+       DF COLLECTIONS	The waste of every toilet and day (premodeling.toiletcollection), from
+       			max(PERIODS) days before START on
+       DF HISTORY	StartCollection and LastCollection of every toilet (premodeling.toilethistory)
+       CSR MATRIX	The distances between TOILETS (see neighbors.py)
+       DATE START, END	The days of the rows (the first and last day of COLLECTIONS if None)
+    Returns
+       GENERATOR	DF of the rows (DENSITY_COLUMNS) of one area and period
+    """
+    days = day_numbers(collections[date])
+    if len(days) == 0:
+        return
+    first_day = days.min()
+    first = day_numbers([start])[0] if start is not None else first_day
+    last = day_numbers([end])[0] if end is not None else days.max()
+    n_days = max(last - first_day + 1, 0)
+    active = activity_matrix(history, toilets, first_day, n_days, toiletname)
+    active[:, :max(first - first_day, 0)] = False
+    matrices = dict([(variable, day_matrices(collections, toilets, first_day, n_days, variable, toiletname, date))
+                     for variable in variables])
+    for period in periods:
+        sums = dict([(variable, [window_sums(m, period) for m in matrices[variable]]) for variable in variables])
+        for area in areas:
+            neighbors = within(matrix, area)
+            distances = within(matrix, area, distances=True)
+            frames = []
+            for ii, variable in enumerate(variables):
+                waste, collected, nonempty = [neighbors.dot(m) for m in sums[variable]]
+                keep = active & (collected > 0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    frames.append(long_rows(keep, collected, waste / collected, toilets, first_day,
+                                            'average', area, period, variable))
+                frames.append(long_rows(keep, collected, nonempty, toilets, first_day,
+                                        'collections', area, period, variable))
+                if ii == 0:
+                    # The distance to the neighbors collected in the window (of the first variable)
+                    seen = (sums[variable][1] > 0).astype(np.float32)
+                    n_seen = neighbors.dot(seen)
+                    keep = active & (n_seen > 0)
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        frames.append(long_rows(keep, n_seen, distances.dot(seen) / n_seen, toilets, first_day,
+                                                'average', area, period, 'distance'))
+            features = pd.concat(frames, ignore_index=True)
+            log.info("Neighborhood features within %im over %i days: %i rows" %(area, period, len(features)))
+            yield(features)
+
+
+def write_neighborhood_features(con, start=None, end=None, schema='premodeling', table=DENSITY_TABLE):
+    """
+    Compute the features from premodeling.toiletcollection, toilethistory and toiletdistances and
+    write them to SCHEMA.TABLE: replace the table, or only its rows from START on.
+    Returns
+       INT		Number of rows written
+    """
+    history = pd.read_sql('select * from premodeling.toilethistory', con, parse_dates=['StartCollection', 'LastCollection'])
+    pairs = pd.read_sql('select "ToiletID", "NeighborToiletID", "Distance" from premodeling.toiletdistances', con)
+    toilets = sorted(history['ToiletID'].dropna().unique())
+    matrix = pairs_matrix(pairs, toilets)
+    where, params = '', {}
+    if start is not None:
+        where, params = ' where "Collection_Date" >= :since', {'since': pd.Timestamp(start).to_pydatetime() - timedelta(days=max(PERIODS))}
+    collections = pd.read_sql(text('select "ToiletID", "Collection_Date", %s from premodeling.toiletcollection%s'
+                                   %(', '.join(['"%s"' %(variable) for variable in VARIABLES]), where)),
+                              con, params=params, parse_dates=['Collection_Date'])
+    if start is None:
+        if_exists = 'replace'
+    else:
+        con.execute(text('delete from %s.%s where "Collection_Date" >= :start' %(schema, table)),
+                    start=pd.Timestamp(start).to_pydatetime())
+        if_exists = 'append'
+    written = 0
+    for features in neighborhood_features(collections, history, matrix, toilets, start, end):
+        written += write_frame(features, table, schema, con, if_exists=if_exists, index=False)
+        if_exists = 'append'
+    return(written)
+
+
+if __name__ == '__main__':
+    import argparse
+    from sanergy.modeling.connection import get_engine, connect
+    parser = argparse.ArgumentParser(description="Build premodeling.toiletdensity")
+    parser.add_argument('--start', help="Only recompute the days from this date on (YYYY-MM-DD)")
+    parser.add_argument('--end', help="Up to this date (YYYY-MM-DD)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    conn = connect(get_engine())
+    log.info("%i rows written" %(write_neighborhood_features(conn, args.start, args.end)))
+    conn.close()
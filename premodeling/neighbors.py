@@ -0,0 +1,124 @@
+"""
+Distances between neighboring toilets, with a spatial index instead of an all-pairs join.
+1. Project the coordinates once, from WGS84 (EPSG:4326, spherical) to EPSG:21037 (meters; one of
+   the 4 systems in Kenya, the one that contains Nairobi)
+2. Index the projected points in a KD-tree and find the pairs within the largest radius, in
+   O(N log N) instead of comparing every toilet with every other
+3. Keep them as a sparse (toilet x toilet) distance matrix; the neighbors within any smaller radius
+   (RADII) are a filter on it
+Run as a script, it writes premodeling.toiletdistances (the pairs within 100m, with the 5m/25m/50m/100m
+flags) for input/geo_spatial_toilets.sql.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from sanergy.modeling.writer import write_frame
+from sanergy.premodeling.density import encode_known
+
+COORD_SYSTEM = 21037
+COORD_WGS = 4326
+RADII = [5, 25, 50, 100] # meters
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+
+def project_points(longitude, latitude, epsg=COORD_SYSTEM, source=COORD_WGS):
+    """
+    Project coordinates from SOURCE (WGS84 by default) to EPSG (meters), in one call for all the points.
+    Returns
+       ARRAY, ARRAY	x, y
+    """
+    import pyproj
+    longitude = np.asarray(longitude, dtype=np.float64)
+    latitude = np.asarray(latitude, dtype=np.float64)
+    if hasattr(pyproj, 'Transformer'):
+        # pyproj >= 2.1 (python 3); always_xy keeps the (longitude, latitude) -> (x, y) order of pyproj 1
+        transformer = pyproj.Transformer.from_crs('epsg:%i' %(source), 'epsg:%i' %(epsg), always_xy=True)
+        x, y = transformer.transform(longitude, latitude)
+    else:
+        # pyproj 1.9 (pinned for python 2) has no Transformer
+        x, y = pyproj.transform(pyproj.Proj(init='epsg:%i' %(source)), pyproj.Proj(init='epsg:%i' %(epsg)), longitude, latitude)
+    return(np.asarray(x), np.asarray(y))
+
+
+def neighbor_matrix(x, y, radius=max(RADII)):
+    """
+    The distances between the points within RADIUS of each other.
+    Args
+       ARRAY X, Y	Projected coordinates (meters)
+    Returns
+       CSR MATRIX	N x N, symmetric, the distance of every pair within RADIUS (explicit zeros for
+       		points at the same place), no diagonal
+    """
+    points = np.column_stack([x, y])
+    pairs = np.array(sorted(cKDTree(points).query_pairs(radius)), dtype=np.int64).reshape(-1, 2)
+    distances = np.sqrt(((points[pairs[:, 0]] - points[pairs[:, 1]]) ** 2).sum(axis=1))
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    return(sparse.csr_matrix((np.concatenate([distances, distances]), (rows, cols)), shape=(len(points), len(points))))
+
+
+def neighbor_counts(matrix, radii=RADII):
+    """
+    Number of neighbors of every point within each of RADII, as {radius: ARRAY}.
+    """
+    matrix = matrix.tocsr()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    return(dict([(radius, np.bincount(rows, weights=(matrix.data <= radius), minlength=matrix.shape[0]).astype(np.int64))
+                 for radius in radii]))
+
+
+def neighbor_pairs(matrix, toilets, radii=RADII, toiletname='ToiletID'):
+    """
+    The pairs of MATRIX as a table (ToiletID, NeighborToiletID, Distance and one <radius>m flag per radius),
+    as premodeling.toiletdistances.
+    """
+    pairs = matrix.tocoo()
+    toilets = np.asarray(toilets, dtype=object)
+    table = pd.DataFrame({toiletname: toilets[pairs.row],
+                          'Neighbor' + toiletname: toilets[pairs.col],
+                          'Distance': pairs.data},
+                         columns=[toiletname, 'Neighbor' + toiletname, 'Distance'])
+    for radius in radii:
+        table['%im' %(radius)] = (pairs.data <= radius).astype(np.int32)
+    return(table)
+
+
+def pairs_matrix(pairs, toilets, toiletname='ToiletID'):
+    """
+    The distance matrix of the pairs of a premodeling.toiletdistances table (the inverse of
+    neighbor_pairs), over TOILETS (the pairs of other toilets are dropped).
+    """
+    toilets = list(toilets)
+    rows = encode_known(pairs[toiletname].values, toilets)
+    cols = encode_known(pairs['Neighbor' + toiletname].values, toilets)
+    known = (rows >= 0) & (cols >= 0)
+    return(sparse.csr_matrix((pairs['Distance'].values[known].astype(np.float64), (rows[known], cols[known])),
+                             shape=(len(toilets), len(toilets))))
+
+
+def toilet_coordinates(con):
+    """
+    One point per toilet with collections: ToiletID, Longitude, Latitude.
+    """
+    toilets = pd.read_sql('select distinct "ToiletID", "Longitude", "Latitude" from input."tblToilet" '
+                          'where "ToiletID" in (select "Toilet__c" from input."Collection_Data__c")', con)
+    toilets = toilets.dropna().drop_duplicates(subset=['ToiletID'])
+    return(toilets.reset_index(drop=True))
+
+
+if __name__ == '__main__':
+    from sanergy.modeling.connection import get_engine
+    logging.basicConfig(level=logging.INFO)
+    engine = get_engine()
+    toilets = toilet_coordinates(engine)
+    x, y = project_points(toilets['Longitude'].values, toilets['Latitude'].values)
+    matrix = neighbor_matrix(x, y, max(RADII))
+    log.info("%i toilets, %i pairs within %im" %(len(toilets), matrix.nnz, max(RADII)))
+    write_frame(neighbor_pairs(matrix, toilets['ToiletID'].values), 'toiletdistances', 'premodeling', engine,
+                if_exists='replace', index=False)
@@ -0,0 +1,151 @@
+"""
+Named stages with on-disk checkpoints, for the premodeling build (ProcessCollectionsData.py).
+1. Every stage is keyed by the fingerprint of its inputs: the source tables it reads (row count and
+   latest date), the keys of the stages it depends on and its parameters
+2. The result of a stage is pickled under <directory>/<stage>/<key>.pkl; a rerun loads it instead of
+   recomputing the stage when none of its inputs changed
+3. resume_from: recompute that stage and the ones after it, and load the latest checkpoint of the
+   stages before it without checking their inputs (e.g., after a crash in a late stage)
+4. The time and the row count of every stage are logged
+5. submit: run a stage on a thread pool as soon as the stages it depends on are done, so independent
+   stages (e.g., the reads of the source tables) overlap
+"""
+
+import os
+import time
+import glob
+import logging
+
+import pandas as pd
+
+from sanergy.modeling.cache import config_fingerprint
+
+CHECKPOINT_EXTENSION = '.pkl'
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+
+def table_fingerprint(con, table, date=None):
+    """
+    Row count (and latest DATE) of a source table, e.g., 'input."Collection_Data__c"'.
+    """
+    statement = 'select count(*)%s from %s' %(', max("%s")' %(date) if date else '', table)
+    row = con.execute(statement).fetchone()
+    return({'table': table, 'n_rows': int(row[0]), 'max_date': str(row[1]) if date else None})
+
+
+class StageRunner(object):
+    """
+    Run the stages of a build in order, reusing their checkpoints.
+    """
+
+    def __init__(self, directory, con=None, resume_from=None):
+        """
+        Args
+           STR DIRECTORY	Where the checkpoints are kept
+           CON		A SQLAlchemy engine (or a connection, if the stages are not submitted to
+           			a pool), to fingerprint the source tables
+           STR RESUME_FROM	Name of the first stage to recompute unconditionally
+        """
+        self.directory = directory
+        self.con = con
+        self.resume_from = resume_from
+        self.keys = {}
+        self.timings = []
+        self.pending = {}
+        # The stages in the order they were run or submitted: the checkpoints of the stages before
+        # the resume point are trusted, the stages from it on are recomputed
+        self.order = []
+        self.trusted = {}
+
+    def register(self, name):
+        if name not in self.trusted:
+            self.trusted[name] = ((self.resume_from is not None) and (self.resume_from not in self.order)
+                                  and (name != self.resume_from))
+            self.order.append(name)
+        return(self.trusted[name])
+
+    def checkpoint(self, name, key):
+        return(os.path.join(self.directory, name, key + CHECKPOINT_EXTENSION))
+
+    def latest_checkpoint(self, name):
+        paths = glob.glob(os.path.join(self.directory, name, '*' + CHECKPOINT_EXTENSION))
+        return(max(paths, key=os.path.getmtime) if paths else None)
+
+    def stage_key(self, name, sources=[], upstream=[], params={}):
+        fingerprints = [table_fingerprint(self.con, table, date) for table, date in sources]
+        return(config_fingerprint({'stage': name,
+                                   'sources': fingerprints,
+                                   'upstream': [self.keys[stage] for stage in upstream],
+                                   'params': params}))
+
+    def run(self, name, compute, sources=[], upstream=[], params={}):
+        """
+        The result of the stage NAME, from its checkpoint or from COMPUTE().
+        Args
+           FUNCTION COMPUTE	Computes the stage (no arguments), returns a data frame
+           LIST SOURCES	(table, date column or None) of the source tables the stage reads
+           LIST UPSTREAM	Names of the earlier stages whose results it uses
+           DICT PARAMS	Anything else that changes the result (JSON serializable)
+        Returns
+           DF		The result of the stage
+        """
+        started = time.time()
+        trusted = self.register(name)
+        result = None
+        if trusted:
+            # Before the resume point: trust the latest checkpoint
+            path = self.latest_checkpoint(name)
+            if path is not None:
+                self.keys[name] = os.path.basename(path)[:-len(CHECKPOINT_EXTENSION)]
+                result = pd.read_pickle(path)
+                origin = 'resumed'
+            else:
+                log.warning("No checkpoint of the stage %s to resume from, computing it" %(name))
+        if result is None:
+            key = self.keys[name] = self.stage_key(name, sources, upstream, params)
+            path = self.checkpoint(name, key)
+            if os.path.exists(path) and (self.resume_from is None):
+                result = pd.read_pickle(path)
+                origin = 'checkpoint'
+            else:
+                result = compute()
+                self.save(name, key, result)
+                origin = 'computed'
+        seconds = time.time() - started
+        self.timings.append({'stage': name, 'origin': origin, 'n_rows': len(result), 'seconds': seconds})
+        log.info("Stage %s: %i rows in %.1fs (%s)" %(name, len(result), seconds, origin))
+        return(result)
+
+    def submit(self, pool, name, compute, sources=[], upstream=[], params={}):
+        """
+        Run the stage NAME on a thread of POOL (e.g., a multiprocessing.pool.ThreadPool) once the
+        stages of UPSTREAM are done. Stages have to be submitted after the stages they depend on.
+        Args
+           FUNCTION COMPUTE	Computes the stage from the results of UPSTREAM (in that order)
+        Returns
+           ASYNCRESULT	The result of the stage, with get()
+        """
+        self.register(name)
+        inputs = [self.pending[stage] for stage in upstream]
+        def job():
+            results = [pending.get() for pending in inputs]
+            return(self.run(name, lambda: compute(*results), sources, upstream, params))
+        self.pending[name] = pool.apply_async(job)
+        return(self.pending[name])
+
+    def save(self, name, key, result):
+        """
+        Pickle RESULT as the checkpoint of the stage, replacing its older checkpoints.
+        """
+        stage_directory = os.path.join(self.directory, name)
+        if not os.path.exists(stage_directory):
+            os.makedirs(stage_directory)
+        for path in glob.glob(os.path.join(stage_directory, '*' + CHECKPOINT_EXTENSION)):
+            os.remove(path)
+        partial = self.checkpoint(name, key) + '.tmp'
+        result.to_pickle(partial)
+        os.rename(partial, self.checkpoint(name, key))
+
+    def summary(self):
+        return(pd.DataFrame(self.timings, columns=['stage', 'origin', 'n_rows', 'seconds']))
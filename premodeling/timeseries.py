@@ -0,0 +1,171 @@
+"""
+Vectorized per-toilet time series helpers for the premodeling scripts (ProcessCollectionsData.py).
+1. Complete the calendar: one row per toilet and day, from its first to its last collection
+2. Count the events (e.g., cases) of the same toilet within a window of days of each row
+3. Spread the weights of a collection over the preceding missed collections
+4. Count the days since the last event (e.g., collection), a counter that resets on the event
+"""
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+
+CALENDAR_START = datetime(2011, 1, 1)
+
+
+def day_numbers(dates):
+    """
+    Days since the epoch (int64) of a date column or list of dates.
+    """
+    return(pd.to_datetime(dates).values.astype('datetime64[D]').astype(np.int64))
+
+
+def complete_calendar(collects, toiletname='ToiletID', date='Collection_Date', start=CALENDAR_START):
+    """
+    Add a row for every missing day of every toilet, between its first day (or START, whichever is
+    later) and its last day, with all the other variables missing.
+    Args
+       DF COLLECTS	The collections data, one row per toilet and collection
+       DATE START		No days are added before this date
+    Returns
+       DF		COLLECTS with the added rows, sorted by toilet and date
+    """
+    days = day_numbers(collects[date])
+    codes, toilets = pd.factorize(collects[toiletname])
+    known = codes >= 0
+    bounds = pd.Series(days[known]).groupby(codes[known]).agg(['min', 'max'])
+    first = np.maximum(bounds['min'].values, day_numbers([start])[0])
+    last = bounds['max'].values
+
+    # The grid of all (toilet, day) pairs: one block of consecutive days per toilet
+    n_days = np.maximum(last - first + 1, 0)
+    block_start = np.cumsum(n_days) - n_days
+    grid_codes = np.repeat(bounds.index.values, n_days)
+    grid_days = np.repeat(first, n_days) + (np.arange(n_days.sum()) - np.repeat(block_start, n_days))
+
+    # Keep the pairs that were not observed (toilet and day as one integer key)
+    offset = days.min()
+    span = days.max() - offset + 1
+    observed = codes[known].astype(np.int64) * span + (days[known] - offset)
+    grid = grid_codes.astype(np.int64) * span + (grid_days - offset)
+    missing = ~np.in1d(grid, observed)
+
+    added = pd.DataFrame({toiletname: np.asarray(toilets)[grid_codes[missing]],
+                          date: grid_days[missing].astype('datetime64[D]').astype('datetime64[ns]')})
+    completed = pd.concat([collects, added], ignore_index=True)
+    return(completed.sort_values(by=[toiletname, date]))
+
+
+def events_within_window(frame, events, key='ToiletID', date='Collection_Date', window=7, direction='forward'):
+    """
+    For every row of FRAME, the number of EVENTS with the same KEY within WINDOW days of its date:
+    in [date, date + WINDOW] ('forward', the row is in the week before an event) or
+    in [date - WINDOW, date] ('backward', an event happened in the week before the row).
+    Both tables are joined as sorted (key, day) integers, with two binary searches per row.
+    Args
+       DF FRAME		The rows to count for (e.g., the collections)
+       DF EVENTS		The events, with the KEY and DATE columns (e.g., the toilet cases)
+       INT WINDOW		Length of the window in days
+    Returns
+       ARRAY		Number of events per row of FRAME (0 if there are none)
+    """
+    codes, _ = pd.factorize(pd.concat([frame[key], events[key]], ignore_index=True))
+    frame_codes, event_codes = codes[:len(frame)], codes[len(frame):]
+    frame_days, event_days = day_numbers(frame[date]), day_numbers(events[date])
+    all_days = np.concatenate([frame_days, event_days])
+    offset = all_days.min() - window
+    span = all_days.max() - offset + window + 1
+
+    keep = event_codes >= 0
+    event_keys = np.sort(event_codes[keep].astype(np.int64) * span + (event_days[keep] - offset))
+    frame_keys = frame_codes.astype(np.int64) * span + (frame_days - offset)
+    if direction == 'forward':
+        lo, hi = frame_keys, frame_keys + window
+    elif direction == 'backward':
+        lo, hi = frame_keys - window, frame_keys
+    else:
+        raise ValueError("Unsupported window direction {0}".format(direction))
+    counts = np.searchsorted(event_keys, hi, side='right') - np.searchsorted(event_keys, lo, side='left')
+    counts[frame_codes < 0] = 0
+    return(counts)
+
+
+def interpolate_missed_collections(collects, interpolate_codes, zero_codes, weights=['Feces_kg_day', 'Urine_kg_day'],
+                                   toiletname='ToiletID', date='Collection_Date', code='Missed_Collection_Code', record='Id'):
+    """
+    Estimate the waste accumulated on the days without a pick up.
+    Every row is classified, per toilet and in date order, as
+       Z: a missed collection code in ZERO_CODES, the weights are set to 0
+       I: a code in INTERPOLATE_CODES, or no collection record (a day added to the calendar)
+       O: any other day, a collection that closes the run of I days before it
+    The weights of a closing collection are divided by the length of its run (the I days and itself)
+    and assigned to its I days. Runs are numbered by a cumulative sum over the closing days.
+    Args
+       DF COLLECTS	The collections data
+       SET INTERPOLATE_CODES, ZERO_CODES	Missed collection codes (as stored in CODE)
+       LIST WEIGHTS	The columns to interpolate
+    Returns
+       DF		A copy of COLLECTS with the interpolated weights
+       SERIES		Per toilet, the longest run interpolated over (max_linear_int), 0 if none
+    """
+    collects = collects.copy()
+    order = np.lexsort((day_numbers(collects[date]), pd.factorize(collects[toiletname])[0]))
+    toilets = collects[toiletname].values[order]
+    codes = collects[code].values[order]
+    is_zero = pd.Series(codes).isin(zero_codes).values
+    is_interp = pd.Series(codes).isin(interpolate_codes).values
+    is_interp = is_interp | (~is_zero & pd.isnull(collects[record].values[order]))
+    is_closing = ~is_interp & ~is_zero
+
+    # A run starts after a closing day or with a new toilet, and ends with (includes) its closing day
+    starts = np.ones(len(order), dtype=bool)
+    if len(order) > 0:
+        starts[1:] = is_closing[:-1] | (toilets[1:] != toilets[:-1])
+    run = np.cumsum(starts) - 1
+    n_interp = np.bincount(run, weights=is_interp)
+    closer = np.full(run.max() + 1 if len(run) else 0, -1, dtype=np.int64)
+    closer[run[is_closing]] = np.flatnonzero(is_closing)
+    length = n_interp + 1
+    filled = is_interp & (closer[run] >= 0)
+
+    for weight in weights:
+        values = collects[weight].values[order].astype(np.float64)
+        result = values.copy()
+        result[is_zero] = 0
+        result[filled] = values[closer[run[filled]]] / length[run[filled]]
+        unsorted = np.empty(len(order))
+        unsorted[order] = result
+        collects[weight] = unsorted
+
+    # The longest run per toilet that was interpolated over
+    closed = (closer >= 0) & (n_interp > 0)
+    run_toilet = toilets[np.searchsorted(run, np.arange(len(closer)))] if len(closer) else toilets[:0]
+    max_linear_int = pd.Series(np.where(closed, length, 0).astype(np.int64)).groupby(run_toilet).max()
+    return(collects, max_linear_int)
+
+
+def days_since_event(frame, flag, key='ToiletID', date='Collection_Date'):
+    """
+    For every row, the number of rows (days, on a completed calendar) since the last row of the same
+    KEY where FLAG is set: 0 on the flagged rows, and counted from the first row of the key before
+    its first flagged row.
+    Args
+       DF FRAME		The data, e.g., the collections
+       STR FLAG		The event column (1/True on the days of an event, e.g., Feces_Collected)
+    Returns
+       ARRAY		The counter, in the row order of FRAME
+    """
+    order = np.lexsort((day_numbers(frame[date]), pd.factorize(frame[key])[0]))
+    keys = frame[key].values[order]
+    events = frame[flag].fillna(0).values[order].astype(bool)
+    position = np.arange(len(order))
+    resets = events.copy()
+    if len(order) > 0:
+        resets[0] = True
+        resets[1:] |= (keys[1:] != keys[:-1])
+    # Position of the last reset up to each row
+    last_reset = np.maximum.accumulate(np.where(resets, position, 0))
+    counter = np.empty(len(order), dtype=np.int64)
+    counter[order] = position - last_reset
+    return(counter)
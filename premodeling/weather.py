@@ -0,0 +1,165 @@
+"""
+Ingest the hourly ISD-lite weather files of a station (downloaded by input/weather/weather_download.sh)
+as daily aggregates, in input.weather_daily.
+1. Stream the fixed-width .gz files year by year (one file per year, USAF-WBAN-YEAR.gz)
+2. Parse the fixed-width columns directly into numpy arrays: -9999 is
+   missing, and the temperatures, pressure, wind speed and precipitation are scaled by 10
+3. Aggregate per day: mean, min, max and sd of every variable, named <stat>_<variable>
+   (e.g., mean_air_temp), as the features in default.yaml
+4. Incremental runs: only the years after the last aggregated one (and that year itself, which
+   may have been partial) are parsed again
+"""
+
+import os
+import re
+import gzip
+import logging
+
+import numpy as np
+import pandas as pd
+
+from sanergy.modeling.writer import write_frame
+
+# (column, start, length) of an ISD-lite line: the layout of input/weather/weather_schema.csv, with
+# the variables in their full 6-character fields (the schema cut the last digit of the pressure)
+ISD_LITE_COLUMNS = [('year', 0, 4),
+                    ('month', 5, 2),
+                    ('day', 8, 2),
+                    ('hour', 11, 2),
+                    ('air_temp', 13, 6),
+                    ('dew_point_temp', 19, 6),
+                    ('sea_level_pressure', 25, 6),
+                    ('wind_direction', 31, 6),
+                    ('wind_speed_rate', 37, 6),
+                    ('sky_condition_total_coverage_code', 43, 6),
+                    ('liquid_precipitation_depth_dimension_one_hour', 49, 6),
+                    ('liquid_precipitation_depth_dimension_six_hours', 55, 6)]
+MISSING = -9999
+# Variables stored in tenths (degrees C, hectopascals, m/s, mm)
+SCALED = ['air_temp', 'dew_point_temp', 'sea_level_pressure', 'wind_speed_rate',
+          'liquid_precipitation_depth_dimension_one_hour', 'liquid_precipitation_depth_dimension_six_hours']
+# Aggregated variables, with their names in the daily table
+DAILY_VARIABLES = [('air_temp', 'air_temp'),
+                   ('dew_point_temp', 'dew_point_temp'),
+                   ('sea_level_pressure', 'sea_level_pressure'),
+                   ('wind_speed_rate', 'wind_speed_rate'),
+                   ('liquid_precipitation_depth_dimension_six_hours', 'precipitation_6hr')]
+STATISTICS = [('mean', 'mean'), ('min', 'min'), ('max', 'max'), ('sd', 'std')]
+DAILY_TABLE = 'weather_daily'
+FILE_PATTERN = re.compile(r'^\d+-\d+-(\d{4})\.gz$')
+
+log = logging.getLogger("Sanergy Collection Optimizer")
+
+
+def weather_files(directory):
+    """
+    The ISD-lite files of DIRECTORY, as {year: path}.
+    """
+    files = {}
+    for name in os.listdir(directory):
+        match = FILE_PATTERN.match(name)
+        if match:
+            files[int(match.group(1))] = os.path.join(directory, name)
+    return(files)
+
+
+def parse_integers(chars, start, length):
+    """
+    The signed integers in the fixed-width field [START, START+LENGTH) of CHARS (a uint8 matrix,
+    one line per row). Blank fields are MISSING.
+    """
+    field = chars[:, start:start + length].astype(np.int64)
+    digits = field - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+    values = np.zeros(len(chars), dtype=np.int64)
+    for position in range(field.shape[1]):
+        values = np.where(is_digit[:, position], values * 10 + digits[:, position], values)
+    values[(field == ord('-')).any(axis=1)] *= -1
+    values[~is_digit.any(axis=1)] = MISSING
+    return(values)
+
+
+def parse_isd_lite(stream):
+    """
+    Parse the hourly observations of an ISD-lite file.
+    Args
+       FILE STREAM	The (uncompressed) lines of the file
+    Returns
+       DF		One row per observation: date, hour and the variables (NaN if missing, scaled)
+    """
+    lines = stream.read().splitlines()
+    width = max([len(line) for line in lines] + [max([start + length for _, start, length in ISD_LITE_COLUMNS])])
+    # Shorter lines are padded with NUL bytes, which parse as blanks
+    chars = np.array(lines, dtype='S%d' %(width)).view(np.uint8).reshape(len(lines), width)
+    parsed = dict([(name, parse_integers(chars, start, length)) for name, start, length in ISD_LITE_COLUMNS])
+
+    months = (parsed['year'] - 1970) * 12 + (parsed['month'] - 1)
+    dates = months.astype('datetime64[M]').astype('datetime64[D]') + (parsed['day'] - 1).astype('timedelta64[D]')
+    weather = pd.DataFrame({'date': dates.astype('datetime64[ns]'), 'hour': parsed['hour']})
+    for name, _, _ in ISD_LITE_COLUMNS[4:]:
+        values = parsed[name].astype(np.float64)
+        values[values == MISSING] = np.nan
+        if name in SCALED:
+            values /= 10.0
+        weather[name] = values
+    return(weather)
+
+
+def aggregate_daily(weather):
+    """
+    Daily mean, min, max and sd of the hourly WEATHER, with one <stat>_<variable> column each.
+    """
+    byDAY = weather.groupby('date')
+    daily = pd.DataFrame(index=byDAY.size().index)
+    for variable, name in DAILY_VARIABLES:
+        stats = byDAY[variable].agg([function for _, function in STATISTICS])
+        for stat, function in STATISTICS:
+            daily['%s_%s' %(stat, name)] = stats[function]
+    return(daily.reset_index())
+
+
+def last_aggregated_date(con, table=DAILY_TABLE, schema='input'):
+    if not con.dialect.has_table(con, table, schema=schema):
+        return(None)
+    last = con.execute('select max(date) from %s.%s' %(schema, table)).scalar()
+    return(None if last is None else pd.Timestamp(last))
+
+
+def ingest_weather(directory, con, table=DAILY_TABLE, schema='input', full=False):
+    """
+    Aggregate the ISD-lite files of DIRECTORY into SCHEMA.TABLE, one year at a time.
+    Args
+       STR DIRECTORY	Where the .gz files were downloaded
+       CON		A SQLAlchemy engine or connection
+       BOOL FULL		Rebuild the whole table instead of parsing the new years only
+    Returns
+       LIST		The years that were parsed
+    """
+    files = weather_files(directory)
+    last = None if full else last_aggregated_date(con, table, schema)
+    years = sorted([year for year in files if last is None or year >= last.year])
+    if len(years) == 0:
+        return(years)
+    if last is None:
+        if_exists = 'replace'
+    else:
+        # The last aggregated year is parsed again, it may have been partial
+        con.execute("delete from %s.%s where date >= '%i-01-01'" %(schema, table, years[0]))
+        if_exists = 'append'
+    for year in years:
+        log.info("Parsing the weather of %i" %(year))
+        with gzip.open(files[year], 'rb') as stream:
+            daily = aggregate_daily(parse_isd_lite(stream))
+        write_frame(daily, table, schema, con, if_exists=if_exists, index=False)
+        if_exists = 'append'
+    return(years)
+
+
+if __name__ == '__main__':
+    import sys
+    from sanergy.modeling.connection import get_engine, connect
+    logging.basicConfig(level=logging.INFO)
+    engine = get_engine()
+    conn = connect(engine)
+    ingest_weather(sys.argv[1], conn, full=('--full' in sys.argv[2:]))
+    conn.close()
@@ -7,10 +7,14 @@ import pandas as pd
 import readline
 
 #Import our modules
-from sanergy.modeling.LossFunction import LossFunction, compare_models_by_loss_functions
+from sanergy.modeling.LossFunction import compare_models_by_loss_functions
 from sanergy.premodeling.Experiment import generate_experiments
-from sanergy.modeling.dataset import grab_collections_data, get_db, temporal_split
-from sanergy.modeling.models import run_models_on_folds, run_best_model_on_all_data
+from sanergy.modeling.dataset import get_db, temporal_split, FoldSlicer
+from sanergy.modeling.models import run_best_model_on_all_data
+from sanergy.modeling.parallel import run_experiments
+from sanergy.modeling.cache import open_dataset_cache
+from sanergy.modeling.feature_store import FeatureStore, feature_variants
+from sanergy.modeling.connection import pool_stats, dispose_engines
 
 
 
@@ -44,12 +48,6 @@ def main(config_file_name="default.yaml"):
   # In the aggregate evaluation, we may need to interpret losses from folds with different windows differently.
   results = pd.DataFrame()
 
-  # 1. Generate all experiments
-  log.info("Generate experiments from default.yaml...")
-  experiments = generate_experiments(config)
-  log.info("Generated {0} experiments.".format(len(experiments)))
-
-
   """
       loop through the config variables to generate a list of experiments to run
       [{model: "randomForest",
@@ -64,27 +62,43 @@ def main(config_file_name="default.yaml"):
   "test":(start, end)}, ... Fold 2 ...]
   """
 
-  #Loop through each of the experiments
-  #TODO: Remove this, move this elsewhere
-  #db['connection'].execute('DROP TABLE IF EXISTS output."model"')
-  #db['connection'].execute('DROP TABLE IF EXISTS output."predictions"')
-  #db['connection'].execute('DROP TABLE IF EXISTS output."evaluations"')
-  for i_exp, experiment in enumerate(experiments):
-      log.debug("Running experiment #{0}".format(i_exp))
-      #Initialize the loss function.
-      lf = LossFunction(experiment.config)
+  # Every feature variant (config['Xy'] and config['Xy_variants']) is evaluated with all experiments
+  for i_variant, config_Xy in enumerate(feature_variants(config)):
+      config_variant = dict(config)
+      config_variant['Xy'] = config_Xy
 
       # 2. Create the labels / features data set in Postgres
-      #TODO: grab_collections_data needs a unittest
-      if experiment.config['setup']['run_features']:
-          grab_collections_data(db, experiment.config, log) #this creates df features and labels in the postgres
-      log.debug("Generated features in the database.")
-
-
+      # The feature store reuses the tables of this variant if the source has not changed since they were built
+      # (run_features forces a rebuild). All experiments of the variant share them.
+      store = FeatureStore(db, config_variant)
+      rebuild = store.needs_build(force=config['setup']['run_features'])
+      store.use()
+      db['cache'] = open_dataset_cache(db, config_variant, log, fill=not rebuild)
+      if rebuild:
+          store.build() #this creates df features and labels in the postgres
+          log.debug("Generated features {0} in the database.".format(store.key))
+
+      # Load the dataset once; every fold of every experiment is sliced from it in memory.
+      slicer = FoldSlicer.from_db(db, config_variant, folds)
+      log.debug("Loaded the dataset for all folds.")
+
+      # 1. Generate all experiments
+      log.info("Generate experiments from default.yaml (feature variant #{0})...".format(i_variant))
+      experiments = generate_experiments(config_variant)
+      log.info("Generated {0} experiments.".format(len(experiments)))
+
+      # Run the experiments on setup: workers processes; the rows of their results are written here
+      #TODO: Remove this, move this elsewhere
+      #db['connection'].execute('DROP TABLE IF EXISTS output."model"')
+      #db['connection'].execute('DROP TABLE IF EXISTS output."predictions"')
+      #db['connection'].execute('DROP TABLE IF EXISTS output."evaluations"')
       # 4. Folds are passed to models functions
       # 5. Run the models
       # 6. Calculate and save the losses
-      results.append( run_models_on_folds(folds, lf, db, experiment) )#See below the structure. Return a list of losses per fold.
+      failures = run_experiments(experiments, folds, db, slicer, config['db'], workers=config['setup'].get('workers', 1),
+                                 resume=config['setup'].get('resume', True))
+      if failures:
+          log.error("Feature variant #{0}: experiments {1} failed, see the log".format(i_variant, sorted(set([i_exp for (i_exp, _), _ in failures]))))
       # 8. Evaluate the losses
       # Have results_from_experiments ready or load it from the db
   log.info("Crossvalidated the experiments.")
@@ -96,6 +110,9 @@ def main(config_file_name="default.yaml"):
   #TODO: What is test?
   #run_best_model_on_all_data(best_experiment, db, folds)
   # Write the results to postgres
+  log.debug("Database pool: {0}".format(pool_stats(db['engine'])))
+  db['connection'].close()
+  dispose_engines()
 
 if __name__ == '__main__':
     main()
@@ -5,7 +5,13 @@ import sqlalchemy
 import pandas as pd
 import numpy as np
 import logging
+import os
 import sys
+import shutil
+import tempfile
+import gzip
+import json
+import threading
 from datetime import datetime, date, timedelta
 from functools import reduce
 
@@ -13,10 +19,33 @@ from functools import reduce
 
 from sanergy.premodeling.Experiment import generate_experiments, Experiment
 from sanergy.modeling.LossFunction import LossFunction, compare_models_by_loss_functions
-from sanergy.modeling.dataset import grab_collections_data, temporal_split, format_features_labels, create_enveloping_fold
+from sanergy.modeling.dataset import grab_collections_data, temporal_split, format_features_labels, create_enveloping_fold, FoldSlicer
 import sanergy.input.dbconfig as dbconfig
 from sanergy.modeling.models import WasteModel, ScheduleModel, FullModel
 from sanergy.modeling.Staffing import Staffing
+from sanergy.modeling.cache import DatasetCache, config_fingerprint
+from sanergy.modeling.features import add_daily_features
+from sanergy.modeling.writer import copy_chunks, write_frame, FrameBuffer
+import sanergy.modeling.writer as writer
+from sanergy.modeling.backend import create_db_engine
+from sanergy.modeling.dataset import load_modeling_tables, needed_columns
+from sanergy.modeling.ingest import read_compact, encode_strings
+from sanergy.modeling.encoding import CategoricalEncoder
+from sanergy.modeling.feature_store import FeatureStore, feature_variants
+from sanergy.modeling.intervals import IntervalIndex, day_points
+import sanergy.modeling.parallel as parallel
+from sanergy.modeling.parallel import run_experiments
+from sanergy.premodeling.timeseries import complete_calendar, events_within_window, interpolate_missed_collections, days_since_event
+from sanergy.premodeling.weather import parse_isd_lite, aggregate_daily, ingest_weather
+from sanergy.premodeling.incremental import read_watermark, record_watermark, recompute_starts, rows_to_recompute, replace_rows
+from sanergy.premodeling.stages import StageRunner
+from sanergy.premodeling.density import load_density
+from sanergy.premodeling.neighbors import neighbor_matrix, neighbor_counts, neighbor_pairs, pairs_matrix
+from sanergy.premodeling.neighborhood import neighborhood_features, write_neighborhood_features, activity_matrix
+from sanergy.premodeling.geometries import reproject_features, feature_frame, batches, GeoJSONWriter
+from multiprocessing.pool import ThreadPool
+from scipy import sparse
+from sanergy.modeling.connection import get_engine, thread_connection, release_thread_connection, pool_stats, ping_connection, dispose_engines
 #from premodeling.Experiment import generate_experiments
 
 class ExperimentTest(unittest.TestCase):
@@ -61,6 +90,28 @@ class ExperimentTest(unittest.TestCase):
         self.assertEqual(exp,exp2)
         self.assertNotEqual(exp,exp1)
 
+    def test_fingerprint(self):
+        experiments = generate_experiments(self.config)
+        again = Experiment(dict(self.config), experiments[1].model, dict(reversed(list(experiments[1].parameters.items()))))
+        self.assertEqual(again.fingerprint(), experiments[1].fingerprint())
+        self.assertEqual(hash(again), experiments[1].fingerprint())
+        self.assertNotEqual(experiments[1].fingerprint(), experiments[2].fingerprint())
+        self.assertTrue(0 <= experiments[1].fingerprint() < 2**60)
+        self.assertEqual(len(set([experiment.fingerprint() for experiment in experiments])), len(experiments))
+        config = dict(self.config)
+        config['pickle_store'] = '/tmp/elsewhere'
+        self.assertEqual(Experiment(config, experiments[1].model, experiments[1].parameters).fingerprint(), experiments[1].fingerprint())
+        config['cv'] = dict(config['cv'], fake_freq='4W')
+        self.assertNotEqual(Experiment(config, experiments[1].model, experiments[1].parameters).fingerprint(), experiments[1].fingerprint())
+
+    def test_hash_and_eq_agree(self):
+        experiment = generate_experiments(self.config)[1]
+        config = dict(self.config)
+        config['Xy'] = {'lagged':{}} # Another feature variant
+        variant = Experiment(config, experiment.model, experiment.parameters)
+        self.assertNotEqual(variant, experiment)
+        self.assertEqual(len(set([experiment, variant, Experiment(dict(self.config), experiment.model, experiment.parameters)])), 2)
+
 
 
 class datasetTest(unittest.TestCase):
@@ -167,6 +218,989 @@ class datasetTest(unittest.TestCase):
          self.assertIsInstance(labels, np.ndarray)
 
 
+class FoldSlicerTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {'cols':{'toiletname':'ToiletID', 'date':'Collection_Date'},
+        'Xy':{'response_f':{'variable':'f'}, 'response_u':{'variable':'u'}}}
+        days = [datetime(2012,1,1) + timedelta(days=d) for d in range(0,6)]
+        #t3 only appears on the last four days
+        toilets = ['t2','t1']*6 + ['t3']*4
+        dates = [d for d in days for t in range(0,2)] + days[2:]
+        self.dataset = pd.DataFrame.from_dict({'ToiletID':toilets, 'Collection_Date':dates,
+        'w':range(0,16), 'f':range(100,116), 'u':range(200,216)})
+        self.dataset['response_f'] = self.dataset['f']
+        self.dataset['response_u'] = self.dataset['u']
+        self.dataset.loc[3,'w'] = np.nan
+        self.slicer = FoldSlicer(self.dataset.iloc[::-1], None, self.config)
+
+    def test_split(self):
+        fold = {'train_start':datetime(2012,1,1), 'train_end':datetime(2012,1,2), 'test_start':datetime(2012,1,3), 'test_end':datetime(2012,1,4)}
+        features_train, labels_train_f, labels_train_u, features_test, labels_test_f, labels_test_u, _ = self.slicer.split(fold)
+        self.assertEqual(sorted(features_train.columns), ['Collection_Date','ToiletID','w'])
+        self.assertEqual(list(features_train['ToiletID']), ['t1','t2','t1','t2'])
+        self.assertEqual(list(features_train['w']), [1,0,0,2])
+        self.assertEqual(list(labels_train_u['response']), [201,200,203,202])
+        #t3 is not contiguous in the fold
+        self.assertEqual(list(features_test['ToiletID']), ['t1','t2','t1','t2'])
+        self.assertEqual(list(labels_test_f['response']), [105,104,107,106])
+
+    def test_split_contiguous(self):
+        fold = {'train_start':datetime(2012,1,3), 'train_end':datetime(2012,1,4), 'test_start':datetime(2012,1,5), 'test_end':datetime(2012,1,6)}
+        features_train, _, _, features_test, _, labels_test_u, _ = self.slicer.split(fold)
+        self.assertEqual(len(features_train), 6)
+        self.assertEqual(list(features_test['ToiletID']), ['t1','t2','t3']*2)
+        self.assertEqual(list(labels_test_u['response']), [209,208,214,211,210,215])
+
+
+class IntervalIndexTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(2)
+        self.starts = np.random.randint(0, 100, 300)
+        self.ends = self.starts + np.random.randint(0, 20, 300)
+        self.keys = np.array(['t%i' %(ii % 50) for ii in range(300)], dtype=object)
+        self.index = IntervalIndex(self.keys, self.starts, self.ends)
+
+    def test_overlapping(self):
+        for start, end in [(0, 0), (5, 5), (50, 60), (118, 130), (-10, -1), (30, 31)]:
+            expected = (self.starts <= end) & (self.ends >= start)
+            self.assertEqual(list(self.index.positions(start, end)), list(np.flatnonzero(expected)))
+            self.assertEqual(list(self.index.overlapping(start, end)), sorted(set(self.keys[expected])))
+            covering = (self.starts <= start) & (self.ends >= end)
+            self.assertEqual(list(self.index.covering(start, end)), sorted(set(self.keys[covering])))
+
+    def test_from_runs(self):
+        index = IntervalIndex.from_runs(['a','a','a','b','a','b',None], [1,2,4,7,5,7,3])
+        self.assertEqual(sorted(zip(index.keys, index.starts, index.ends)), [('a',1,2), ('a',4,5), ('b',7,7)])
+        self.assertEqual(list(index.overlapping(3)), [])
+        self.assertEqual(list(index.covering(4, 5)), ['a'])
+
+    def test_by_group(self):
+        memberships = IntervalIndex.by_group(['t1','t2','t1','t1'], [1,1,2,5], ['r1','r1','r1','r2'])
+        self.assertEqual(sorted(memberships.keys()), ['r1','r2'])
+        self.assertEqual(list(memberships['r1'].overlapping(2, 9)), ['t1'])
+        self.assertEqual(list(memberships['r2'].overlapping(0, 4)), [])
+        self.assertEqual(list(day_points([datetime(1970,1,3)])), [2])
+
+
+class DailyFeaturesTest(unittest.TestCase):
+    def setUp(self):
+        #t1 misses 2012-01-03, t2 starts on 2012-01-02
+        self.dataset = pd.DataFrame.from_dict({'ToiletID':['t1','t1','t1','t2','t2','t1'],
+         'Collection_Date':[datetime(2012,1,2), datetime(2012,1,1), datetime(2012,1,4), datetime(2012,1,2), datetime(2012,1,3), datetime(2012,1,5)],
+         'y':[2.0, 1.0, 4.0, 20.0, np.nan, 5.0]})
+
+    def test_lag_and_lead(self):
+        daily = add_daily_features(self.dataset.copy(), {'y':{'function':['lag','lead'], 'rows':[1,2]}})
+        self.assertEqual(list(daily['y_lag1'].fillna(-1)), [1.0, -1, -1, -1, 20.0, 4.0])
+        self.assertEqual(list(daily['y_lag2'].fillna(-1)), [-1, -1, 2.0, -1, -1, -1])
+        self.assertEqual(list(daily['y_lead1'].fillna(-1)), [-1, 2.0, 5.0, -1, -1, -1])
+
+    def test_rolling(self):
+        daily = add_daily_features(self.dataset.copy(), {'y':{'function':['rolling_sum','rolling_mean'], 'rows':[3]}})
+        self.assertEqual(list(daily['y_rolling_sum3'].fillna(-1)), [1.0, -1, 3.0, -1, 20.0, 6.0])
+        self.assertEqual(list(daily['y_rolling_mean3'].fillna(-1)), [1.0, -1, 1.5, -1, 20.0, 3.0])
+
+
+class CopyCursor(object):
+    """
+    Records the COPY statements and data instead of sending them to postgres.
+    """
+    def __init__(self):
+        self.statements = []
+        self.data = []
+    def copy_expert(self, sql, buf):
+        self.statements.append(sql)
+        self.data.append(buf.read())
+
+class WriterTest(unittest.TestCase):
+    def setUp(self):
+        self.frame = pd.DataFrame.from_dict({'ToiletID':['t1','t2','t3'], 'w':[1.5, np.nan, 3.0]})[['ToiletID','w']]
+
+    def test_copy_chunks(self):
+        cursor = CopyCursor()
+        copy_chunks(self.frame, cursor, 'output."predictions"', index=False, chunksize=2)
+        self.assertEqual(len(cursor.statements), 2)
+        self.assertEqual(cursor.statements[0], 'COPY output."predictions" ("ToiletID","w") FROM STDIN WITH CSV')
+        self.assertEqual(cursor.data[0].splitlines(), ['t1,1.5', 't2,'])
+
+    def test_copy_chunks_index(self):
+        cursor = CopyCursor()
+        copy_chunks(self.frame, cursor, 'modeling."dataset"')
+        self.assertEqual(cursor.statements[0], 'COPY modeling."dataset" ("index","ToiletID","w") FROM STDIN WITH CSV')
+        self.assertEqual(cursor.data[0].splitlines()[2], '2,t3,3.0')
+
+    def test_write_frame_fallback(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        self.assertEqual(write_frame(self.frame, 'predictions', None, engine), 3)
+        self.assertEqual(len(pd.read_sql('select * from predictions', engine)), 3)
+
+    def test_swap_replace_twice(self):
+        # The swap path on sqlite posing as postgres, the COPY replaced by INSERTs: index names
+        # live in one namespace per schema on both
+        engine = sqlalchemy.create_engine('sqlite://')
+        engine.dialect.name = 'postgresql'
+        def insert_chunks(frame, cursor, table, index=True, chunksize=50000):
+            frame = frame.reset_index() if index else frame
+            cursor.executemany('INSERT INTO %s VALUES (%s)' %(table, ','.join(['?'] * frame.shape[1])),
+                               [tuple(None if pd.isnull(value) else value for value in row) for row in frame.values.tolist()])
+        copy = writer.copy_chunks
+        writer.copy_chunks = insert_chunks
+        try:
+            for _ in range(2):
+                self.assertEqual(write_frame(self.frame, 'dataset', 'main', engine, if_exists='replace'), 3)
+        finally:
+            writer.copy_chunks = copy
+        engine.dialect.name = 'sqlite'
+        self.assertEqual(list(pd.read_sql('select * from dataset', engine)['ToiletID']), ['t1','t2','t3'])
+        self.assertEqual(sqlalchemy.inspect(engine).get_table_names(), ['dataset'])
+        self.assertEqual([ix['name'] for ix in sqlalchemy.inspect(engine).get_indexes('dataset')], ['ix_main_dataset_index'])
+
+    def test_frame_buffer(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        buffer = FrameBuffer()
+        buffer.append(self.frame, 'predictions', None, index=False)
+        buffer.append(self.frame.iloc[:1], 'predictions', None, index=False)
+        buffer.append(self.frame, 'experiments', None)
+        self.assertEqual(len(buffer), 7)
+        self.assertEqual(buffer.flush(engine), 7)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(list(pd.read_sql('select * from predictions', engine)['ToiletID']), ['t1','t2','t3','t1'])
+        self.assertEqual(list(pd.read_sql('select * from experiments', engine).columns), ['index','ToiletID','w'])
+
+
+class DatasetCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dataset = pd.DataFrame.from_dict({'ToiletID':['t2','t1','t1','t2','t1'],
+         'Collection_Date':[datetime(2012,1,2), datetime(2012,1,1), datetime(2012,1,2), datetime(2012,1,1), datetime(2012,1,3)],
+         'w':[3.0,5.0,7.0,8.0,np.nan], 'Area':['a', None, 'b', 'a', 'b']})
+        self.cache = DatasetCache(self.directory, {'features':{'w':[]}}, {'n_rows':5, 'max_date':'2012-01-03'})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fingerprint(self):
+        self.assertEqual(config_fingerprint({'a':[1], 'b':{'c':2}}), config_fingerprint({'b':{'c':2}, 'a':[1]}))
+        self.assertNotEqual(config_fingerprint({'a':[1]}), config_fingerprint({'a':[2]}))
+
+    def test_roundtrip(self):
+        self.cache.write('dataset', self.dataset)
+        self.cache.write('toilet_route', self.dataset[['ToiletID','Collection_Date','Area']])
+        self.assertTrue(self.cache.exists())
+        fold = self.cache.read('dataset', start=datetime(2012,1,2), end=datetime(2012,1,3))
+        self.assertEqual(len(fold), 3)
+        self.assertEqual(list(fold['ToiletID']), ['t1','t2','t1'])
+        self.assertEqual(list(fold['Area']), ['b','a','b'])
+        self.assertTrue(np.isnan(fold['w'].values[2]))
+        self.assertTrue(self.cache.read('toilet_route')['Area'].isnull().values[0])
+
+    def test_other_keys_are_pruned(self):
+        self.cache.write('dataset', self.dataset)
+        other = DatasetCache(self.directory, {'features':{'w':[]}}, {'n_rows':6, 'max_date':'2012-01-04'})
+        self.assertFalse(other.exists())
+        other.write('dataset', self.dataset)
+        self.assertFalse(os.path.exists(self.cache.path))
+
+    def test_prune_keeps_other_directories(self):
+        unrelated = os.path.join(self.cache.root, 'data')
+        os.makedirs(os.path.join(unrelated, 'dataset'))
+        self.cache.write('dataset', self.dataset)
+        self.assertTrue(os.path.exists(unrelated))
+
+
+class SqliteBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_db_engine({'backend':'sqlite', 'path':self.directory})
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, create_db_engine, {'backend':'oracle'})
+
+    def test_schemas_are_attached(self):
+        dataset = pd.DataFrame.from_dict({'ToiletID':['t1','t1','t2'],
+         'Collection_Date':[datetime(2012,1,1), datetime(2012,1,2), datetime(2012,1,2)], 'w':[1.0,2.0,3.0]})
+        write_frame(dataset, 'dataset', 'modeling', self.engine, if_exists='replace', index=False)
+        write_frame(dataset[['ToiletID','Collection_Date']], 'toilet_route', 'modeling', self.engine, if_exists='replace', index=False)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'modeling.db')))
+        db = {'connection':self.engine, 'cache':None}
+        dataset, toilet_routes = load_modeling_tables(db, start=datetime(2012,1,2), end=datetime(2012,1,2))
+        self.assertEqual(list(dataset['w']), [2.0,3.0])
+        self.assertEqual(dataset['Collection_Date'].dtype, np.dtype('datetime64[ns]'))
+
+    def test_fold_query(self):
+        dataset = pd.DataFrame.from_dict({'ToiletID':['t1','t1','t1','t2','t2'],
+         'Collection_Date':[datetime(2012,1,1), datetime(2012,1,2), datetime(2012,1,3), datetime(2012,1,2), datetime(2012,1,3)],
+         'w':[1.0,2.0,3.0,4.0,5.0], 'Area_b':[0,1,0,1,0], 'unused':[0,0,0,0,0],
+         'response_f':[1.0,2.0,3.0,4.0,5.0], 'response_u':[1.0,2.0,3.0,4.0,5.0]})
+        write_frame(dataset, 'dataset', 'modeling', self.engine, if_exists='replace')
+        write_frame(dataset[['ToiletID','Collection_Date']], 'toilet_route', 'modeling', self.engine, if_exists='replace', index=False)
+        config = {'cols':{'toiletname':'ToiletID', 'date':'Collection_Date'},
+                  'Xy':{'unique':{'ToiletID':[], 'Collection_Date':[]}, 'features':{'w':[], 'Area':[]}, 'lagged':{},
+                        'response_f':{'variable':'w'}, 'response_u':{'variable':'w'}}}
+        self.assertEqual(sorted(needed_columns(config, dataset.columns)), ['Area_b','Collection_Date','ToiletID','response_f','response_u','w'])
+        db = {'connection':self.engine, 'cache':None}
+        fold, toilet_routes = load_modeling_tables(db, datetime(2012,1,1), datetime(2012,1,3), config=config, contiguous=True)
+        self.assertEqual(list(fold['ToiletID'].unique()), ['t1'])
+        self.assertNotIn('unused', fold.columns)
+        self.assertEqual(len(load_modeling_tables(db, datetime(2012,1,2), datetime(2012,1,3), config=config, contiguous=True)[0]), 4)
+        self.assertEqual(len(load_modeling_tables(db, None, datetime(2012,1,1))[1]), 1)
+
+
+class BrokenCursor(object):
+    def execute(self, statement):
+        raise Exception('server closed the connection unexpectedly')
+    def close(self):
+        pass
+
+
+class BrokenConnection(object):
+    def cursor(self):
+        return(BrokenCursor())
+
+
+class ConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config_db = {'backend':'sqlite', 'path':self.directory}
+
+    def tearDown(self):
+        dispose_engines()
+        shutil.rmtree(self.directory)
+
+    def test_one_engine_per_process(self):
+        self.assertIs(get_engine(self.config_db), get_engine(dict(self.config_db)))
+
+    def test_thread_connections(self):
+        engine = get_engine(self.config_db)
+        mine = thread_connection(engine)
+        self.assertIs(thread_connection(engine), mine)
+        theirs = []
+        def worker():
+            theirs.append(thread_connection(engine))
+            release_thread_connection(engine)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertIsNot(theirs[0], mine)
+        mine.close()
+        self.assertIsNot(thread_connection(engine), mine)
+        release_thread_connection(engine)
+        self.assertEqual(pool_stats(engine)['checkouts'], 3)
+
+    def test_dead_connections_are_replaced(self):
+        self.assertRaises(sqlalchemy.exc.DisconnectionError, ping_connection, BrokenConnection(), None, None)
+
+
+def flaky_run_models_on_folds(folds, loss_function, db, experiment, slicer=None, buffer=None, done=frozenset(), fold_ids=None):
+    model_id = experiment.fingerprint()
+    for i_fold in (range(len(folds)) if fold_ids is None else fold_ids):
+        if (model_id, i_fold) in done:
+            continue
+        if experiment.model == 'broken' and i_fold == 1:
+            raise ValueError("Broken experiment")
+        buffer.append(pd.DataFrame({'model_id':[experiment.parameters['id']], 'fold_id':[i_fold],
+                                    'pid':[os.getpid()]}), 'evaluations', 'output', index=False)
+        buffer.append(pd.DataFrame({'id':[model_id], 'fold_id':[i_fold], 'model':[experiment.model]}), 'experiments', 'output')
+
+
+class ParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config_db = {'backend':'sqlite', 'path':self.directory}
+        self.db = {'engine':get_engine(self.config_db)}
+        self.db['connection'] = self.db['engine'].connect()
+        self.experiments = [Experiment({}, 'broken' if ii == 3 else 'Lasso', {'id':ii}) for ii in range(6)]
+        self.folds = [{'train_start':datetime(2016,1,1), 'test_end':datetime(2016,1,8)},
+                      {'train_start':datetime(2016,1,8), 'test_end':datetime(2016,1,15)}]
+        self.run_models_on_folds = parallel.run_models_on_folds
+        parallel.run_models_on_folds = flaky_run_models_on_folds
+
+    def tearDown(self):
+        parallel.run_models_on_folds = self.run_models_on_folds
+        self.db['connection'].close()
+        dispose_engines()
+        shutil.rmtree(self.directory)
+
+    def check(self, workers):
+        failures = run_experiments(self.experiments, self.folds, self.db, None, self.config_db, workers=workers,
+                                   log_file=os.path.join(self.directory, 'default.log'))
+        self.assertEqual([task for task, _ in failures], [(3, 1)])
+        self.assertTrue('Broken experiment' in failures[0][1])
+        # The folds are written one by one: the fold of the broken experiment that ran is kept
+        evaluations = pd.read_sql('select * from output.evaluations', self.db['connection'])
+        self.assertEqual(sorted(evaluations['model_id']), [0, 0, 1, 1, 2, 2, 3, 4, 4, 5, 5])
+        return(evaluations)
+
+    def test_sequential(self):
+        evaluations = self.check(1)
+        self.assertEqual(set(evaluations['pid']), set([os.getpid()]))
+
+    def test_workers(self):
+        evaluations = self.check(3)
+        self.assertFalse(os.getpid() in set(evaluations['pid']))
+        logs = [name for name in os.listdir(self.directory) if name.startswith('default.log.')]
+        self.assertTrue(len(logs) >= 1)
+
+    def test_resume(self):
+        self.check(2)
+        # The broken experiment is fixed and a fold is added: only the missing pairs run
+        self.experiments[3] = Experiment({}, 'Lasso', {'id':3})
+        self.folds.append({'train_start':datetime(2016,1,15), 'test_end':datetime(2016,1,22)})
+        self.assertEqual(run_experiments(self.experiments, self.folds, self.db, None, self.config_db, workers=2,
+                                         log_file=os.path.join(self.directory, 'default.log')), [])
+        evaluations = pd.read_sql('select * from output.evaluations', self.db['connection'])
+        # The fixed experiment is a new one (its fold 0 of the broken one stays)
+        self.assertEqual(len(evaluations), 19)
+        self.assertEqual(sorted(evaluations.loc[evaluations['model_id'] == 3, 'fold_id']), [0, 0, 1, 2])
+        self.assertEqual(sorted(evaluations.loc[evaluations['model_id'] == 0, 'fold_id']), [0, 1, 2])
+        self.assertEqual(run_experiments(self.experiments, self.folds, self.db, None, self.config_db, resume=True), [])
+        self.assertEqual(len(pd.read_sql('select * from output.evaluations', self.db['connection'])), 19)
+
+
+class IngestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_db_engine({'backend':'sqlite', 'path':self.directory})
+        self.collections = pd.DataFrame.from_dict({'ToiletID':['t1','t2','t1','t2','t1','t2'],
+         'Collection_Date':[datetime(2012,1,1), datetime(2012,1,1), datetime(2012,1,2), datetime(2012,1,2), datetime(2012,1,3), datetime(2012,1,3)],
+         'FecesContainer_percent':[10.0,20.0,30.0,40.0,50.0,60.0],
+         'UrineContainer_percent':[1.0,2.0,3.0,4.0,5.0,np.nan],
+         'month':[1,1,1,1,1,1],
+         'Area':[None,None,'a','b','a','b']})
+        write_frame(self.collections, 'toiletcollection', 'premodeling', self.engine, if_exists='replace', index=False)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_encode_strings(self):
+        vocabulary = ['b']
+        codes = encode_strings(np.array(['a', None, 'b', 'a'], dtype=object), vocabulary)
+        self.assertEqual(list(codes), [1,-1,0,1])
+        self.assertEqual(vocabulary, ['b','a'])
+
+    def test_read_compact(self):
+        dataset = read_compact('select * from premodeling.toiletcollection', self.engine,
+                               chunksize=2, parse_dates=['Collection_Date'], keep=['ToiletID'])
+        self.assertEqual(len(dataset), 6)
+        self.assertEqual(dataset['FecesContainer_percent'].dtype, np.float32)
+        self.assertEqual(dataset['month'].dtype, np.int8)
+        self.assertEqual(str(dataset['Area'].dtype), 'category')
+        self.assertEqual(list(dataset['Area'].astype(object).fillna('')), ['','','a','b','a','b'])
+        self.assertEqual(dataset['ToiletID'].dtype, object)
+        self.assertTrue(np.isnan(dataset['UrineContainer_percent'].values[5]))
+
+    def test_read_compact_sorted_categories(self):
+        # b is seen first, in every chunking: the categories (and the dummy dropped) are as for strings
+        statement = 'select * from premodeling.toiletcollection order by "Area" desc'
+        for chunksize in [None, 1, 4]:
+            dataset = read_compact(statement, self.engine, chunksize=chunksize, parse_dates=['Collection_Date'], keep=['ToiletID'])
+            self.assertEqual(list(dataset['Area'].cat.categories), ['a','b'])
+            self.assertEqual(list(dataset['Area'].astype(object).fillna('')), ['b','b','a','a','',''])
+            dummies = pd.get_dummies(dataset[['Area']], columns=['Area'], drop_first=True)
+            self.assertEqual(list(dummies.columns), list(pd.get_dummies(pd.DataFrame({'Area':dataset['Area'].astype(object)}), columns=['Area'], drop_first=True).columns))
+
+    def test_grab_collections_data(self):
+        config = {'cols':{'toiletname':'ToiletID', 'date':'Collection_Date', 'route':'Area'},
+                  'db':{'chunksize':4},
+                  'Xy':{'response_f':{'variable':'FecesContainer_percent', 'split':[]},
+                        'response_u':{'variable':'UrineContainer_percent', 'split':[]},
+                        'features':{'month':[], 'Area':[]},
+                        'unique':{'ToiletID':[], 'Collection_Date':[]},
+                        'lagged':{'FecesContainer_percent':{'function':'lag', 'rows':[1]}}}}
+        db = {'connection':self.engine, 'database':'premodeling', 'table':'toiletcollection', 'cache':None}
+        yf, yu, x, toilet_route = grab_collections_data(db, config, logging.getLogger('test'))
+        self.assertEqual(len(x), 6)
+        self.assertEqual(list(yf['response']), [10.0,30.0,50.0,20.0,40.0,60.0])
+        self.assertEqual(sorted(x.columns), ['Collection_Date','FecesContainer_percent_lag1','ToiletID','month'])
+        self.assertEqual(x['month'].dtype, np.int8)
+        self.assertEqual(len(pd.read_sql('select * from modeling.dataset', self.engine)), 6)
+        indexes = pd.read_sql("select name from modeling.sqlite_master where type = 'index'", self.engine)
+        self.assertIn('ix_dataset_collection_date_toiletid', list(indexes['name']))
+
+        config['Xy']['sparse_categoricals'] = True
+        config['Xy']['features']['Route_Name'] = []
+        self.collections['Route_Name'] = ['r1','r2','r1','r2','r1','r2']
+        write_frame(self.collections, 'toiletcollection', 'premodeling', self.engine, if_exists='replace', index=False)
+        x = grab_collections_data(db, config, logging.getLogger('test'))[2]
+        self.assertEqual(list(x['Route_Name'].astype(object)), ['r1','r1','r1','r2','r2','r2'])
+        encoder = CategoricalEncoder.from_db(self.engine)
+        self.assertEqual(encoder.vocabulary, {'Route_Name':['r1','r2']})
+
+
+class FeatureStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_db_engine({'backend':'sqlite', 'path':self.directory})
+        self.collections = pd.DataFrame.from_dict({'ToiletID':['t1','t2','t1','t2'],
+         'Collection_Date':[datetime(2012,1,1), datetime(2012,1,1), datetime(2012,1,2), datetime(2012,1,2)],
+         'FecesContainer_percent':[10.0,20.0,30.0,40.0], 'UrineContainer_percent':[1.0,2.0,3.0,4.0],
+         'Area':['a','b','a','b']})
+        write_frame(self.collections, 'toiletcollection', 'premodeling', self.engine, if_exists='replace', index=False)
+        self.config = {'cols':{'toiletname':'ToiletID', 'date':'Collection_Date', 'route':'Area'},
+                  'db':{},
+                  'Xy':{'response_f':{'variable':'FecesContainer_percent', 'split':[]},
+                        'response_u':{'variable':'UrineContainer_percent', 'split':[]},
+                        'features':{'Area':[]},
+                        'unique':{'ToiletID':[], 'Collection_Date':[]},
+                        'lagged':{'FecesContainer_percent':{'function':'lag', 'rows':[1]}}},
+                  'Xy_variants':[{'lagged':{}}]}
+        self.db = {'connection':self.engine, 'database':'premodeling', 'table':'toiletcollection', 'cache':None}
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_variants(self):
+        variants = feature_variants(self.config)
+        self.assertEqual(len(variants), 2)
+        self.assertEqual(variants[1]['lagged'], {})
+        self.assertEqual(self.config['Xy']['lagged'].keys(), ['FecesContainer_percent'])
+
+    def test_materialize(self):
+        store = FeatureStore(self.db, self.config)
+        self.assertTrue(store.materialize())
+        self.assertFalse(FeatureStore(self.db, self.config).materialize())
+        self.assertEqual(self.db['tables'], store.tables)
+        self.assertEqual(store.lineage()['n_rows'], 4)
+
+        config = dict(self.config)
+        config['Xy'] = feature_variants(self.config)[1]
+        other = FeatureStore(self.db, config)
+        self.assertTrue(other.materialize())
+        self.assertNotEqual(other.tables['dataset'], store.tables['dataset'])
+        lagged = pd.read_sql('select * from modeling.%s' %(store.tables['dataset']), self.engine)
+        self.assertIn('FecesContainer_percent_lag1', lagged.columns)
+
+        # New source rows make the materialization stale
+        write_frame(self.collections.iloc[:1], 'toiletcollection', 'premodeling', self.engine, index=False)
+        self.assertTrue(FeatureStore(self.db, self.config).needs_build())
+
+
+class EncodingTest(unittest.TestCase):
+    def setUp(self):
+        self.train = pd.DataFrame.from_dict({'ToiletID':['t1','t2','t1','t2'],
+         'Collection_Date':[datetime(2012,1,1), datetime(2012,1,1), datetime(2012,1,2), datetime(2012,1,2)],
+         'w':[1.0,2.0,3.0,4.0], 'Area':['a','b','c',None]})
+        self.encoder = CategoricalEncoder().fit(self.train, ['Area'])
+        self.config = {'Xy':{'lagged':{}}, 'cols':{'toiletname':'ToiletID', 'date':'Collection_Date', 'feces':'y'}}
+
+    def test_transform(self):
+        test = pd.DataFrame.from_dict({'w':[5.0,6.0,7.0], 'Area':['c','a','z']})
+        matrix, names = self.encoder.transform(test[['w','Area']])
+        self.assertTrue(sparse.isspmatrix_csr(matrix))
+        self.assertEqual(list(names), ['w','Area_b','Area_c'])
+        self.assertEqual(matrix.toarray().tolist(), [[5.0,0.0,1.0],[6.0,0.0,0.0],[7.0,0.0,0.0]])
+        self.assertIsInstance(self.encoder.transform(test, dense=True)[0], np.ndarray)
+
+    def test_same_columns_as_get_dummies(self):
+        train = self.train.assign(Area=['c','a','b','a'])
+        matrix, names = CategoricalEncoder().fit(train, ['Area']).transform(train[['w','Area']], dense=True)
+        dummies = pd.get_dummies(train[['w','Area']], columns=['Area'], drop_first=True)
+        self.assertEqual(list(names), list(dummies.columns))
+        self.assertEqual(matrix.tolist(), dummies.values.astype(np.float64).tolist())
+
+    def test_persistent_vocabulary(self):
+        reloaded = CategoricalEncoder.from_frame(self.encoder.to_frame())
+        self.assertEqual(reloaded.vocabulary, {'Area':['a','b','c']})
+        reloaded.fit(pd.DataFrame.from_dict({'Area':['d','a']}), ['Area'])
+        self.assertEqual(reloaded.vocabulary['Area'], ['a','b','c','d'])
+
+    def test_sparse_models(self):
+        labels = pd.DataFrame.from_dict({'response':[1.0,2.0,3.0,4.0]})
+        lasso = WasteModel('Lasso', {'alpha':0.1}, self.config, self.train, labels, encoder=self.encoder)
+        self.assertEqual(list(lasso.feature_names), ['w','Area_b','Area_c'])
+        forest = WasteModel('RandomForest', {'n_estimators':2}, self.config, self.train, labels, encoder=self.encoder)
+        self.assertEqual(len(forest.trained_model.feature_importances_), 3)
+
+
+class TimeseriesTest(unittest.TestCase):
+    def setUp(self):
+        self.collects = pd.DataFrame.from_dict({'ToiletID':['t1','t1','t2','t2','t3'],
+         'Collection_Date':[datetime(2012,1,1), datetime(2012,1,4), datetime(2010,12,30), datetime(2011,1,2), datetime(2010,5,1)],
+         'Feces_kg_day':[1.0,2.0,3.0,4.0,5.0]})
+
+    def test_complete_calendar(self):
+        completed = complete_calendar(self.collects, start=datetime(2011,1,1))
+        t1 = completed.loc[completed['ToiletID']=='t1']
+        self.assertEqual(list(t1['Collection_Date']), list(pd.date_range('2012-01-01', '2012-01-04')))
+        self.assertEqual(list(t1['Feces_kg_day'].isnull()), [False, True, True, False])
+        # Observed days before the start are kept, no days are added before it
+        t2 = completed.loc[completed['ToiletID']=='t2']
+        self.assertEqual(list(t2['Collection_Date']), [datetime(2010,12,30), datetime(2011,1,1), datetime(2011,1,2)])
+        self.assertEqual(len(completed.loc[completed['ToiletID']=='t3']), 1)
+
+    def test_events_within_window(self):
+        frame = pd.DataFrame.from_dict({'ToiletID':['t1']*5 + ['t2']*2,
+         'Collection_Date':list(pd.date_range('2012-01-01', '2012-01-05')) + [datetime(2012,1,1), datetime(2012,1,9)]})
+        cases = pd.DataFrame.from_dict({'ToiletID':['t1','t2','t3'],
+         'Collection_Date':[datetime(2012,1,4), datetime(2012,1,9), datetime(2012,1,1)]})
+        self.assertEqual(list(events_within_window(frame, cases, window=2)), [0,1,1,1,0, 0,1])
+        self.assertEqual(list(events_within_window(frame, cases, window=2, direction='backward')), [0,0,0,1,1, 0,1])
+        self.assertEqual(list(events_within_window(frame, cases.iloc[:0], window=2)), [0]*7)
+
+    def interpolate_loop(self, collect_toilets, missed_code_set_interpolate, missed_code_set_0):
+        """
+        The per toilet and per row loop ProcessCollectionsData.py used (missing Ids tested with isnull)
+        """
+        collect_toilets = collect_toilets.copy()
+        max_linear_int={}
+        for ToiletId in collect_toilets['ToiletID'].unique():
+            dfId = collect_toilets[collect_toilets['ToiletID']==ToiletId].sort_values('Collection_Date')
+            count_int=0
+            max_count_int=0
+            ind_interpolate=list()
+            for ind in dfId.index:
+                if dfId.loc[ind,'Missed_Collection_Code'] in missed_code_set_interpolate:
+                    count_int=count_int+1
+                    ind_interpolate.append(ind)
+                elif dfId.loc[ind,'Missed_Collection_Code'] in missed_code_set_0:
+                    collect_toilets.loc[ind,'Feces_kg_day']=0
+                    collect_toilets.loc[ind,'Urine_kg_day']=0
+                elif pd.isnull(dfId.loc[ind,'Id']):
+                    count_int=count_int+1
+                    ind_interpolate.append(ind)
+                else:
+                    if (count_int>0):
+                        count_int=count_int+1
+                        collect_toilets.loc[ind_interpolate,'Feces_kg_day']=dfId.loc[ind,'Feces_kg_day']/count_int
+                        collect_toilets.loc[ind_interpolate,'Urine_kg_day']=dfId.loc[ind,'Urine_kg_day']/count_int
+                        if (count_int>max_count_int):
+                            max_count_int=count_int
+                        count_int=0
+                        ind_interpolate=list()
+            max_linear_int[ToiletId] = max_count_int
+        return(collect_toilets, max_linear_int)
+
+    def test_interpolate_missed_collections(self):
+        rng = np.random.RandomState(0)
+        n = 300
+        collects = pd.DataFrame.from_dict({'ToiletID':rng.choice(['t1','t2','t3','t4'], n),
+         'Collection_Date':[datetime(2012,1,1) + timedelta(days=int(dd)) for dd in rng.permutation(n)],
+         'Missed_Collection_Code':rng.choice(['1','5','8','9','3', None, None, None], n),
+         'Id':rng.choice(['a', None], n, p=[0.8,0.2]),
+         'Feces_kg_day':rng.uniform(0, 50, n), 'Urine_kg_day':rng.uniform(0, 50, n)})
+        codes_interpolate, codes_0 = set(['5','8','9']), set(['1','2','3','4','6','7'])
+        expected, expected_max = self.interpolate_loop(collects, codes_interpolate, codes_0)
+        result, max_linear_int = interpolate_missed_collections(collects, codes_interpolate, codes_0)
+        np.testing.assert_allclose(result['Feces_kg_day'].values, expected['Feces_kg_day'].values)
+        np.testing.assert_allclose(result['Urine_kg_day'].values, expected['Urine_kg_day'].values)
+        self.assertEqual(max_linear_int.to_dict(), expected_max)
+
+    def test_days_since_event(self):
+        frame = pd.DataFrame.from_dict({'ToiletID':['t2','t1','t1','t1','t1','t1','t2'],
+         'Collection_Date':[datetime(2012,1,2), datetime(2012,1,1), datetime(2012,1,2), datetime(2012,1,3), datetime(2012,1,4), datetime(2012,1,5), datetime(2012,1,1)],
+         'Feces_Collected':[0,0,0,1,0,0,1]})
+        self.assertEqual(list(days_since_event(frame, 'Feces_Collected')), [1,0,1,0,1,2,0])
+
+
+class WeatherTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_db_engine({'backend':'sqlite', 'path':self.directory})
+        line = "%4i %02i %02i %02i" + "%6i"*8
+        self.lines = {2012: [line %(2012,12,31,0, 215,142,10170,110,26,4,0,-9999),
+                             line %(2012,12,31,6, 185,-9999,10180,130,36,0,-9999,12)],
+                      2013: [line %(2013,1,1,0, -15,120,10160,90,21,7,-9999,-9999)]}
+        for year, lines in self.lines.items():
+            with gzip.open(os.path.join(self.directory, '637400-99999-%i.gz' %(year)), 'wb') as stream:
+                stream.write("\n".join(lines) + "\n")
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_parse_isd_lite(self):
+        with gzip.open(os.path.join(self.directory, '637400-99999-2012.gz'), 'rb') as stream:
+            weather = parse_isd_lite(stream)
+        self.assertEqual(list(weather['date']), [datetime(2012,12,31)]*2)
+        self.assertEqual(list(weather['hour']), [0,6])
+        np.testing.assert_allclose(weather['air_temp'].values, [21.5, 18.5])
+        self.assertTrue(np.isnan(weather['dew_point_temp'].values[1]))
+        np.testing.assert_allclose(weather['sea_level_pressure'].values, [1017.0, 1018.0])
+        self.assertTrue(np.isnan(weather['liquid_precipitation_depth_dimension_six_hours'].values[0]))
+
+    def test_aggregate_daily(self):
+        with gzip.open(os.path.join(self.directory, '637400-99999-2012.gz'), 'rb') as stream:
+            daily = aggregate_daily(parse_isd_lite(stream))
+        self.assertEqual(len(daily), 1)
+        self.assertAlmostEqual(daily['mean_air_temp'][0], 20.0)
+        self.assertAlmostEqual(daily['min_air_temp'][0], 18.5)
+        self.assertAlmostEqual(daily['max_wind_speed_rate'][0], 3.6)
+        self.assertAlmostEqual(daily['sd_air_temp'][0], np.std([21.5, 18.5], ddof=1))
+        self.assertAlmostEqual(daily['mean_precipitation_6hr'][0], 1.2)
+
+    def test_ingest_incremental(self):
+        self.assertEqual(ingest_weather(self.directory, self.engine), [2012, 2013])
+        # Only the last aggregated year is parsed again
+        self.assertEqual(ingest_weather(self.directory, self.engine), [2013])
+        daily = pd.read_sql('select * from input.weather_daily', self.engine, parse_dates=['date'])
+        self.assertEqual(list(daily['date']), [datetime(2012,12,31), datetime(2013,1,1)])
+        self.assertAlmostEqual(daily['mean_air_temp'][1], -1.5)
+
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_db_engine({'backend':'sqlite', 'path':self.directory})
+        self.conn = self.engine.connect()
+        days = [datetime(2012,1,1) + timedelta(days=dd) for dd in range(20)]
+        self.stored = pd.DataFrame.from_dict({'ToiletID':['t1']*20 + ['t2']*20,
+         'Collection_Date':days*2,
+         'Feces_Collected':[1 if dd % 5 == 0 else 0 for dd in range(20)] + [0]*20,
+         'Urine_Collected':[1]*40,
+         'Missed_Collection_Code':[None]*40,
+         'Feces_kg_day':np.arange(40.0)})
+        write_frame(self.stored, 'toiletcollection', 'premodeling', self.conn, if_exists='replace', index=False)
+
+    def tearDown(self):
+        self.conn.close()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_watermark(self):
+        self.assertEqual(read_watermark(self.conn, 'toiletcollection'), None)
+        record_watermark(self.conn, 'toiletcollection', datetime(2012,1,20))
+        record_watermark(self.conn, 'toiletcollection', datetime(2012,1,21))
+        self.assertEqual(read_watermark(self.conn, 'toiletcollection'), pd.Timestamp(datetime(2012,1,21)))
+
+    def test_recompute_starts(self):
+        starts, earliest = recompute_starts(self.conn, pd.Timestamp(datetime(2012,1,20)), set(['5']), set(['1']), max_lookback=15)
+        # t1 is reset on the 11th (the 16th is within the case window of the mark), t2 never is: from its first day
+        self.assertEqual(starts.to_dict(), {'t1': pd.Timestamp(datetime(2012,1,11)), 't2': pd.Timestamp(datetime(2012,1,1))})
+        self.assertEqual(earliest, pd.Timestamp(datetime(2012,1,1)))
+        rows = rows_to_recompute(self.stored, starts, earliest)
+        self.assertEqual(rows.groupby('ToiletID')['Collection_Date'].min().to_dict(),
+                         {'t1': pd.Timestamp(datetime(2012,1,11)), 't2': pd.Timestamp(datetime(2012,1,1))})
+
+    def test_incremental_matches_full(self):
+        # t3 was reset long before the lookback, t4 is not stored in it
+        days = [datetime(2011,12,1) + timedelta(days=dd) for dd in range(20)]
+        older = pd.DataFrame.from_dict({'ToiletID':['t3']*20 + ['t4']*5, 'Collection_Date':days + days[:5],
+         'Feces_Collected':[1] + [0]*24, 'Urine_Collected':[1]*25, 'Missed_Collection_Code':[None]*25,
+         'Feces_kg_day':np.arange(25.0)})
+        write_frame(older, 'toiletcollection', 'premodeling', self.conn, if_exists='append', index=False)
+        later = pd.DataFrame.from_dict({'ToiletID':['t3']*20, 'Collection_Date':[datetime(2012,1,1) + timedelta(days=dd) for dd in range(20)],
+         'Feces_Collected':[0]*20, 'Urine_Collected':[1]*20, 'Missed_Collection_Code':[None]*20, 'Feces_kg_day':np.arange(20.0)})
+        write_frame(later, 'toiletcollection', 'premodeling', self.conn, if_exists='append', index=False)
+        full = pd.concat([older, self.stored, later], ignore_index=True)
+        full['days_since'] = days_since_event(full, 'Feces_Collected')
+        starts, since = recompute_starts(self.conn, pd.Timestamp(datetime(2012,1,20)), set(['5']), set(['1']), max_lookback=15)
+        self.assertEqual(since, pd.Timestamp(datetime(2011,12,1)))
+        self.assertEqual(starts['t4'], pd.Timestamp(datetime(2012,1,5)))
+        rows = rows_to_recompute(full.loc[full['Collection_Date'] >= since], starts, since).copy()
+        rows['incremental'] = days_since_event(rows, 'Feces_Collected')
+        self.assertEqual(rows.loc[rows['ToiletID'] == 't3', 'Collection_Date'].min(), pd.Timestamp(datetime(2011,12,1)))
+        self.assertEqual(list(rows['incremental']), list(rows['days_since']))
+
+    def test_replace_rows(self):
+        new = pd.DataFrame.from_dict({'ToiletID':['t1','t1','t1'],
+         'Collection_Date':[datetime(2012,1,19), datetime(2012,1,20), datetime(2012,1,21)],
+         'Feces_Collected':[1,1,1], 'Urine_Collected':[1,1,1], 'Missed_Collection_Code':[None]*3,
+         'Feces_kg_day':[100.0,101.0,102.0]})
+        replace_rows(new, self.conn, 'toiletcollection', 'premodeling', index=False)
+        stored = pd.read_sql('select * from premodeling.toiletcollection', self.conn, parse_dates=['Collection_Date'])
+        self.assertEqual(len(stored), 41)
+        t1 = stored[stored['ToiletID'] == 't1'].sort_values(by='Collection_Date')
+        self.assertEqual(list(t1['Feces_kg_day'])[-4:], [17.0, 100.0, 101.0, 102.0])
+        self.assertFalse(self.engine.dialect.has_table(self.conn, 'toiletcollection_starts', schema='premodeling'))
+
+    def test_replace_rows_index(self):
+        write_frame(self.stored, 'toiletcollection', 'premodeling', self.conn, if_exists='replace')
+        new = self.stored.iloc[15:25].reset_index(drop=True) # As recomputed: numbered from 0
+        replace_rows(new, self.conn, 'toiletcollection', 'premodeling')
+        replace_rows(new, self.conn, 'toiletcollection', 'premodeling')
+        stored = pd.read_sql('select * from premodeling.toiletcollection', self.conn)
+        self.assertEqual(len(stored), 25) # t2 is replaced from its first day in NEW on
+        self.assertTrue(stored['index'].is_unique)
+
+
+class StageRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_db_engine({'backend':'sqlite', 'path':self.directory})
+        write_frame(pd.DataFrame({'x':[1,2,3]}), 'source', 'input', self.engine, if_exists='replace', index=False)
+        self.calls = []
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def build(self, resume_from=None):
+        runner = StageRunner(os.path.join(self.directory, 'checkpoints'), self.engine, resume_from=resume_from)
+        def read():
+            self.calls.append('read')
+            return(pd.read_sql('select * from input.source', self.engine))
+        def double(frame):
+            self.calls.append('double')
+            return(frame * 2)
+        source = runner.run('read', read, sources=[('input.source', None)])
+        result = runner.run('double', lambda: double(source), upstream=['read'])
+        return(runner, result)
+
+    def test_checkpoints(self):
+        runner, result = self.build()
+        self.assertEqual(list(result['x']), [2,4,6])
+        runner, result = self.build()
+        self.assertEqual(self.calls, ['read', 'double'])
+        self.assertEqual(list(runner.summary()['origin']), ['checkpoint', 'checkpoint'])
+        # A changed source recomputes the stage and the ones that depend on it
+        write_frame(pd.DataFrame({'x':[4]}), 'source', 'input', self.engine, if_exists='append', index=False)
+        runner, result = self.build()
+        self.assertEqual(list(result['x']), [2,4,6,8])
+        self.assertEqual(self.calls, ['read', 'double', 'read', 'double'])
+
+    def test_resume_from(self):
+        self.build()
+        runner, result = self.build(resume_from='double')
+        self.assertEqual(self.calls, ['read', 'double', 'double'])
+        self.assertEqual(list(runner.summary()['origin']), ['resumed', 'computed'])
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'checkpoints', 'double'))), 1)
+
+    def test_submit(self):
+        runner = StageRunner(os.path.join(self.directory, 'checkpoints'), self.engine)
+        pool = ThreadPool(2)
+        started = threading.Event()
+        def left():
+            started.set()
+            return(pd.read_sql('select * from input.source', self.engine))
+        def right():
+            # Runs while the other source stage is running
+            self.assertTrue(started.wait(5))
+            return(pd.DataFrame({'y':[10,20,30]}))
+        runner.submit(pool, 'left', left, sources=[('input.source', None)])
+        runner.submit(pool, 'right', right)
+        joined = runner.submit(pool, 'join', lambda ll, rr: pd.concat([ll, rr], axis=1), upstream=['left', 'right']).get(10)
+        pool.close()
+        pool.join()
+        self.assertEqual(list(joined['x'] + joined['y']), [11,22,33])
+        self.assertEqual(runner.order, ['left', 'right', 'join'])
+        self.assertEqual(sorted(runner.summary()['stage']), ['join', 'left', 'right'])
+
+
+class DensityTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_db_engine({'backend':'sqlite', 'path':self.directory})
+        rows = []
+        for ii, toilet in enumerate(['t2','t1','t3']):
+            for dd in range(3):
+                for area in ['5m','50m']:
+                    rows.append({'ToiletID':toilet, 'Collection_Date':datetime(2012,1,1+dd+ii), 'variable':'Feces_kg_day',
+                                 'functional':'average', 'area':area, 'period':'7 days', 'value':float(ii*10+dd)})
+        rows.append({'ToiletID':'t1', 'Collection_Date':datetime(2012,1,1), 'variable':'Urine_kg_day',
+                     'functional':'sum', 'area':'5m', 'period':'1 days', 'value':4.0})
+        rows.append({'ToiletID':'t1', 'Collection_Date':datetime(2012,1,1), 'variable':'Urine_kg_day',
+                     'functional':'sum', 'area':'5m', 'period':'1 days', 'value':6.0})
+        self.density = pd.DataFrame(rows)
+        write_frame(self.density, 'toiletdensity', 'premodeling', self.engine, if_exists='replace', index=False)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_load_density(self):
+        density = self.density.copy()
+        density['period'] = density['period'].str.replace(' ', '')
+        density['concat'] = density['functional'] +'_'+ density['area'] +'_'+ density['period'] +'_'+ density['variable']
+        expected = pd.pivot_table(density, index=['ToiletID','Collection_Date'], columns='concat', values='value').reset_index()
+        result = load_density(self.engine, chunksize=4)
+        self.assertEqual(list(result.columns), list(expected.columns))
+        self.assertEqual(list(result['ToiletID']), list(expected['ToiletID']))
+        self.assertEqual(list(result['Collection_Date']), list(expected['Collection_Date']))
+        self.assertEqual(result['average_5m_7days_Feces_kg_day'].dtype, np.float32)
+        np.testing.assert_allclose(result[expected.columns[2:]].values, expected[expected.columns[2:]].values)
+
+    def test_many_duplicates(self):
+        duplicates = pd.DataFrame({'ToiletID':'t9', 'Collection_Date':datetime(2012,2,1), 'variable':'Feces_kg_day',
+                                   'functional':'average', 'area':'5m', 'period':'7 days', 'value':np.arange(300.0)})
+        write_frame(duplicates, 'toiletdensity', 'premodeling', self.engine, index=False)
+        result = load_density(self.engine, chunksize=100)
+        self.assertAlmostEqual(result.loc[result['ToiletID'] == 't9', 'average_5m_7days_Feces_kg_day'].values[0], 149.5, places=3)
+
+    def test_since(self):
+        result = load_density(self.engine, since=datetime(2012,1,4), chunksize=4)
+        self.assertEqual(sorted(set(result['ToiletID'])), ['t1','t3'])
+        self.assertTrue((result['Collection_Date'] >= datetime(2012,1,4)).all())
+
+
+class NeighborsTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.x = np.random.uniform(0, 300, 200)
+        self.y = np.random.uniform(0, 300, 200)
+        self.x[1], self.y[1] = self.x[0], self.y[0] # Two toilets at the same place
+
+    def test_neighbor_matrix(self):
+        matrix = neighbor_matrix(self.x, self.y, 100)
+        distances = np.sqrt((self.x[:,None] - self.x[None,:])**2 + (self.y[:,None] - self.y[None,:])**2)
+        np.fill_diagonal(distances, np.inf)
+        counts = neighbor_counts(matrix, [5, 25, 50, 100])
+        for radius in [5, 25, 50, 100]:
+            self.assertEqual(list(counts[radius]), list((distances <= radius).sum(axis=1)))
+        self.assertEqual(matrix[0, 1], 0)
+        self.assertEqual(counts[5][0] >= 1, True)
+        within = distances <= 100
+        np.testing.assert_allclose(np.asarray(matrix.todense())[within], distances[within])
+
+    def test_neighbor_pairs(self):
+        matrix = neighbor_matrix(np.array([0.0, 3.0, 40.0, 500.0]), np.zeros(4), 100)
+        pairs = neighbor_pairs(matrix, ['a','b','c','d'])
+        pairs = pairs.sort_values(by=['ToiletID','NeighborToiletID']).reset_index(drop=True)
+        self.assertEqual(list(pairs['ToiletID']), ['a','a','b','b','c','c'])
+        self.assertEqual(list(pairs['NeighborToiletID']), ['b','c','a','c','a','b'])
+        self.assertEqual(list(pairs['5m']), [1,0,1,0,0,0])
+        self.assertEqual(list(pairs['50m']), [1,1,1,1,1,1])
+
+
+class NeighborhoodTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1)
+        self.toilets = ['a','b','c','d','e']
+        self.x = np.array([0.0, 3.0, 30.0, 45.0, 400.0])
+        self.matrix = neighbor_matrix(self.x, np.zeros(5), 100)
+        rows = []
+        for toilet in self.toilets:
+            for dd in range(20):
+                rows.append({'ToiletID':toilet, 'Collection_Date':datetime(2016,5,1) + timedelta(days=dd),
+                             'Feces_kg_day':np.random.choice([np.nan, 0.0, 1.0, 2.5]),
+                             'Urine_kg_day':np.random.choice([np.nan, 0.0, 3.0])})
+        self.collections = pd.DataFrame(rows)
+        self.history = pd.DataFrame({'ToiletID':self.toilets,
+                                     'StartCollection':[datetime(2016,5,1)]*4 + [datetime(2016,5,5)],
+                                     'LastCollection':[datetime(2016,5,20), datetime(2016,5,12)] + [datetime(2016,5,20)]*3})
+
+    def naive(self, toilet, day, area, period, variable):
+        history = self.history.set_index('ToiletID')
+        if not (history.loc[toilet, 'StartCollection'] < day <= history.loc[toilet, 'LastCollection']):
+            return(None)
+        index = self.toilets.index(toilet)
+        neighbors = [self.toilets[jj] for jj in range(len(self.toilets)) if jj != index and abs(self.x[index] - self.x[jj]) <= area]
+        window = self.collections[self.collections['ToiletID'].isin(neighbors) &
+                                  (self.collections['Collection_Date'] >= day - timedelta(days=period)) &
+                                  (self.collections['Collection_Date'] < day)].dropna(subset=[variable])
+        if len(window) == 0:
+            return(None)
+        return(len(window), window[variable].mean(), (window[variable] != 0).sum())
+
+    def test_neighborhood_features(self):
+        features = pd.concat(list(neighborhood_features(self.collections, self.history, self.matrix, self.toilets)))
+        self.assertEqual(list(features.columns), ['ToiletID','Collection_Date','functional','area','period','variable','observations','value'])
+        features = features.set_index(['ToiletID','Collection_Date','functional','area','period','variable'])
+        for toilet in self.toilets:
+            for dd in range(20):
+                day = datetime(2016,5,1) + timedelta(days=dd)
+                for area in [5, 50]:
+                    for period in [1, 7]:
+                        for variable in ['Feces_kg_day', 'Urine_kg_day']:
+                            expected = self.naive(toilet, day, area, period, variable)
+                            key = (toilet, day, 'average', '%im' %(area), '%i days' %(period), variable)
+                            if expected is None:
+                                self.assertFalse(key in features.index)
+                                continue
+                            self.assertEqual(features.loc[key, 'observations'], expected[0])
+                            self.assertAlmostEqual(features.loc[key, 'value'], expected[1], places=5) # float32 sums
+                            key = (toilet, day, 'collections', '%im' %(area), '%i days' %(period), variable)
+                            self.assertEqual(features.loc[key, 'value'], expected[2])
+        # Toilet a: its only neighbor within 5m (b, 3m away), active up to the 12th
+        self.assertAlmostEqual(features.loc[('a', datetime(2016,5,10), 'average', '5m', '7 days', 'distance'), 'value'], 3.0)
+        self.assertFalse(('e', datetime(2016,5,10), 'average', '50m', '7 days', 'Feces_kg_day') in features.index)
+
+    def test_start_end(self):
+        start, end = datetime(2016,5,10), datetime(2016,5,14)
+        features = pd.concat(list(neighborhood_features(self.collections, self.history, self.matrix, self.toilets, start, end)))
+        full = pd.concat(list(neighborhood_features(self.collections, self.history, self.matrix, self.toilets)))
+        full = full[(full['Collection_Date'] >= start) & (full['Collection_Date'] <= end)]
+        self.assertEqual(len(features), len(full))
+        self.assertTrue((features['Collection_Date'] >= start).all() and (features['Collection_Date'] <= end).all())
+
+    def test_write_neighborhood_features(self):
+        directory = tempfile.mkdtemp()
+        engine = create_db_engine({'backend':'sqlite', 'path':directory})
+        try:
+            write_frame(self.collections, 'toiletcollection', 'premodeling', engine, if_exists='replace', index=False)
+            write_frame(self.history, 'toilethistory', 'premodeling', engine, if_exists='replace', index=False)
+            write_frame(neighbor_pairs(self.matrix, self.toilets), 'toiletdistances', 'premodeling', engine, if_exists='replace', index=False)
+            full = write_neighborhood_features(engine)
+            updated = write_neighborhood_features(engine, start=datetime(2016,5,15))
+            self.assertEqual(engine.execute('select count(*) from premodeling.toiletdensity').scalar(), full)
+            density = load_density(engine)
+            self.assertTrue('average_50m_7days_distance' in density.columns)
+            self.assertTrue(0 < updated < full)
+        finally:
+            engine.dispose()
+            shutil.rmtree(directory)
+
+    def test_pairs_matrix(self):
+        pairs = neighbor_pairs(self.matrix, self.toilets)
+        matrix = pairs_matrix(pairs, self.toilets)
+        np.testing.assert_allclose(np.asarray(matrix.todense()), np.asarray(self.matrix.todense()))
+
+    def test_activity_matrix(self):
+        # Two lifetimes of b, one of a over the edges of the days, an unknown toilet and a missing end
+        history = pd.DataFrame({'ToiletID':['a','b','b','x','c'],
+                                'StartCollection':[datetime(2016,4,1), datetime(2016,5,2), datetime(2016,5,5), datetime(2016,5,1), datetime(2016,5,1)],
+                                'LastCollection':[datetime(2016,6,1), datetime(2016,5,3), datetime(2016,5,6), datetime(2016,5,6), None]})
+        active = activity_matrix(history, ['a','b','c'], day_points([datetime(2016,5,1)])[0], 7)
+        self.assertEqual(active.dtype, np.bool_)
+        self.assertEqual(active.astype(int).tolist(), [[1,1,1,1,1,1,1], [0,0,1,0,0,1,0], [0,0,0,0,0,0,0]])
+
+
+class GeometriesTest(unittest.TestCase):
+    def setUp(self):
+        self.features = [{'type':'Feature', 'properties':{'Name':'a', 'Kind':'toilet'},
+                          'geometry':{'type':'Point', 'coordinates':[36.8, -1.3, 0.0]}},
+                         {'type':'Feature', 'properties':{'Name':'b', 'Kind':None},
+                          'geometry':{'type':'Polygon', 'coordinates':[[[36.0, -1.0], [37.0, -1.0], [37.0, -2.0], [36.0, -1.0]]]}},
+                         {'type':'Feature', 'properties':{'Name':'c', 'Kind':'boundary'},
+                          'geometry':{'type':'GeometryCollection', 'geometries':[{'type':'LineString', 'coordinates':[[1.0, 2.0], [3.0, 4.0]]}]}},
+                         {'type':'Feature', 'properties':{'Name':'d', 'Kind':None}, 'geometry':None}]
+
+    def test_reproject_features(self):
+        calls = []
+        def transform(x, y):
+            calls.append(len(x))
+            return(x * 2, y + 10)
+        reproject_features(self.features, transform)
+        self.assertEqual(calls, [7])
+        self.assertEqual(self.features[0]['geometry']['coordinates'], [73.6, 8.7, 0.0])
+        self.assertEqual(self.features[1]['geometry']['coordinates'][0][1], [74.0, 9.0])
+        self.assertEqual(self.features[2]['geometry']['geometries'][0]['coordinates'], [[2.0, 12.0], [6.0, 14.0]])
+
+    def test_feature_frame(self):
+        frame = feature_frame(self.features)
+        self.assertEqual(sorted(frame.columns), ['geometry', 'kind', 'name'])
+        self.assertEqual(json.loads(frame['geometry'][1])['type'], 'Polygon')
+        self.assertTrue(frame['geometry'][3] is None)
+
+    def test_feature_frame_fields(self):
+        # A batch without a field of the layer still has its column, and only the fields of the layer
+        frame = feature_frame(self.features[:1], fields=['Name', 'Kind', 'Height'])
+        self.assertEqual(list(frame.columns), ['name', 'kind', 'height', 'geometry'])
+        self.assertTrue(pd.isnull(frame['height'][0]))
+        self.assertEqual(list(feature_frame(self.features[:1], fields=['Name']).columns), ['name', 'geometry'])
+
+    def test_batches_and_geojson(self):
+        self.assertEqual([len(batch) for batch in batches(range(7), 3)], [3, 3, 1])
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'areas.geojson')
+            writer = GeoJSONWriter(path)
+            for batch in batches(self.features, 3):
+                writer.write(batch)
+            writer.close()
+            with open(path) as stream:
+                collection = json.load(stream)
+            self.assertEqual(collection['type'], 'FeatureCollection')
+            self.assertEqual([feature['properties']['Name'] for feature in collection['features']], ['a','b','c','d'])
+        finally:
+            shutil.rmtree(directory)
+
+
 class modelsTest(unittest.TestCase):
     def setUp(self):
         self.horizon = 7